@@ -232,6 +232,12 @@ def edit_files():
       <disabled> 0 </disabled>
       <output> fits2wu.out </output>
     </task>
+    <task>
+      <cmd> /home/ec2-user/boinc-magphys/server/src/work_generation/priority_scheduler.py --reissue </cmd>
+      <period> 1 hour </period>
+      <disabled> 0 </disabled>
+      <output> priority_scheduler.out </output>
+    </task>
     <task>
       <cmd> /home/ec2-user/boinc-magphys/server/src/archive/archive_task.py boinc </cmd>
       <period> 12 hours </period>
@@ -416,6 +416,37 @@ threshold = "1000"
 high_water_mark = "400"
 report_deadline = "7"
 pixel_commit_threshold = "76"
+bulk_insert_size = "1000"
+boinc_batch_size = "100"
+boinc_batch_retries = "3"
+writer_threads = "4"
+pipeline_queue_size = "100"
+id_block_size = "10000"
+poll_seconds = "5"
+metadata_cache_seconds = "600"
+sizing = "fixed"
+target_runtimes = "14400", "28800", "43200"
+host_flops = "3e9"
+pack_max_pixels = "100"
+pack_galaxies = "20"
+gzip_inputs = "False"
+scheduler_completion = "0.9"
+scheduler_priority = "100"
+straggler_hours = "48"
+straggler_max_reissue = "1"
+upload_threads = "0"
+upload_part_mb = "16"
+upload_part_threads = "4"
+upload_retry_minutes = "30"
+upload_max_attempts = "3"
+
+# Assimilator settings
+batch_pixels = "5000"
+batch_seconds = "30"
+sed_spool_dir = "/home/ec2-user/sed_spool"
+sed_upload_threads = "4"
+sed_upload_queue_size = "100"
+sed_upload_attempts = "5"
 
 # Archive settings
 delete_delay = "5"
@@ -30,7 +30,7 @@ import datetime
 from sqlalchemy.sql import select, func, and_
 from utils.logging_helper import config_logger
 from config import DELETED, ARC_DELETE_DELAY, STORED
-from database.database_support_core import GALAXY, AREA, PIXEL_RESULT, FITS_HEADER, REGISTER, TAG_REGISTER
+from database.database_support_core import GALAXY, AREA, PIXEL_RESULT, FITS_HEADER, REGISTER, REGISTER_CURSOR, REGISTER_PREFLIGHT, TAG_REGISTER
 from utils.name_builder import get_galaxy_file_name, get_sed_files_bucket
 from utils.s3_helper import S3Helper
 from utils.shutdown_detection import shutdown
@@ -126,6 +126,10 @@ def delete_register_entries(connection, register_ids):
             LOG.info("Deleting tags for register entry {0}".format(register_id))
             connection.execute(TAG_REGISTER.delete().where(TAG_REGISTER.c.register_id == register_id))
 
+            # The cursor is only left by a work generator that stopped before the galaxy was finished
+            connection.execute(REGISTER_CURSOR.delete().where(REGISTER_CURSOR.c.register_id == register_id))
+            connection.execute(REGISTER_PREFLIGHT.delete().where(REGISTER_PREFLIGHT.c.register_id == register_id))
+
             LOG.info('Deleting register entry with register_id of %d - %s', register_id, register[REGISTER.c.galaxy_name])
             connection.execute(REGISTER.delete().where(REGISTER.c.register_id == register_id))
 
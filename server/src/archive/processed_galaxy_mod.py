@@ -26,11 +26,12 @@ The function used to process a galaxy
 """
 import datetime
 from sqlalchemy import select, func, and_
-from database.database_support_core import AREA, GALAXY
+from database.database_support_core import AREA, AREA_PACK, GALAXY
 from sqlalchemy.engine import create_engine
 from config import BOINC_DB_LOGIN, PROCESSED, COMPUTING
 from database.boinc_database_support_core import RESULT
 from utils.logging_helper import config_logger
+from utils.name_builder import parse_work_unit_name
 
 from utils.shutdown_detection import shutdown
 
@@ -81,11 +82,20 @@ def sort_data(connection, current_jobs, modulus, remainder):
     return_data = {}
     for job_name in current_jobs:
         #LOG.info('Checking {0}'.format(job_name))
-        index = job_name.index('_area')
-        galaxy_name = job_name[0:index]
+        # The result name is the work unit name followed by _<result number>
+        wu_name = job_name[0:job_name.rfind('_')]
+        work_unit_area = parse_work_unit_name(wu_name)
+        if work_unit_area is None:
+            LOG.info('{0} is not a work unit for an area'.format(job_name))
+            continue
 
-        index1 = job_name.index('_', index + 5)
-        area_number = job_name[index + 5: index1]
+        area_id, packed = work_unit_area
+        if packed:
+            add_packed_areas(connection, area_id, return_data, modulus, remainder)
+            continue
+
+        galaxy_name = wu_name[0:wu_name.rindex('_area')]
+        area_number = str(area_id)
 
         cached_galaxy = get_cached_galaxy(cache_data, galaxy_name, int(area_number))
         #LOG.info('Cache check = {0}'.format(cached_galaxy))
@@ -128,6 +138,30 @@ def sort_data(connection, current_jobs, modulus, remainder):
     return return_data
 
 
+def add_packed_areas(connection, pack_area_id, return_data, modulus, remainder):
+    """
+    A packed work unit holds areas from several galaxies - every one of them is still being processed
+
+    :param connection: the database connection
+    :param pack_area_id: the first area in the work unit - its opaque value and the pack_area_id of its AREA_PACK rows
+    :param return_data: the map of the galaxy key to the areas still being processed, added to here
+    :param modulus: only add the galaxies whose id % modulus == remainder, or None for all of them
+    :param remainder: see modulus
+    :return:
+    """
+    for area in connection.execute(select([GALAXY.c.name, GALAXY.c.galaxy_id, AREA.c.area_id], from_obj=AREA_PACK.join(AREA).join(GALAXY))
+                                   .where(AREA_PACK.c.pack_area_id == pack_area_id)):
+        galaxy_id = int(area[GALAXY.c.galaxy_id])
+        if modulus is None or galaxy_id % modulus == remainder:
+            key = build_key(area[GALAXY.c.name], galaxy_id)
+            areas = return_data.get(key)
+            if areas is None:
+                areas = []
+                return_data[key] = areas
+
+            areas.append(str(area[AREA.c.area_id]))
+
+
 def finish_processing(galaxy_name, galaxy_id, sorted_data):
     """
     Have we finished processing yet
@@ -4,7 +4,7 @@ Generic Assimilator framework
 """
 
 import os, re, signal, sys, time, hashlib
-from Boinc import database, boinc_db, boinc_project_path, configxml, sched_messages
+from Boinc import database, db_base, boinc_db, boinc_project_path, configxml, sched_messages
 
 
 # Peter Norvig's Abstract base class hack
@@ -45,7 +45,13 @@ class Assimilator():
         self.update_db = True
         self.noinsert = False
         self.wu_id_mod = 0
-        self.wu_id_remainder = 0
+        self.wu_id_remainders = set([0])
+        self.workers = 0
+        self.assimilated_count = 0
+        self.assimilated_counter = None
+        self.counted_assimilated = 0
+        self.page_size = 1000
+        self.pending_assimilated = []
         self.one_pass = False
         self.one_pass_N_WU = 0
         self.appname = ''
@@ -136,12 +142,52 @@ class Assimilator():
             return True
         return False
 
+    def find_work_units(self, app, after_id):
+        """
+        Gets the next page of workunits that are ready to be assimilated,
+        in id order, starting after the workunit with the id after_id.
+        Only the ids are read by the query that pages through the table,
+        the workunits themselves are then loaded in one find.
+        """
+        query = 'select id from workunit where appid = %d and assimilate_state = %d and id > %d' % (app.id, boinc_db.ASSIMILATE_READY, after_id)
+        if self.wu_id_mod > 0:
+            # if the user has turned on the WU mod flag, adhere to it
+            query += ' and id %% %d in (%s)' % (self.wu_id_mod, ', '.join(str(remainder) for remainder in sorted(self.wu_id_remainders)))
+        query += ' order by id limit %d' % self.page_size
+
+        cursor = db_base.get_dbconnection().cursor()
+        cursor.execute(query)
+        ids = [row['id'] for row in cursor.fetchall()]
+        cursor.close()
+        if len(ids) == 0:
+            return []
+
+        units = database.Workunits.find(_extra_params=['id in (%s)' % ', '.join(str(wu_id) for wu_id in ids)])
+        units.sort(key=lambda wu: wu.id)
+        return units
+
+    @staticmethod
+    def find_results(units):
+        """
+        Gets the results for a page of workunits in one find.
+        Returns a dictionary of the workunit id to its results.
+        """
+        results = {}
+        for wu in units:
+            results[wu.id] = []
+        if len(units) > 0:
+            for result in database.Results.find(_extra_params=['workunitid in (%s)' % ', '.join(str(wu.id) for wu in units)]):
+                results[result.workunit.id].append(result)
+        return results
+
     def do_pass(self, app):
         """
         This method scans the database for workunits that need to be
         assimilated. It handles all processing rules passed in on the command
         line, except for -noinsert, which must be handled in assimilate_handler.
         Calls check_stop_trigger before doing any work.
+        The workunits are read a page at a time, in id order, and the
+        workunits assimilated in each page are tagged in one update.
         """
 
         did_something = False
@@ -149,59 +195,125 @@ class Assimilator():
         self.check_stop_trigger()
         self.pass_count += 1
         n = 0
+        after_id = 0
+
+        while True:
+            # look for workunits with correct appid and
+            # assimilate_state==ASSIMILATE_READY
+            units = self.find_work_units(app, after_id)
+            if len(units) == 0:
+                break
+
+            self.logDebug("pass %d, page after %d, units %d\n", self.pass_count, after_id, len(units))
+            after_id = units[-1].id
+            unit_results = self.find_results(units)
+
+            for wu in units:
+                # stop between workunits once SIGINT has been caught
+                if self.caught_sig_int:
+                    break
+
+                # track how many jobs have been processed
+                # stop if the limit is reached
+                n += 1
+                if self.one_pass_N_WU > 0 and n > self.one_pass_N_WU:
+                    self.finish_pass()
+                    self.commit_assimilated()
+                    self.count_assimilated()
+                    return did_something
+
+                # only mark as dirty if the database is modified
+                if self.update_db:
+                    did_something = True
+
+                canonical_result = None
+                self.logDebug("[%s] assimilating: state=%d\n", wu.name, wu.assimilate_state)
+                results = unit_results[wu.id]
+
+                # look for canonical result for workunit in results
+                for result in results:
+                    if result == wu.canonical_result:
+                        canonical_result = result
+
+                if canonical_result is None and wu.error_mask == 0:
+                    # If no canonical result found and WU had no other errors,
+                    # something is wrong, e.g. result records got deleted prematurely.
+                    # This is probably unrecoverable, so mark the WU as having
+                    # an assimilation error and keep going.
+                    wu.error_mask = boinc_db.WU_ERROR_NO_CANONICAL_RESULT
+                    wu.commit()
+
+                # assimilate handler
+                rc = self.assimilate_handler(wu, results, canonical_result)
+
+                # TODO: check for DEFER_ASSIMILATION as a return value from assimilate_handler
+
+                if rc == 0:
+                    self.assimilated_count += 1
+                    if self.update_db:
+                        self.mark_assimilated(wu)
+
+            self.commit_assimilated()
+            self.count_assimilated()
+            if self.caught_sig_int or len(units) < self.page_size:
+                break
+
+        self.finish_pass()
+        self.commit_assimilated()
+        self.count_assimilated()
 
-        units = database.Workunits.find(app=app, assimilate_state=boinc_db.ASSIMILATE_READY)
+        # return did something result
+        return did_something
 
-        self.logDebug("pass %d, units %d\n", self.pass_count, len(units))
+    def mark_assimilated(self, wu):
+        """
+        Tags the workunit as ASSIMILATE_DONE. The tag is written to the
+        database by commit_assimilated at the end of each page. Child classes
+        that save their results in batches can hold the workunit back until
+        its batch has been committed.
+        """
+        wu.assimilate_state = boinc_db.ASSIMILATE_DONE
+        self.pending_assimilated.append(wu)
 
-        # look for workunits with correct appid and
-        # assimilate_state==ASSIMILATE_READY
-        for wu in units:
-            # if the user has turned on the WU mod flag, adhere to it
-            if self.wu_id_mod > 0:
-                if wu.id % self.wu_id_mod != self.wu_id_remainder:
-                    continue
-
-            # track how many jobs have been processed
-            # stop if the limit is reached
-            n += 1
-            if self.one_pass_N_WU > 0 and n > self.one_pass_N_WU:
-                return did_something
-
-            # only mark as dirty if the database is modified
-            if self.update_db:
-                did_something = True
-
-            canonical_result = None
-            self.logDebug("[%s] assimilating: state=%d\n", wu.name, wu.assimilate_state)
-            results = database.Results.find(workunit=wu)
-
-            # look for canonical result for workunit in results
-            for result in results:
-                if result == wu.canonical_result:
-                    canonical_result = result
-
-            if canonical_result is None and wu.error_mask == 0:
-                # If no canonical result found and WU had no other errors,
-                # something is wrong, e.g. result records got deleted prematurely.
-                # This is probably unrecoverable, so mark the WU as having
-                # an assimilation error and keep going.
-                wu.error_mask = boinc_db.WU_ERROR_NO_CANONICAL_RESULT
-                wu.commit()
-
-            # assimilate handler
-            rc = self.assimilate_handler(wu, results, canonical_result)
-
-            # TODO: check for DEFER_ASSIMILATION as a return value from assimilate_handler
-
-            if self.update_db and rc == 0:
-                # tag wu as ASSIMILATE_DONE
-                wu.assimilate_state = boinc_db.ASSIMILATE_DONE
-                wu.transition_time = int(time.time())
-                wu.commit()
+    def commit_assimilated(self):
+        """
+        Writes the ASSIMILATE_DONE tags for the workunits passed to
+        mark_assimilated in one update
+        """
+        if len(self.pending_assimilated) == 0:
+            return
 
-        # return did something result
-        return did_something
+        transition_time = int(time.time())
+        for wu in self.pending_assimilated:
+            wu.transition_time = transition_time
+
+        connection = db_base.get_dbconnection()
+        cursor = connection.cursor()
+        cursor.execute('update workunit set assimilate_state = %d, transition_time = %d where id in (%s)' % (boinc_db.ASSIMILATE_DONE, transition_time, ', '.join(str(wu.id) for wu in self.pending_assimilated)))
+        cursor.close()
+        connection.commit()
+        self.pending_assimilated = []
+
+    def count_assimilated(self):
+        """
+        Adds the workunits assimilated since the last call to the counter
+        shared with the AssimilatorSupervisor, if there is one. Called after
+        each page so the supervisor's throughput doesn't wait for a whole pass.
+        """
+        if self.assimilated_counter is None or self.assimilated_count == self.counted_assimilated:
+            return
+
+        with self.assimilated_counter.get_lock():
+            self.assimilated_counter.value += self.assimilated_count - self.counted_assimilated
+        self.counted_assimilated = self.assimilated_count
+
+    def finish_pass(self):
+        """
+        Called at the end of each pass, while the BOINC database is still
+        connected. Child classes that save their results in batches must
+        commit what is left here.
+        """
+        pass
 
     def parse_args(self, args):
         """
@@ -228,7 +340,11 @@ class Assimilator():
                 self.update_db = False
             elif arg == '-mod':
                 self.wu_id_mod = int(args.pop())
-                self.wu_id_remainder = int(args.pop())
+                self.wu_id_remainders = set([int(args.pop())])
+            elif arg == '-workers':
+                self.workers = int(args.pop())
+            elif arg == '-page_size':
+                self.page_size = int(args.pop())
             elif arg == '-d':
                 arg = args.pop()
                 self.log.set_debug_level(arg)
@@ -244,6 +360,8 @@ class Assimilator():
         one_pass or one_pass_WU_N flags are set. Before execution
         parse_args() is called, the xml config file is loaded and
         the SIGINT signal is hooked to the sigint_handler method.
+        With -workers N the workunits are shared between N worker
+        processes looked after by an AssimilatorSupervisor.
         """
         self.parse_args(sys.argv[1:])
         self.config = configxml.default_config().config
@@ -253,19 +371,36 @@ class Assimilator():
         app = database.Apps.find1(name=self.appname)
         database.close()
 
-        signal.signal(signal.SIGINT, self.sigint_handler)
-
-        # do one pass or execute main loop
+        # do one pass, start the workers or execute main loop
         if self.one_pass:
+            signal.signal(signal.SIGINT, self.sigint_handler)
             self.do_pass(app)
+        elif self.workers > 1:
+            # Imported here so the framework itself only needs the Boinc package
+            from assimilator_supervisor import AssimilatorSupervisor
+            AssimilatorSupervisor(self, app, self.workers).run()
         else:
-            # main loop
-            while 1:
-                database.connect()
-                workdone = self.do_pass(app)
-                database.close()
-                if not workdone:
-                    time.sleep(self.sleep_interval)
+            signal.signal(signal.SIGINT, self.sigint_handler)
+            self.main_loop(app)
+
+    def main_loop(self, app):
+        """
+        Keep doing passes until the stop trigger is found
+        """
+        while 1:
+            database.connect()
+            workdone = self.do_pass(app)
+            database.close()
+            if not workdone:
+                time.sleep(self.sleep_interval)
+
+    def start_worker(self):
+        """
+        Called in a worker process started by the AssimilatorSupervisor
+        before it does any work. Child classes should drop any database
+        connections they inherited from the supervisor here.
+        """
+        pass
 
     def _writeLog(self, mode, *args):
         """
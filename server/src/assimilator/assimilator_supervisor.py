@@ -0,0 +1,320 @@
+#
+#    Copyright (c) UWA, The University of Western Australia
+#    M468/35 Stirling Hwy
+#    Perth WA 6009
+#    Australia
+#
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Run several assimilators at once, each looking after some of the work units.
+
+The work units are split into partitions by their id, as -mod N R does, with a few partitions for
+each worker. A worker that dies is started again. If the work waiting in some workers' partitions
+is well ahead of the rest, the partitions are handed out again. A partition only moves once the
+worker that had it has stopped, so two workers never assimilate the same work unit.
+"""
+import multiprocessing
+import os
+import signal
+import time
+from Boinc import boinc_db, database
+from sqlalchemy import create_engine, func
+from sqlalchemy.sql.expression import select
+from config import BOINC_DB_LOGIN
+from database.boinc_database_support_core import WORK_UNIT
+
+# Each worker gets this many partitions, so they can be moved around
+PARTITIONS_PER_WORKER = 4
+
+# How often the workers are checked
+POLL_SECONDS = 1.0
+
+# How often the throughput is reported
+REPORT_SECONDS = 60
+
+# How often the backlog is checked, and how many times the average of the other workers the busiest
+# worker's backlog must be before it is rebalanced
+REBALANCE_SECONDS = 300
+REBALANCE_SKEW = 2.0
+REBALANCE_MIN_BACKLOG = 100
+
+# Don't start a worker again more often than this
+RESTART_SECONDS = 10
+
+
+def assign_partitions(backlog, workers):
+    """
+    Share the partitions between the workers so each has about the same backlog. The busiest partitions
+    are handed out first, each to the worker with the least so far.
+
+    >>> assign_partitions([5, 1, 1, 1, 4, 0, 0, 0], 2)
+    [set([0, 2, 5, 6]), set([1, 3, 4, 7])]
+
+    :param backlog: the number of work units waiting in each partition
+    :param workers: the number of workers
+    :return: a list of the set of partitions for each worker
+    """
+    assignments = [set() for _ in range(workers)]
+    loads = [0] * workers
+    for partition in sorted(range(len(backlog)), key=lambda index: (-backlog[index], index)):
+        worker = min(range(workers), key=lambda index: (loads[index], len(assignments[index]), index))
+        assignments[worker].add(partition)
+        loads[worker] += backlog[partition]
+
+    return assignments
+
+
+def needs_rebalance(loads):
+    """
+    Is the busiest worker far enough ahead of the others to be worth moving the partitions?
+    It is compared with the average of the other workers, so this works for two workers too.
+
+    >>> needs_rebalance([300, 100])
+    True
+    >>> needs_rebalance([150, 100])
+    False
+    >>> needs_rebalance([50, 0])
+    False
+
+    :param loads: the backlog of each worker
+    :return: True if the partitions should be handed out again
+    """
+    busiest = max(loads)
+    others = (sum(loads) - busiest) / float(len(loads) - 1)
+    return busiest >= REBALANCE_MIN_BACKLOG and busiest > others * REBALANCE_SKEW
+
+
+def reassign_partitions(current, backlog):
+    """
+    Share the partitions out again with assign_partitions, but leave alone the workers that
+    would get the partitions they already have. Their sets are returned as they are, so a
+    worker still waiting to move keeps the partitions it is moving to.
+
+    >>> current = [set([0, 2, 4, 6]), set([1, 3, 5, 7])]
+    >>> reassign_partitions(current, [5, 1, 1, 1, 4, 0, 0, 0])
+    [set([0, 2, 5, 6]), set([1, 3, 4, 7])]
+    >>> current = [set([0]), set([1, 2, 3, 4]), set([5, 6, 7, 8, 9, 10, 11])]
+    >>> new = reassign_partitions(current, [9, 1, 1, 1, 4, 0, 0, 0, 0, 0, 0, 0])
+    >>> new
+    [set([0]), set([4]), set([1, 2, 3, 5, 6, 7, 8, 9, 10, 11])]
+    >>> [partitions is kept for partitions, kept in zip(new, current)]
+    [True, False, False]
+    >>> current = [set([1, 3, 4, 7]), set([0, 2, 5, 6])]
+    >>> new = reassign_partitions(current, [5, 1, 1, 1, 4, 0, 0, 0])
+    >>> [partitions is kept for partitions, kept in zip(new, current)]
+    [True, True]
+
+    :param current: the set of partitions each worker has or is moving to
+    :param backlog: the number of work units waiting in each partition
+    :return: a list of the set of partitions for each worker
+    """
+    assignments = assign_partitions(backlog, len(current))
+
+    # Keep the workers whose partitions haven't changed running
+    kept = [None] * len(current)
+    for worker, partitions in enumerate(current):
+        if partitions in assignments:
+            assignments.remove(partitions)
+            kept[worker] = partitions
+
+    return [partitions if partitions is not None else assignments.pop(0) for partitions in kept]
+
+
+def _worker_main(asm, app, modulus, partitions, counter):
+    """
+    The body of a worker process - the usual assimilator loop over its partitions
+    """
+    asm.wu_id_mod = modulus
+    asm.wu_id_remainders = partitions
+    asm.assimilated_counter = counter
+    asm.caught_sig_int = False
+    signal.signal(signal.SIGINT, asm.sigint_handler)
+    asm.start_worker()
+
+    while 1:
+        database.connect()
+        workdone = asm.do_pass(app)
+        database.close()
+
+        if not workdone:
+            time.sleep(asm.sleep_interval)
+
+
+class _WorkerSlot:
+    """
+    A worker, the partitions it has and the partitions it should have
+    """
+    def __init__(self, number, partitions):
+        self.number = number
+        self.partitions = partitions
+        self.next_partitions = partitions
+        self.process = None
+        self.started = 0
+        self.stopping = False
+
+
+class AssimilatorSupervisor:
+    """
+    Starts the worker processes, restarts them if they die and rebalances their partitions
+    """
+    def __init__(self, asm, app, workers):
+        """
+        Initialise the supervisor
+
+        :param asm: the assimilator each worker runs
+        :param app: the BOINC app
+        :param workers: the number of worker processes
+        """
+        self._asm = asm
+        self._app = app
+        self._modulus = workers * PARTITIONS_PER_WORKER
+        self._slots = [_WorkerSlot(number, set(range(number, self._modulus, workers))) for number in range(workers)]
+        self._counter = multiprocessing.Value('l', 0)
+        self._stopping = False
+        self._caught_sig_int = False
+
+    def run(self):
+        """
+        Look after the workers until the stop trigger is found or SIGINT is caught, then wait for them to finish
+        """
+        signal.signal(signal.SIGINT, self._sigint_handler)
+        self._asm.logNormal('Starting %d workers with %d partitions\n', len(self._slots), self._modulus)
+
+        start = time.time()
+        last_report = start
+        last_count = 0
+        last_rebalance = start
+        while True:
+            if not self._stopping and (self._caught_sig_int or os.path.exists(self._asm.STOP_TRIGGER_FILENAME)):
+                self._asm.logCritical('Stopping the workers\n')
+                self._stopping = True
+                for slot in self._slots:
+                    self._stop(slot)
+
+            self._check_workers()
+            if self._stopping and all([slot.process is None for slot in self._slots]):
+                break
+
+            now = time.time()
+            if now - last_report >= REPORT_SECONDS:
+                count = self._counter.value
+                self._asm.logNormal('Assimilated %d workunits in the last %d seconds (%.2f per second), %d since starting\n',
+                                    count - last_count, now - last_report, (count - last_count) / (now - last_report), count)
+                last_report = now
+                last_count = count
+
+            if not self._stopping and now - last_rebalance >= REBALANCE_SECONDS:
+                self._rebalance()
+                last_rebalance = now
+
+            time.sleep(POLL_SECONDS)
+
+        count = self._counter.value
+        elapsed = max(time.time() - start, 1)
+        self._asm.logNormal('All workers have stopped. Assimilated %d workunits in %d seconds (%.2f per second)\n', count, elapsed, count / elapsed)
+
+    def _sigint_handler(self, sig, stack):
+        self._caught_sig_int = True
+
+    def _check_workers(self):
+        """
+        Reap the workers that have stopped and start the ones that should be running
+        """
+        for slot in self._slots:
+            if slot.process is not None and not slot.process.is_alive():
+                slot.process.join()
+                if not slot.stopping:
+                    self._asm.logCritical('Worker %d stopped with exit code %s\n', slot.number, slot.process.exitcode)
+                slot.process = None
+                slot.stopping = False
+
+        if self._stopping:
+            return
+
+        # A partition can only be taken over once the worker that had it has stopped
+        running = set()
+        for slot in self._slots:
+            if slot.process is not None:
+                running.update(slot.partitions)
+
+        for slot in self._slots:
+            if slot.process is None and len(slot.next_partitions & running) == 0 and time.time() - slot.started >= RESTART_SECONDS:
+                self._start(slot)
+                running.update(slot.partitions)
+
+    def _start(self, slot):
+        slot.partitions = slot.next_partitions
+        slot.started = time.time()
+        slot.process = multiprocessing.Process(target=_worker_main,
+                                               args=(self._asm, self._app, self._modulus, slot.partitions, self._counter),
+                                               name='assimilator-{0}'.format(slot.number))
+        slot.process.start()
+        self._asm.logNormal('Started worker %d (pid %d) with partitions %s of %d\n', slot.number, slot.process.pid, sorted(slot.partitions), self._modulus)
+
+    def _stop(self, slot):
+        """
+        Ask the worker to stop once it has finished the work unit it is on
+        """
+        if slot.process is not None and not slot.stopping:
+            slot.stopping = True
+            os.kill(slot.process.pid, signal.SIGINT)
+
+    def _get_backlog(self):
+        """
+        Count the work units waiting to be assimilated in each partition
+        """
+        engine = create_engine(BOINC_DB_LOGIN)
+        connection = engine.connect()
+        try:
+            backlog = [0] * self._modulus
+            partition = WORK_UNIT.c.id % self._modulus
+            for row in connection.execute(select([partition, func.count(WORK_UNIT.c.id)])
+                                          .where(WORK_UNIT.c.appid == self._app.id)
+                                          .where(WORK_UNIT.c.assimilate_state == boinc_db.ASSIMILATE_READY)
+                                          .group_by(partition)):
+                backlog[int(row[0])] = int(row[1])
+            return backlog
+        finally:
+            connection.close()
+            engine.dispose()
+
+    def _rebalance(self):
+        """
+        Hand the partitions out again if the busiest worker has much more waiting than the others
+        """
+        if len(self._slots) < 2:
+            return
+
+        # noinspection PyBroadException
+        try:
+            backlog = self._get_backlog()
+        except Exception:
+            self._asm.logCritical('Unable to count the backlog of the partitions\n')
+            return
+
+        loads = [sum([backlog[partition] for partition in slot.next_partitions]) for slot in self._slots]
+        self._asm.logNormal('Backlog of the workers: %s\n', loads)
+        if not needs_rebalance(loads):
+            return
+
+        for slot, partitions in zip(self._slots, reassign_partitions([slot.next_partitions for slot in self._slots], backlog)):
+            if partitions is not slot.next_partitions:
+                slot.next_partitions = partitions
+                self._asm.logNormal('Moving worker %d to partitions %s\n', slot.number, sorted(slot.next_partitions))
+                self._stop(slot)
@@ -24,6 +24,9 @@
 """
 Some utilities for the Assimilator
 """
+import gzip
+import os
+import tempfile
 
 
 def is_gzip(out_file):
@@ -55,3 +58,54 @@ def is_gzip(out_file):
     finally:
         f.close()
     return result
+
+
+def split_sed_file(out_file, pixel_areas, directory):
+    """
+    Split the output of a work unit holding several areas into one gzip file per area.
+    Anything before the first pixel is copied into every file.
+
+    :param out_file: the output file
+    :param pixel_areas: map of the pxresult_id to the area_id
+    :param directory: where to write the files
+    :return: map of the area_id to the file written for it
+    """
+    if is_gzip(out_file):
+        f = gzip.open(out_file, "rb")
+    else:
+        f = open(out_file, "r")
+
+    header = []
+    area_files = {}
+    file_names = {}
+    current = None
+    in_header = True
+    try:
+        for line in f:
+            if line.startswith(" ####### "):
+                in_header = False
+                area_id = pixel_areas.get(int(line.split()[1][3:]))
+                if area_id is None:
+                    # The pixel wasn't found in the database, so it goes nowhere
+                    current = None
+                    continue
+
+                current = area_files.get(area_id)
+                if current is None:
+                    handle, file_names[area_id] = tempfile.mkstemp(suffix='.gz', dir=directory)
+                    os.close(handle)
+                    current = gzip.open(file_names[area_id], 'wb')
+                    current.writelines(header)
+                    area_files[area_id] = current
+
+                current.write(line)
+            elif current is not None:
+                current.write(line)
+            elif in_header:
+                header.append(line)
+    finally:
+        f.close()
+        for area_file in area_files.values():
+            area_file.close()
+
+    return file_names
@@ -39,21 +39,26 @@ import assimilator
 import gzip
 import traceback
 import datetime
+from collections import OrderedDict
 from Boinc import boinc_db
 from utils.logging_helper import config_logger
-from assimilator_utils import is_gzip
-from config import DB_LOGIN
+from assimilator_utils import is_gzip, split_sed_file
+from config import DB_LOGIN, ASM_BATCH_PIXELS, ASM_BATCH_SECONDS, ASM_SPOOL_DIR, ASM_UPLOAD_THREADS, ASM_UPLOAD_QUEUE_SIZE, ASM_UPLOAD_ATTEMPTS
 from sqlalchemy import create_engine
 from sqlalchemy.sql import select
-from database.database_support_core import PARAMETER_NAME, PIXEL_RESULT, AREA, AREA_USER, GALAXY, GALAXY_USER
-from utils.name_builder import get_sed_files_bucket, get_key_sed
-from utils.s3_helper import S3Helper
+from database.database_support_core import PARAMETER_NAME, PIXEL_RESULT, AREA, AREA_PACK, GALAXY
+from result_batch import ResultBatch
+from sed_uploader import SedUploader
+from utils.name_builder import get_sed_files_bucket, get_key_sed, parse_work_unit_name
 
 LOG = config_logger(__name__)
 LOG.info('PYTHONPATH = {0}'.format(sys.path))
 
 ENGINE = create_engine(DB_LOGIN)
 
+# How many areas to remember the galaxy of between work units
+AREA_CACHE_SIZE = 1000
+
 
 class MagphysAssimilator(assimilator.Assimilator):
 
@@ -63,7 +68,13 @@ class MagphysAssimilator(assimilator.Assimilator):
         # Login is set in the database package
         connection = ENGINE.connect()
         self._map_parameter_name = {}
-        self._database_queue = []
+        self._batch = ResultBatch()
+        self._batch_start = None
+        self._batch_work_units = []
+        self._work_unit_rows = None
+        self._pixel_rows = {}
+        self._area_cache = OrderedDict()
+        self._uploader = None
 
         # Load the parameter name map
         for parameter_name in connection.execute(select([PARAMETER_NAME])):
@@ -73,28 +84,90 @@ class MagphysAssimilator(assimilator.Assimilator):
 
         self.logNormal('Starting assimilator\n')
 
+    def _prefetch(self, connection, wu):
+        """
+        Load the pixel rows for the areas in the work unit in one query, rather than one for each pixel,
+        and the galaxy details of any areas not already in the cache
+        """
+        self._pixel_rows = {}
+        if self.noinsert:
+            return
+
+        # The work generator sets the opaque value to the first area, so the name is only needed if it isn't set
+        area_id = int(wu.opaque or 0)
+        packed = None
+        if area_id <= 0:
+            work_unit_area = parse_work_unit_name(wu.name)
+            if work_unit_area is None:
+                return
+            area_id, packed = work_unit_area
+
+        # A packed work unit has the rest of its areas in AREA_PACK
+        area_ids = [area_id]
+        if packed is not False:
+            pack_area_ids = [area_pack[AREA_PACK.c.area_id] for area_pack in connection.execute(select([AREA_PACK.c.area_id])
+                                                                                                     .where(AREA_PACK.c.pack_area_id == area_id))]
+            if len(pack_area_ids) > 0:
+                area_ids = pack_area_ids
+            elif packed:
+                return
+
+        for pxresult in connection.execute(select([PIXEL_RESULT.c.pxresult_id, PIXEL_RESULT.c.area_id]).where(PIXEL_RESULT.c.area_id.in_(area_ids))):
+            self._pixel_rows[pxresult[PIXEL_RESULT.c.pxresult_id]] = pxresult[PIXEL_RESULT.c.area_id]
+
+        area_ids = [area_id for area_id in area_ids if area_id not in self._area_cache]
+        if len(area_ids) > 0:
+            for galaxy in connection.execute(select([AREA.c.area_id, GALAXY.c.name, GALAXY.c.galaxy_id, GALAXY.c.run_id], from_obj=GALAXY.join(AREA))
+                                             .where(AREA.c.area_id.in_(area_ids))):
+                self._cache_area(galaxy[AREA.c.area_id], (galaxy[GALAXY.c.name], galaxy[GALAXY.c.galaxy_id], galaxy[GALAXY.c.run_id]))
+
+    def _cache_area(self, area_id, galaxy_details):
+        self._area_cache[area_id] = galaxy_details
+        if len(self._area_cache) > AREA_CACHE_SIZE:
+            self._area_cache.popitem(last=False)
+
+    def _get_area_galaxy(self, connection, area_id):
+        """
+        Get the name, id and run of the galaxy the area belongs to
+        """
+        galaxy_details = self._area_cache.pop(area_id, None)
+        if galaxy_details is None:
+            galaxy = connection.execute(select([GALAXY], from_obj=GALAXY.join(AREA))
+                                        .where(AREA.c.area_id == area_id)).first()
+            galaxy_details = (galaxy[GALAXY.c.name], galaxy[GALAXY.c.galaxy_id], galaxy[GALAXY.c.run_id])
+
+        # Most recently used goes to the end
+        self._cache_area(area_id, galaxy_details)
+        return galaxy_details
+
     def _get_pixel_result(self, connection, pxresult_id):
         """
-        Get the pixel result row from the database
+        Get the pixel result row, from the rows loaded for the work unit if it is there, otherwise from the database
         """
         self._area_id = None
         self._pxresult_id = None
         if not self.noinsert:
-            pxresult = connection.execute(select([PIXEL_RESULT]).where(PIXEL_RESULT.c.pxresult_id == pxresult_id)).first()
+            area_id = None
+            if pxresult_id.isdigit():
+                area_id = self._pixel_rows.get(int(pxresult_id))
+                if area_id is not None:
+                    self._area_id = area_id
+                    self._pxresult_id = int(pxresult_id)
+
+            if area_id is None:
+                pxresult = connection.execute(select([PIXEL_RESULT]).where(PIXEL_RESULT.c.pxresult_id == pxresult_id)).first()
+
+                if pxresult is None:
+                    self.logCritical("Pixel Result row not found for pxresult_id = %s\n", pxresult_id)
+                    return
 
-            if pxresult is None:
-                self.logCritical("Pixel Result row not found for pxresult_id = %s\n", pxresult_id)
-            else:
                 # Record the area_id
                 self._area_id = pxresult[PIXEL_RESULT.c.area_id]
                 self._pxresult_id = pxresult[PIXEL_RESULT.c.pxresult_id]
 
-                # Find the galaxy details
-                galaxy = connection.execute(select([GALAXY], from_obj=GALAXY.join(AREA))
-                                            .where(AREA.c.area_id == self._area_id)).first()
-                self._galaxy_name = galaxy[GALAXY.c.name]
-                self._galaxy_id = galaxy[GALAXY.c.galaxy_id]
-                self._run_id = galaxy[GALAXY.c.run_id]
+            # A packed work unit has areas from several galaxies
+            self._areas[self._area_id] = self._get_area_galaxy(connection, self._area_id)
+            self._pixel_areas[self._pxresult_id] = self._area_id
 
     def _save_results(self, map_pixel_results):
         """
@@ -102,7 +175,7 @@ class MagphysAssimilator(assimilator.Assimilator):
         """
         if self._pxresult_id is not None and not self.noinsert:
             # Update the filters
-            self._database_queue.append(PIXEL_RESULT.update().where(PIXEL_RESULT.c.pxresult_id == self._pxresult_id).values(map_pixel_results))
+            self._work_unit_rows.add_pixel_result(self._pxresult_id, map_pixel_results)
 
     def _process_result(self, connection, out_file, wu):
         """
@@ -116,6 +189,9 @@ class MagphysAssimilator(assimilator.Assimilator):
 
         self._area_id = None
         self._pxresult_id = None
+        self._areas = OrderedDict()
+        self._pixel_areas = {}
+        self._prefetch(connection, wu)
         line_number = 0
         percentiles_next = False
         histogram_next = False
@@ -199,34 +275,83 @@ class MagphysAssimilator(assimilator.Assimilator):
             # self.logDebug('%.3f seconds for %d\n', time.time() - start_time, self._pxresult_id)
         return result_count
 
-    def _run_pending_db_tasks(self, connection):
+    def _batch_full(self):
         """
-        Run any pending database tasks in one transaction
-        :param connection:
-        :return:
+        Is it time to write the batch? It is written once it has ASM_BATCH_PIXELS pixels or is ASM_BATCH_SECONDS old.
         """
-        self.logNormal('Committing all pending data to database\n')
-        start = time.time()
+        if self._batch_start is None:
+            return False
+        return len(self._batch) >= ASM_BATCH_PIXELS or time.time() - self._batch_start >= ASM_BATCH_SECONDS
 
-        transaction = connection.begin()
-        try:
-            for query in self._database_queue:
-                connection.execute(query)
-            transaction.commit()
-            self.logNormal('Time spent in database {0:.2f}\n'.format(time.time() - start))
-            self.logNormal('Number of tasks executed {0}\n'.format(len(self._database_queue)))
-            self._database_queue = []
-        except Exception:
-            self.logCritical('An error occurred while running a database task\n')
-            transaction.rollback()
-            raise
+    def _run_pending_db_tasks(self):
+        """
+        Write the rows for all of the work units in the batch in one transaction, then tag the work units as assimilated.
+        If the write fails the work units are left as they were, so they are assimilated again in the next pass.
+        """
+        if not self._batch.is_empty():
+            self.logNormal('Committing all pending data to database\n')
+            start = time.time()
+
+            connection = ENGINE.connect()
+            transaction = connection.begin()
+            try:
+                statements = self._batch.write(connection)
+                transaction.commit()
+                self.logNormal('Time spent in database {0:.2f}\n'.format(time.time() - start))
+                self.logNormal('Number of statements executed {0} for {1} pixels from {2} work units\n'.format(statements, len(self._batch), len(self._batch_work_units)))
+            except Exception:
+                self.logCritical('An error occurred while running a database task, the work units will be retried\n')
+                traceback.print_exception(sys.exc_info()[0], sys.exc_info()[1], sys.exc_info()[2])
+                transaction.rollback()
+                self._batch_work_units = []
+            finally:
+                connection.close()
+
+        for wu in self._batch_work_units:
+            assimilator.Assimilator.mark_assimilated(self, wu)
+        self.commit_assimilated()
+
+        self._batch = ResultBatch()
+        self._batch_start = None
+        self._batch_work_units = []
+
+    def mark_assimilated(self, wu):
+        """
+        The work unit is tagged as assimilated once its batch has been written
+        """
+        self._batch_work_units.append(wu)
+
+    def start_worker(self):
+        """
+        Don't share the supervisor's database connections
+        """
+        ENGINE.dispose()
+
+    def _get_uploader(self):
+        """
+        The upload threads are started in the process that uses them, not in the supervisor
+        """
+        if self._uploader is None:
+            self._uploader = SedUploader(ASM_SPOOL_DIR, ASM_UPLOAD_THREADS, ASM_UPLOAD_QUEUE_SIZE, ASM_UPLOAD_ATTEMPTS)
+        return self._uploader
+
+    def finish_pass(self):
+        """
+        Write what is left of the batch and queue any SED files that have not been uploaded yet
+        """
+        self._run_pending_db_tasks()
+        self._get_uploader().recover(self.wu_id_mod, self.wu_id_remainders)
 
     def assimilate_handler(self, wu, results, canonical_result):
         """
         Process the Results.
         """
         self.logDebug("Start of assimilate_handler for wu %d\n", wu.id)
+        if self._batch_full():
+            self._run_pending_db_tasks()
+
         connection = None
+        self._work_unit_rows = ResultBatch()
         try:
             if wu.canonical_result:
                 out_file = self.get_file_path(canonical_result)
@@ -250,13 +375,9 @@ class MagphysAssimilator(assimilator.Assimilator):
                         if not result_count:
                             self.logCritical("No results were found in the output file\n")
 
-                        if self._area_id is None:
+                        if len(self._areas) == 0:
                             self.logDebug("The Area was not found\n")
                         else:
-                            self._database_queue.append(AREA.update()
-                                                            .where(AREA.c.area_id == self._area_id)
-                                                            .values(workunit_id=wu.id, update_time=datetime.datetime.now()))
-
                             user_id_set = set()
                             for result in results:
                                 if result.user and result.validate_state == boinc_db.VALIDATE_STATE_VALID:
@@ -264,25 +385,44 @@ class MagphysAssimilator(assimilator.Assimilator):
                                     if user_id not in user_id_set:
                                         user_id_set.add(user_id)
 
-                            self._database_queue.append(AREA_USER.delete().where(AREA_USER.c.area_id == self._area_id))
-
-                            insert_area_user = AREA_USER.insert()
-                            insert_galaxy_user = GALAXY_USER.insert().prefix_with('IGNORE')
-                            for user_id in user_id_set:
-                                self._database_queue.append(insert_area_user.values(area_id=self._area_id, userid=user_id))
-                                self._database_queue.append(insert_galaxy_user.values(galaxy_id=self._galaxy_id, userid=user_id))
-
-                            # Copy the file to S3
-                            s3helper = S3Helper()
-                            s3helper.add_file_to_bucket(get_sed_files_bucket(),
-                                                        get_key_sed(self._galaxy_name, self._run_id, self._galaxy_id, self._area_id),
-                                                        out_file,
-                                                        reduced_redundancy=True)
+                            update_time = datetime.datetime.now()
+                            for area_id, (galaxy_name, galaxy_id, run_id) in self._areas.items():
+                                self._work_unit_rows.add_area(area_id, wu.id, update_time, user_id_set)
+                                self._work_unit_rows.add_galaxy_users(galaxy_id, user_id_set)
+
+                            # Spool the file for S3 - the work unit is only tagged as assimilated after this
+                            uploader = self._get_uploader()
+                            if len(self._areas) == 1:
+                                area_id, (galaxy_name, galaxy_id, run_id) = self._areas.items()[0]
+                                uploader.spool(wu.id,
+                                               area_id,
+                                               get_sed_files_bucket(),
+                                               get_key_sed(galaxy_name, run_id, galaxy_id, area_id),
+                                               out_file)
+                            else:
+                                # Each area is stored on its own so the archiver finds it under its own galaxy
+                                area_files = split_sed_file(out_file, self._pixel_areas, ASM_SPOOL_DIR)
+                                try:
+                                    for area_id, area_file in area_files.items():
+                                        galaxy_name, galaxy_id, run_id = self._areas[area_id]
+                                        uploader.spool(wu.id,
+                                                       area_id,
+                                                       get_sed_files_bucket(),
+                                                       get_key_sed(galaxy_name, run_id, galaxy_id, area_id),
+                                                       area_file,
+                                                       move=True)
+                                finally:
+                                    for area_file in area_files.values():
+                                        if os.path.exists(area_file):
+                                            os.remove(area_file)
 
                         time_taken = '{0:.2f}'.format(time.time() - start)
                         self.logDebug("Saving %d results for workunit %d in %s seconds\n", result_count, wu.id, time_taken)
 
-                    self._run_pending_db_tasks(connection)
+                    # The rows are written with the rest of the batch
+                    if self._batch_start is None:
+                        self._batch_start = time.time()
+                    self._batch.merge(self._work_unit_rows)
                     connection.close()
                 else:
                     self.logCritical("The output file was not found\n")
@@ -0,0 +1,149 @@
+#
+#    Copyright (c) UWA, The University of Western Australia
+#    M468/35 Stirling Hwy
+#    Perth WA 6009
+#    Australia
+#
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+The database changes from several work units, written together.
+
+The pixel updates are grouped by the columns they set, so each group is one UPDATE statement
+run with executemany. The AREA_USER and GALAXY_USER rows are written with multi-row inserts.
+"""
+from collections import OrderedDict
+from sqlalchemy.sql.expression import bindparam
+from database.database_support_core import PIXEL_RESULT, AREA, AREA_USER, GALAXY_USER
+
+# The most rows in one multi-row statement
+ROWS_PER_STATEMENT = 1000
+
+
+class ResultBatch:
+    """
+    The rows to be written for one or more work units. If a row turns up twice, the last one wins.
+    """
+    def __init__(self):
+        self._pixel_results = OrderedDict()
+        self._areas = OrderedDict()
+        self._area_users = OrderedDict()
+        self._galaxy_users = set()
+
+    def __len__(self):
+        return len(self._pixel_results)
+
+    def is_empty(self):
+        """
+        Is there anything to write?
+        """
+        return len(self._pixel_results) == 0 and len(self._areas) == 0 and len(self._galaxy_users) == 0
+
+    def add_pixel_result(self, pxresult_id, values):
+        """
+        Add the values for a PIXEL_RESULT row
+
+        :param pxresult_id: the pixel
+        :param values: map of the column name to the value
+        """
+        self._pixel_results[pxresult_id] = values
+
+    def add_area(self, area_id, workunit_id, update_time, user_ids):
+        """
+        Add the work unit and users for an area. The users replace any the area had.
+
+        :param area_id: the area
+        :param workunit_id: the work unit the area was processed in
+        :param update_time: when it was assimilated
+        :param user_ids: the users who processed it
+        """
+        self._areas[area_id] = {'b_area_id': area_id, 'workunit_id': workunit_id, 'update_time': update_time}
+        self._area_users[area_id] = list(user_ids)
+
+    def add_galaxy_users(self, galaxy_id, user_ids):
+        """
+        Add the users who have worked on a galaxy - rows already in GALAXY_USER are ignored
+
+        :param galaxy_id: the galaxy
+        :param user_ids: the users
+        """
+        for user_id in user_ids:
+            self._galaxy_users.add((galaxy_id, user_id))
+
+    def merge(self, other):
+        """
+        Add the rows from another batch, such as the rows for one work unit
+
+        :param other: the ResultBatch
+        """
+        for pxresult_id, values in other._pixel_results.items():
+            self._pixel_results.pop(pxresult_id, None)
+            self._pixel_results[pxresult_id] = values
+        for area_id, area in other._areas.items():
+            self._areas.pop(area_id, None)
+            self._areas[area_id] = area
+        for area_id, user_ids in other._area_users.items():
+            self._area_users.pop(area_id, None)
+            self._area_users[area_id] = user_ids
+        self._galaxy_users.update(other._galaxy_users)
+
+    def write(self, connection):
+        """
+        Write the rows - the caller looks after the transaction
+
+        :param connection: the database connection
+        :return: the number of statements executed
+        """
+        statements = 0
+
+        # executemany needs every row to set the same columns
+        pixel_groups = OrderedDict()
+        for pxresult_id, values in self._pixel_results.items():
+            row = dict(values)
+            row['b_pxresult_id'] = pxresult_id
+            pixel_groups.setdefault(tuple(sorted(values.keys())), []).append(row)
+
+        update_pixel_result = PIXEL_RESULT.update().where(PIXEL_RESULT.c.pxresult_id == bindparam('b_pxresult_id'))
+        for rows in pixel_groups.values():
+            connection.execute(update_pixel_result, rows)
+            statements += 1
+
+        if len(self._areas) > 0:
+            connection.execute(AREA.update().where(AREA.c.area_id == bindparam('b_area_id')), self._areas.values())
+            statements += 1
+
+        area_ids = self._area_users.keys()
+        for index in range(0, len(area_ids), ROWS_PER_STATEMENT):
+            connection.execute(AREA_USER.delete().where(AREA_USER.c.area_id.in_(area_ids[index:index + ROWS_PER_STATEMENT])))
+            statements += 1
+
+        area_user_rows = [{'area_id': area_id, 'userid': user_id} for area_id, user_ids in self._area_users.items() for user_id in user_ids]
+        statements += self._insert_rows(connection, AREA_USER.insert(), area_user_rows)
+
+        galaxy_user_rows = [{'galaxy_id': galaxy_id, 'userid': user_id} for galaxy_id, user_id in sorted(self._galaxy_users)]
+        statements += self._insert_rows(connection, GALAXY_USER.insert().prefix_with('IGNORE'), galaxy_user_rows)
+
+        return statements
+
+    @staticmethod
+    def _insert_rows(connection, insert, rows):
+        statements = 0
+        for index in range(0, len(rows), ROWS_PER_STATEMENT):
+            connection.execute(insert.values(rows[index:index + ROWS_PER_STATEMENT]))
+            statements += 1
+        return statements
@@ -0,0 +1,299 @@
+#
+#    Copyright (c) UWA, The University of Western Australia
+#    M468/35 Stirling Hwy
+#    Perth WA 6009
+#    Australia
+#
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Upload the SED files to S3 in the background.
+
+Each file is first put into a spool directory - the data file, then a small JSON file saying
+where it goes. Once the JSON file has been renamed into place the upload will happen, even if the
+assimilator is stopped or crashes, because the spool is scanned again when it restarts. A pool of
+threads, each with its own S3 connection, works through a bounded queue of the spooled files and
+removes them once they are in S3.
+"""
+import errno
+import json
+import os
+import Queue
+import shutil
+import tempfile
+import threading
+import time
+from utils.logging_helper import config_logger
+from utils.s3_helper import S3Helper
+
+LOG = config_logger(__name__)
+
+DATA_SUFFIX = '.sed'
+ENTRY_SUFFIX = '.json'
+TEMP_PREFIX = 'tmp'
+
+# The wait before the first retry, it doubles with each attempt
+RETRY_SECONDS = 2.0
+
+# Temporary files older than this were left behind by a crash
+STALE_TEMP_SECONDS = 3600
+
+
+def _fsync_directory(directory):
+    """
+    Make sure a rename in the directory is on the disk
+    """
+    handle = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(handle)
+    finally:
+        os.close(handle)
+
+
+def _fsync_file(file_name):
+    handle = os.open(file_name, os.O_RDONLY)
+    try:
+        os.fsync(handle)
+    finally:
+        os.close(handle)
+
+
+def _remove(file_name):
+    try:
+        os.remove(file_name)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+class SedUploader:
+    """
+    Spools the SED files to the local disk and uploads them with a pool of threads
+    """
+    def __init__(self, spool_dir, threads, queue_size, max_attempts):
+        """
+        Initialise the uploader - the threads are started when the first file is spooled
+
+        :param spool_dir: where the files waiting to be uploaded are kept
+        :param threads: the number of upload threads
+        :param queue_size: the maximum number of files waiting for a thread
+        :param max_attempts: how many times a file is tried before it is left for the next recovery
+        """
+        self._spool_dir = spool_dir
+        self._thread_count = max(threads, 1)
+        self._queue = Queue.Queue(max(queue_size, 1))
+        self._max_attempts = max(max_attempts, 1)
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._uploaded = 0
+
+        if not os.path.isdir(spool_dir):
+            try:
+                os.makedirs(spool_dir)
+            except OSError:
+                # Another assimilator may have just created it
+                if not os.path.isdir(spool_dir):
+                    raise
+
+    def spool(self, wu_id, area_id, bucket_name, key_name, source_file, move=False):
+        """
+        Put a file into the spool and queue it for uploading. When this returns the file will be
+        uploaded, even if the assimilator stops before the upload threads get to it.
+        Blocks while the queue is full.
+
+        :param wu_id: the work unit the file came from
+        :param area_id: the area the file holds
+        :param bucket_name: the S3 bucket
+        :param key_name: the S3 key
+        :param source_file: the file to upload
+        :param move: the source file is a temporary file that can be moved into the spool
+        """
+        name = '{0}_{1}'.format(wu_id, area_id)
+        data_file = os.path.join(self._spool_dir, name + DATA_SUFFIX)
+        entry_file = os.path.join(self._spool_dir, name + ENTRY_SUFFIX)
+
+        # The data goes in first, so an entry always has all of its data
+        if move:
+            _fsync_file(source_file)
+            os.rename(source_file, data_file)
+        else:
+            handle, temp_file = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=self._spool_dir)
+            os.close(handle)
+            try:
+                # The BOINC output file is deleted once the work unit is finished with, so we need our own link or copy
+                os.remove(temp_file)
+                os.link(source_file, temp_file)
+            except OSError:
+                shutil.copyfile(source_file, temp_file)
+            _fsync_file(temp_file)
+            os.rename(temp_file, data_file)
+
+        handle, temp_file = tempfile.mkstemp(prefix=TEMP_PREFIX, dir=self._spool_dir)
+        with os.fdopen(handle, 'w') as entry:
+            json.dump({'wu_id': wu_id, 'bucket': bucket_name, 'key': key_name}, entry)
+            entry.flush()
+            os.fsync(entry.fileno())
+        os.rename(temp_file, entry_file)
+        _fsync_directory(self._spool_dir)
+
+        self._start()
+        self._put(name, block=True)
+
+    def recover(self, wu_id_mod=0, wu_id_remainders=None):
+        """
+        Queue the spooled files that are not being uploaded - they were left by an earlier run or
+        ran out of attempts. Nothing is queued if the queue is full, it is tried again next time.
+
+        :param wu_id_mod: only the files from work units where wu_id % wu_id_mod is in wu_id_remainders
+        :param wu_id_remainders: see wu_id_mod
+        :return: the number of files queued
+        """
+        queued = 0
+        waiting = 0
+        for file_name in os.listdir(self._spool_dir):
+            full_name = os.path.join(self._spool_dir, file_name)
+            if file_name.startswith(TEMP_PREFIX):
+                self._remove_stale(full_name)
+                continue
+            if not file_name.endswith(ENTRY_SUFFIX):
+                continue
+
+            name = file_name[:-len(ENTRY_SUFFIX)]
+            if wu_id_mod > 0 and int(name.split('_')[0]) % wu_id_mod not in wu_id_remainders:
+                continue
+
+            waiting += 1
+            with self._lock:
+                if name in self._queued:
+                    continue
+
+            self._start()
+            if not self._put(name, block=False):
+                break
+            queued += 1
+
+        if waiting > 0:
+            LOG.info('{0} SED files waiting to be uploaded, {1} queued again, {2} uploaded so far'.format(waiting, queued, self._uploaded))
+        return queued
+
+    def _put(self, name, block):
+        with self._lock:
+            if name in self._queued:
+                return True
+            self._queued.add(name)
+
+        try:
+            self._queue.put(name, block)
+        except Queue.Full:
+            with self._lock:
+                self._queued.discard(name)
+            return False
+        return True
+
+    def _start(self):
+        if len(self._threads) > 0:
+            return
+
+        for i in range(self._thread_count):
+            thread = threading.Thread(target=self._upload_loop, name='sed-uploader-{0}'.format(i))
+            # Whatever has not been uploaded is still in the spool, so there is no need to wait for the threads
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _remove_stale(self, file_name):
+        try:
+            if time.time() - os.path.getmtime(file_name) > STALE_TEMP_SECONDS:
+                os.remove(file_name)
+        except OSError:
+            # Another assimilator got to it first
+            pass
+
+    def _upload_loop(self):
+        s3helper = None
+        while True:
+            name = self._queue.get()
+            try:
+                for attempt in range(self._max_attempts):
+                    try:
+                        if s3helper is None:
+                            s3helper = S3Helper()
+                        if self._upload(s3helper, name):
+                            break
+                    except Exception:
+                        LOG.exception('Attempt {0} to upload the SED file {1} failed'.format(attempt + 1, name))
+                        # Start again with a new connection
+                        s3helper = None
+                        if attempt + 1 < self._max_attempts:
+                            time.sleep(RETRY_SECONDS * 2 ** attempt)
+                else:
+                    LOG.error('Unable to upload the SED file {0}, it stays in the spool for later'.format(name))
+            finally:
+                with self._lock:
+                    self._queued.discard(name)
+
+    def _upload(self, s3helper, name):
+        """
+        Upload one spooled file and remove it from the spool
+
+        :return: True if the entry is finished with
+        """
+        entry_file = os.path.join(self._spool_dir, name + ENTRY_SUFFIX)
+        data_file = os.path.join(self._spool_dir, name + DATA_SUFFIX)
+        try:
+            entry_stat = os.stat(entry_file)
+            with open(entry_file, 'r') as entry_handle:
+                entry = json.load(entry_handle)
+        except (IOError, OSError) as e:
+            if e.errno != errno.ENOENT:
+                raise
+            # Another assimilator has already uploaded it
+            return True
+
+        try:
+            data_stat = os.stat(data_file)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            # Trying again will never find the data, so the entry is dropped
+            LOG.warning('The SED file {0} has no data in the spool, it will not be uploaded'.format(name))
+            self._remove_if_same(entry_file, entry_stat)
+            return True
+
+        # JSON gives us unicode, boto was always given byte strings
+        s3helper.add_file_to_bucket(entry['bucket'].encode('utf-8'), entry['key'].encode('utf-8'), data_file, reduced_redundancy=True)
+
+        # If the work unit was assimilated again while we were uploading, the new entry and data are left for the next recovery
+        self._remove_if_same(entry_file, entry_stat)
+        self._remove_if_same(data_file, data_stat)
+        with self._lock:
+            self._uploaded += 1
+        return True
+
+    @staticmethod
+    def _remove_if_same(file_name, old_stat):
+        """
+        Remove the file unless it has been replaced since it was looked at
+        """
+        try:
+            if os.stat(file_name).st_ino == old_stat.st_ino:
+                os.remove(file_name)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
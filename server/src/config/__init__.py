@@ -57,6 +57,39 @@ if exists(config_file_name):
     for size in config['size_classes']:
         WG_SIZE_CLASS.append(int(size))
     RADIAL_AREA_SIZE = int(config['radial_area_size'])
+    WG_BULK_INSERT_SIZE = int(config['bulk_insert_size'])
+    WG_BOINC_BATCH_SIZE = int(config['boinc_batch_size'])
+    WG_BOINC_BATCH_RETRIES = int(config['boinc_batch_retries'])
+    WG_WRITER_THREADS = int(config['writer_threads'])
+    WG_PIPELINE_QUEUE_SIZE = int(config['pipeline_queue_size'])
+    WG_ID_BLOCK_SIZE = int(config['id_block_size'])
+    WG_POLL_SECONDS = float(config['poll_seconds'])
+    WG_METADATA_CACHE_SECONDS = int(config['metadata_cache_seconds'])
+    WG_SIZING = config['sizing']
+    WG_TARGET_RUNTIMES = []
+    for runtime in config.as_list('target_runtimes'):
+        WG_TARGET_RUNTIMES.append(float(runtime))
+    WG_HOST_FLOPS = float(config['host_flops'])
+    WG_PACK_MAX_PIXELS = int(config['pack_max_pixels'])
+    WG_PACK_GALAXIES = int(config['pack_galaxies'])
+    WG_GZIP_INPUTS = config.as_bool('gzip_inputs')
+    WG_SCHEDULER_COMPLETION = float(config['scheduler_completion'])
+    WG_SCHEDULER_PRIORITY = int(config['scheduler_priority'])
+    WG_STRAGGLER_HOURS = float(config['straggler_hours'])
+    WG_STRAGGLER_MAX_REISSUE = int(config['straggler_max_reissue'])
+    WG_UPLOAD_THREADS = int(config['upload_threads'])
+    WG_UPLOAD_PART_MB = int(config['upload_part_mb'])
+    WG_UPLOAD_PART_THREADS = int(config['upload_part_threads'])
+    WG_UPLOAD_RETRY_MINUTES = int(config['upload_retry_minutes'])
+    WG_UPLOAD_MAX_ATTEMPTS = int(config['upload_max_attempts'])
+
+    ############### Assimilator Settings ###############
+    ASM_BATCH_PIXELS = int(config['batch_pixels'])
+    ASM_BATCH_SECONDS = float(config['batch_seconds'])
+    ASM_SPOOL_DIR = config['sed_spool_dir']
+    ASM_UPLOAD_THREADS = int(config['sed_upload_threads'])
+    ASM_UPLOAD_QUEUE_SIZE = int(config['sed_upload_queue_size'])
+    ASM_UPLOAD_ATTEMPTS = int(config['sed_upload_attempts'])
 
     ############### ARCHIVE Settings ###############
     ARC_DELETE_DELAY = config['delete_delay']
@@ -24,7 +24,7 @@
 """
 Connect to the BOINC database
 """
-from sqlalchemy import Column, MetaData, BigInteger, String, Table
+from sqlalchemy import Column, MetaData, BigInteger, Integer, String, Table
 
 BOINC_METADATA = MetaData()
 
@@ -35,13 +35,20 @@ RESULT = Table('result',
                Column('workunitid', BigInteger),
                Column('appid', BigInteger),
                Column('name', String),
+               Column('sent_time', Integer),
+               Column('priority', Integer),
 )
 
 WORK_UNIT = Table('workunit',
                   BOINC_METADATA,
                   Column('id', BigInteger, primary_key=True, autoincrement=True),
+                  Column('appid', BigInteger),
                   Column('name', String),
-                  Column('assimilate_state', BigInteger)
+                  Column('assimilate_state', BigInteger),
+                  Column('priority', Integer),
+                  Column('min_quorum', Integer),
+                  Column('target_nresults', Integer),
+                  Column('transition_time', Integer)
 )
 
 USER = Table('user',
@@ -110,6 +110,36 @@ CREATE TABLE register (
   FOREIGN KEY(run_id) REFERENCES run(run_id)
 ) CHARACTER SET utf8 ENGINE=InnoDB;
 
+CREATE TABLE register_cursor (
+  register_id             BIGINT UNSIGNED NOT NULL PRIMARY KEY,
+  galaxy_id               BIGINT UNSIGNED NOT NULL,
+  next_row                INTEGER NOT NULL,
+  min_pixels_per_file_itr INTEGER NOT NULL,
+  next_area_id            BIGINT UNSIGNED NOT NULL,
+  work_units_added        BIGINT UNSIGNED NOT NULL,
+  pixel_count             BIGINT UNSIGNED NOT NULL,
+  update_time             TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+
+  FOREIGN KEY(register_id) REFERENCES register(register_id)
+) CHARACTER SET utf8 ENGINE=InnoDB;
+
+CREATE TABLE register_preflight (
+  register_id          BIGINT UNSIGNED NOT NULL PRIMARY KEY,
+  dimension_x          INTEGER NOT NULL,
+  dimension_y          INTEGER NOT NULL,
+  dimension_z          INTEGER NOT NULL,
+  layer_names          VARCHAR(2000) NOT NULL,
+  layer_order          VARCHAR(1000) NOT NULL,
+  valid_pixels         BIGINT UNSIGNED NOT NULL,
+  row_counts           LONGBLOB NOT NULL,
+  valid_mask           LONGBLOB NOT NULL,
+  estimated_work_units INTEGER NOT NULL,
+  estimated_fpops      DOUBLE NOT NULL,
+  create_time          TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+
+  FOREIGN KEY(register_id) REFERENCES register(register_id)
+) CHARACTER SET utf8 ENGINE=InnoDB;
+
 CREATE TABLE galaxy (
   galaxy_id              BIGINT UNSIGNED NOT NULL PRIMARY KEY AUTO_INCREMENT,
   run_id                 BIGINT UNSIGNED NOT NULL,
@@ -428,3 +458,31 @@ CREATE TABLE galaxy_user (
   INDEX (userid),
   UNIQUE (galaxy_id,userid)
 ) CHARACTER SET utf8 ENGINE=InnoDB;
+
+CREATE TABLE id_block (
+  table_name  VARCHAR(100) NOT NULL PRIMARY KEY,
+  next_id     BIGINT UNSIGNED NOT NULL
+) CHARACTER SET utf8 ENGINE=InnoDB;
+
+CREATE TABLE area_pack (
+  area_id       BIGINT UNSIGNED NOT NULL PRIMARY KEY,
+  pack_area_id  BIGINT UNSIGNED NOT NULL,
+
+  FOREIGN KEY(area_id) REFERENCES area(area_id),
+
+  INDEX (pack_area_id)
+) CHARACTER SET utf8 ENGINE=InnoDB;
+
+CREATE TABLE galaxy_upload (
+  galaxy_upload_id  BIGINT UNSIGNED NOT NULL PRIMARY KEY AUTO_INCREMENT,
+  galaxy_id         BIGINT UNSIGNED NOT NULL,
+  register_id       BIGINT UNSIGNED NOT NULL,
+  pixel_count       BIGINT UNSIGNED NOT NULL,
+  attempts          INTEGER NOT NULL,
+  claim_time        TIMESTAMP NULL DEFAULT NULL,
+  failed_time       TIMESTAMP NULL DEFAULT NULL,
+  create_time       TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+
+  FOREIGN KEY(galaxy_id) REFERENCES galaxy(galaxy_id),
+  FOREIGN KEY(register_id) REFERENCES register(register_id)
+) CHARACTER SET utf8 ENGINE=InnoDB;
@@ -26,7 +26,7 @@ The definitions for using SQLAlchemy Core
 
 """
 
-from sqlalchemy import MetaData, Table, Column, Integer, String, Float, TIMESTAMP, ForeignKey, BigInteger, Numeric
+from sqlalchemy import MetaData, Table, Column, Integer, String, Float, TIMESTAMP, ForeignKey, BigInteger, Numeric, LargeBinary
 
 ##########################################################################
 ##########################################################################
@@ -55,6 +55,12 @@ AREA = Table('area',
              Column('update_time', TIMESTAMP)
              )
 
+AREA_PACK = Table('area_pack',
+                  MAGPHYS_METADATA,
+                  Column('area_id', BigInteger, ForeignKey('area.area_id'), primary_key=True),
+                  Column('pack_area_id', BigInteger, nullable=False),
+                  )
+
 AREA_USER = Table('area_user',
                   MAGPHYS_METADATA,
                   Column('areauser_id', BigInteger, primary_key=True, autoincrement=True),
@@ -113,6 +119,18 @@ GALAXY_STATUS = Table('galaxy_status',
                       Column('description', String(250)),
                       )
 
+GALAXY_UPLOAD = Table('galaxy_upload',
+                      MAGPHYS_METADATA,
+                      Column('galaxy_upload_id', BigInteger, primary_key=True, autoincrement=True),
+                      Column('galaxy_id', BigInteger, ForeignKey('galaxy.galaxy_id'), nullable=False),
+                      Column('register_id', BigInteger, ForeignKey('register.register_id'), nullable=False),
+                      Column('pixel_count', BigInteger, nullable=False),
+                      Column('attempts', Integer, nullable=False),
+                      Column('claim_time', TIMESTAMP),
+                      Column('failed_time', TIMESTAMP),
+                      Column('create_time', TIMESTAMP, nullable=False),
+                      )
+
 GALAXY_USER = Table('galaxy_user',
                     MAGPHYS_METADATA,
                     Column('galaxy_user_id', BigInteger, primary_key=True, autoincrement=True),
@@ -121,6 +139,12 @@ GALAXY_USER = Table('galaxy_user',
                     Column('create_at', TIMESTAMP, nullable=False)
                     )
 
+ID_BLOCK = Table('id_block',
+                 MAGPHYS_METADATA,
+                 Column('table_name', String(100), primary_key=True),
+                 Column('next_id', BigInteger, nullable=False),
+                 )
+
 IMAGE_FILTERS_USED = Table('image_filters_used',
                            MAGPHYS_METADATA,
                            Column('image_filters_used_id', BigInteger, primary_key=True),
@@ -183,6 +207,34 @@ REGISTER = Table('register',
                  Column('run_id', BigInteger, ForeignKey('run.run_id'), nullable=False)
                  )
 
+REGISTER_CURSOR = Table('register_cursor',
+                        MAGPHYS_METADATA,
+                        Column('register_id', BigInteger, ForeignKey('register.register_id'), primary_key=True),
+                        Column('galaxy_id', BigInteger, ForeignKey('galaxy.galaxy_id'), nullable=False),
+                        Column('next_row', Integer, nullable=False),
+                        Column('min_pixels_per_file_itr', Integer, nullable=False),
+                        Column('next_area_id', BigInteger, nullable=False),
+                        Column('work_units_added', BigInteger, nullable=False),
+                        Column('pixel_count', BigInteger, nullable=False),
+                        Column('update_time', TIMESTAMP, nullable=False),
+                        )
+
+REGISTER_PREFLIGHT = Table('register_preflight',
+                           MAGPHYS_METADATA,
+                           Column('register_id', BigInteger, ForeignKey('register.register_id'), primary_key=True),
+                           Column('dimension_x', Integer, nullable=False),
+                           Column('dimension_y', Integer, nullable=False),
+                           Column('dimension_z', Integer, nullable=False),
+                           Column('layer_names', String(2000), nullable=False),
+                           Column('layer_order', String(1000), nullable=False),
+                           Column('valid_pixels', BigInteger, nullable=False),
+                           Column('row_counts', LargeBinary, nullable=False),
+                           Column('valid_mask', LargeBinary, nullable=False),
+                           Column('estimated_work_units', Integer, nullable=False),
+                           Column('estimated_fpops', Float, nullable=False),
+                           Column('create_time', TIMESTAMP, nullable=False),
+                           )
+
 RUN = Table('run',
             MAGPHYS_METADATA,
             Column('run_id', BigInteger, primary_key=True),
@@ -85,6 +85,17 @@ where galaxy_id = GALAXY_ID /*replace with galaxy id*/
 AND area.top_x = -2;
 
 
+--gets the uploads that have failed
+select galaxy_upload_id, galaxy_id, attempts, failed_time
+from galaxy_upload
+where failed_time is not null;
+
+--lets a failed upload be tried again by the next work generator pass
+update galaxy_upload
+set failed_time = null, attempts = 0
+where galaxy_upload_id = GALAXY_UPLOAD_ID; /*replace with galaxy upload id*/
+
+
 -- pogs
 -- Number active users
 select count(*)
@@ -24,9 +24,11 @@
 """
 Image generation
 """
+import os
 import pyfits
 import math
 import numpy
+import tempfile
 from PIL import Image
 from sqlalchemy.sql import select
 from sqlalchemy.sql.expression import and_
@@ -238,9 +240,14 @@ class ImageBuilder:
         :return:
         """
         LOG.info('Saving an image to {0}'.format(image_file_key))
-        file_name = '{0}/image.png'.format(POGS_TMP)
-        self._image.save(file_name)
-        s3_helper.add_file_to_bucket(self._bucket_name, image_file_key, file_name)
+        # Several galaxies can be saving images at the same time, so each image needs its own file
+        handle, file_name = tempfile.mkstemp(suffix='.png', dir=POGS_TMP)
+        os.close(handle)
+        try:
+            self._image.save(file_name)
+            s3_helper.add_file_to_bucket(self._bucket_name, image_file_key, file_name)
+        finally:
+            os.remove(file_name)
 
 
 class FitsImage:
@@ -24,7 +24,8 @@
 """
 Functions used to delete a galaxy
 """
-from database.database_support_core import PIXEL_RESULT, IMAGE_FILTERS_USED, AREA, FITS_HEADER, GALAXY
+from sqlalchemy.sql.expression import select
+from database.database_support_core import PIXEL_RESULT, IMAGE_FILTERS_USED, AREA, AREA_PACK, FITS_HEADER, GALAXY
 from utils.name_builder import get_galaxy_image_bucket, get_galaxy_file_name
 from utils.s3_helper import S3Helper
 from boto.s3.key import Key
@@ -33,6 +34,8 @@ from boto.s3.key import Key
 def remove_database_entries(connection, galaxy_id):
     connection.execute(PIXEL_RESULT.delete().where(PIXEL_RESULT.c.galaxy_id == galaxy_id))
     connection.execute(IMAGE_FILTERS_USED.delete().where(IMAGE_FILTERS_USED.c.galaxy_id == galaxy_id))
+    # Packed work units link the areas to the first area of the work unit
+    connection.execute(AREA_PACK.delete().where(AREA_PACK.c.area_id.in_(select([AREA.c.area_id]).where(AREA.c.galaxy_id == galaxy_id))))
     connection.execute(AREA.delete().where(AREA.c.galaxy_id == galaxy_id))
     connection.execute(FITS_HEADER.delete().where(FITS_HEADER.c.galaxy_id == galaxy_id))
     connection.execute(GALAXY.delete().where(GALAXY.c.galaxy_id == galaxy_id))
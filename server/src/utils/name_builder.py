@@ -179,6 +179,49 @@ def get_key_sed(galaxy_name, run_id, galaxy_id, area_id):
     return '{0}/{1}.sed'.format(get_galaxy_file_name(galaxy_name, run_id, galaxy_id), area_id)
 
 
+def get_work_unit_name(galaxy_name, area_id):
+    """
+    Get the name of the work unit for an area
+
+    :param galaxy_name:
+    :param area_id:
+    :return: the work unit name
+    """
+    return '%(galaxy)s_area%(area)s' % {'galaxy': galaxy_name, 'area': area_id}
+
+
+def get_packed_work_unit_name(galaxy_name, area_id):
+    """
+    Get the name of a work unit holding the areas of several galaxies
+
+    :param galaxy_name: the galaxy of the first area
+    :param area_id: the first area
+    :return: the work unit name
+    """
+    return '%(galaxy)s_pack%(area)s' % {'galaxy': galaxy_name, 'area': area_id}
+
+
+def parse_work_unit_name(wu_name):
+    """
+    Get the area from the name of a work unit - see get_work_unit_name and get_packed_work_unit_name
+
+    >>> parse_work_unit_name('NGC1209_area719')
+    (719, False)
+    >>> parse_work_unit_name('UGC_1209_pack719')
+    (719, True)
+    >>> parse_work_unit_name('NGC1209__wu719') is None
+    True
+
+    :param wu_name: the name of the work unit
+    :return: the area id and True if it is the first area of a packed work unit, or None if the name is not one of ours
+    """
+    index = max(wu_name.rfind('_area'), wu_name.rfind('_pack'))
+    if index == -1 or not wu_name[index + 5:].isdigit():
+        return None
+
+    return int(wu_name[index + 5:]), wu_name[index + 1:index + 5] == 'pack'
+
+
 def get_colour_image_key(galaxy_key_prefix, colour):
     """
     Generates the key to the file given by the colour id
@@ -24,9 +24,13 @@
 """
 A helper for putting files into S3 and getting them out again
 """
+import os
+import Queue
 import ssl
+import threading
 import boto
 from boto.s3.key import Key
+from boto.s3.multipart import MultiPartUpload
 from utils.logging_helper import config_logger
 from config import S3_FILE_RESTORE_TIME
 
@@ -45,15 +49,20 @@ class S3Helper:
         :return:
         """
         self.s3_connection = boto.connect_s3()
+        self._buckets = {}
 
     def get_bucket(self, bucket_name):
         """
-        Get a S3 bucket
+        Get a S3 bucket - it is remembered, so a helper that is kept only looks for it once
 
         :param bucket_name:
         :return:
         """
-        return self.s3_connection.get_bucket(bucket_name)
+        bucket = self._buckets.get(bucket_name)
+        if bucket is None:
+            bucket = self.s3_connection.get_bucket(bucket_name)
+            self._buckets[bucket_name] = bucket
+        return bucket
 
     def add_file_to_bucket(self, bucket_name, key_name, filename, reduced_redundancy=False):
         """
@@ -69,6 +78,51 @@ class S3Helper:
         key.key = key_name
         key.set_contents_from_filename(filename, reduced_redundancy=reduced_redundancy)
 
+    def add_file_to_bucket_multipart(self, bucket_name, key_name, filename, part_size, threads, reduced_redundancy=False):
+        """
+        Add file to a bucket. A file bigger than part_size is sent as a multipart upload with
+        several parts going up at the same time.
+
+        :param bucket_name:
+        :param key_name:
+        :param filename:
+        :param part_size: the size of each part in bytes - S3 needs at least 5MB
+        :param threads: the number of parts to send at the same time
+        :param reduced_redundancy:
+        """
+        file_size = os.path.getsize(filename)
+        if file_size <= part_size:
+            self.add_file_to_bucket(bucket_name, key_name, filename, reduced_redundancy)
+            return
+
+        bucket = self.get_bucket(bucket_name)
+        multipart = bucket.initiate_multipart_upload(key_name, reduced_redundancy=reduced_redundancy)
+
+        parts = Queue.Queue()
+        for part_number, offset in enumerate(range(0, file_size, part_size), 1):
+            parts.put((part_number, offset, min(part_size, file_size - offset)))
+
+        part_count = parts.qsize()
+        errors = []
+        sent = []
+        uploaders = []
+        for _ in range(max(min(threads, part_count), 1)):
+            uploader = threading.Thread(target=_upload_parts, args=(bucket_name, key_name, multipart.id, filename, parts, errors, sent))
+            uploader.start()
+            uploaders.append(uploader)
+        for uploader in uploaders:
+            uploader.join()
+
+        if len(errors) > 0:
+            multipart.cancel_upload()
+            raise errors[0]
+        if len(sent) != part_count:
+            multipart.cancel_upload()
+            raise IOError('Only {0} of the {1} parts of {2} were sent'.format(len(sent), part_count, key_name))
+
+        LOG.info('Uploaded {0} in {1} parts'.format(key_name, part_count))
+        multipart.complete_upload()
+
     def get_file_from_bucket(self, bucket_name, key_name, file_name):
         """
         Get a file from S3 into a local file
@@ -177,3 +231,30 @@ class S3Helper:
                 counted += 1
 
         return bucket_size
+
+
+def _upload_parts(bucket_name, key_name, upload_id, filename, parts, errors, sent):
+    """
+    Send parts of a multipart upload until there are none left. A boto connection can't be shared
+    between threads, so each thread has its own.
+    """
+    # noinspection PyBroadException
+    try:
+        multipart = MultiPartUpload(boto.connect_s3().get_bucket(bucket_name))
+        multipart.key_name = key_name
+        multipart.id = upload_id
+
+        with open(filename, 'rb') as part_file:
+            while len(errors) == 0:
+                try:
+                    part_number, offset, size = parts.get_nowait()
+                except Queue.Empty:
+                    break
+
+                part_file.seek(offset)
+                multipart.upload_part_from_file(part_file, part_number, size=size)
+                sent.append(part_number)
+    except Exception as e:
+        # Recorded so the upload is cancelled rather than completed with parts missing
+        LOG.exception('Error sending the parts of {0}'.format(key_name))
+        errors.append(e)
@@ -23,42 +23,60 @@
 #    MA 02111-1307  USA
 #
 """
-Check the characteristics of the fits file
+Check the characteristics of the fits files from their headers and print a JSON summary
 """
-import argparse
-import glob
-import sys
 import os
-import pyfits
+import sys
+
+base_path = os.path.dirname(__file__)
+sys.path.append(os.path.abspath(os.path.join(base_path, '..')))
+
+import argparse
+import json
+import multiprocessing
 from utils.logging_helper import config_logger
+from work_generation.fits_checker import check_fits_files, expand_file_names
 
 LOG = config_logger(__name__)
 LOG.info('PYTHONPATH = {0}'.format(sys.path))
 
 parser = argparse.ArgumentParser()
 parser.add_argument('file_names', nargs='+', help='the files to be checked')
+parser.add_argument('-w', '--workers', type=int, default=multiprocessing.cpu_count(), help='the number of processes checking the files')
+parser.add_argument('-r', '--run_id', type=int, help='check the filters against the ones used by this run')
+parser.add_argument('--headers', action='store_true', help='include every card of every layer in the summary')
+parser.add_argument('-o', '--output', help='write the summary to this file rather than stdout')
 args = vars(parser.parse_args())
 
-for file_name_stub in args['file_names']:
-    for file_name in glob.glob(file_name_stub):
-        if os.path.isfile(file_name):
-            LOG.info('Check %s', file_name)
+filter_names = None
+if args['run_id'] is not None:
+    from sqlalchemy.engine import create_engine
+    from config import DB_LOGIN
+    from work_generation.register_manifest_mod import get_filter_names
+
+    connection = create_engine(DB_LOGIN).connect()
+    filter_names = get_filter_names(connection, [args['run_id']])[args['run_id']]
+    connection.close()
+
+file_names, not_found = expand_file_names(args['file_names'])
+for file_name_stub in not_found:
+    LOG.info('The file %s does not exist', file_name_stub)
 
-            hdu_list = pyfits.open(file_name, memmap=True)
-            layer_count = len(hdu_list)
+summaries = check_fits_files(file_names, max(args['workers'], 1), filter_names, include_headers=args['headers'])
+for summary in summaries:
+    LOG.info('%s: %d layers, dimensions %s, %d errors', summary['file_name'], summary['layers'], summary['dimensions'], len(summary['errors']))
 
-            end_y = hdu_list[0].data.shape[0]
-            end_x = hdu_list[0].data.shape[1]
+files_with_errors = len([summary for summary in summaries if len(summary['errors']) > 0])
+result = {'files_checked': len(summaries),
+          'files_with_errors': files_with_errors,
+          'not_found': not_found,
+          'files': summaries}
 
-            LOG.info("Image dimensions: %(x)d x %(y)d x %(z)d => %(pix).2f Mpixels" % {'x': end_x, 'y': end_y, 'z': layer_count, 'pix': end_x * end_y/1000000.0})
+if args['output'] is not None:
+    with open(args['output'], 'w') as output:
+        json.dump(result, output, indent=2)
+else:
+    json.dump(result, sys.stdout, indent=2)
+    sys.stdout.write('\n')
 
-            # Read the fits headers
-            for layer in range(layer_count):
-                header = hdu_list[layer].header
-                for keyword in header:
-                    if header.comments[keyword] is None:
-                        LOG.info('** Layer %d - %s: %s', layer, keyword, header[keyword])
-                    else:
-                        LOG.info('** Layer %d - %s: %s: %s', layer, keyword, header[keyword], header.comments[keyword])
-        else:
-            LOG.info('The file %s does not exist', file_name)
+sys.exit(1 if files_with_errors > 0 or len(not_found) > 0 else 0)
@@ -0,0 +1,286 @@
+#
+#    Copyright (c) UWA, The University of Western Australia
+#    M468/35 Stirling Hwy
+#    Perth WA 6009
+#    Australia
+#
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Write the work unit files into BOINC's download hierarchy.
+
+The fanout directories that exist are remembered, the job.xml files are hardlinked to one copy per
+pixel count and the observation rows are formatted a column at a time from the pixel arrays.
+The writer can be shared by the writer threads of the pipeline.
+
+If the input files are gzipped, a .gz copy is written next to each file. BOINC sends it to the
+clients instead of the file when the input template has <gzip/> in the file_info.
+"""
+import errno
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from utils.logging_helper import config_logger
+from work_generation.pixel_cube import PixelBlock
+
+LOG = config_logger(__name__)
+
+# The job.xml files are kept in here, below the download directory so they can be hardlinked
+JOB_XML_STORE = 'job_xml'
+
+# The rows of numbers compress nearly as well at this level as at 9, in much less time
+GZIP_LEVEL = 6
+
+_WRITERS = {}
+_WRITERS_LOCK = threading.Lock()
+
+
+def get_fanout_writer(download_dir, fanout, gzip_inputs=False):
+    """
+    Get the writer for the download directory - it is kept so the directories seen by earlier galaxies are remembered
+
+    :param download_dir: the BOINC download directory
+    :param fanout: the BOINC fanout
+    :param gzip_inputs: write a gzipped copy of each file as well
+    :return: the FanoutWriter
+    """
+    with _WRITERS_LOCK:
+        writer = _WRITERS.get((download_dir, fanout, gzip_inputs))
+        if writer is None:
+            writer = FanoutWriter(download_dir, fanout, gzip_inputs)
+            _WRITERS[(download_dir, fanout, gzip_inputs)] = writer
+        return writer
+
+
+def build_job_xml(pixels_in_file):
+    """
+    Build the contents of the job.xml file - it only depends on the number of pixels
+
+    :param pixels_in_file: the number of pixels
+    :return: the contents of the file
+    """
+    lines = ['<job_desc>\n']
+    for i in range(1, pixels_in_file + 1):
+        lines.append('''   <task>
+      <application>./fit_sed</application>
+      <command_line>{0} filters.dat observations.dat</command_line>
+      <stdout_filename>stdout_file</stdout_filename>
+      <stderr_filename>stderr_file</stderr_filename>
+   </task>
+'''.format(i))
+
+    lines.append('''   <task>
+      <application>./concat</application>
+      <command_line>{0} output.fit</command_line>
+      <stdout_filename>stdout_file</stdout_filename>
+      <stderr_filename>stderr_file</stderr_filename>
+   </task>
+'''.format(pixels_in_file))
+
+    lines.append('</job_desc>\n')
+    return ''.join(lines)
+
+
+def format_observation_rows(pixels, redshift):
+    """
+    Format the rows of the observation file
+
+    :param pixels: a PixelBlock or a list of Pixels
+    :param redshift: the redshift of the galaxy
+    :return: a list of the rows
+    """
+    if not isinstance(pixels, PixelBlock):
+        rows = []
+        for pixel in pixels:
+            row = ['pix%(id)s %(pixel_redshift)s ' % {'id': pixel.pixel_id, 'pixel_redshift': redshift}]
+            for pixel_value in pixel.pixels:  # Should be placed here in same order as LayerOrder
+                if pixel_value.value is None or pixel_value.value <= 0:
+                    row.append("{0}  {1}  ".format(-1, -1))
+                else:
+                    row.append("{0}  {1}  ".format(pixel_value.value, pixel_value.sigma))
+            row.append('\n')
+            rows.append(''.join(row))
+        return rows
+
+    # Work down each column of the block. tolist() gives python numbers, which print the same as the numpy scalars did.
+    pixel_count = len(pixels)
+    rows = ['pix%(id)s %(pixel_redshift)s ' % {'id': pixel_id, 'pixel_redshift': redshift} for pixel_id in pixels.pixel_ids]
+    for values, sigmas in zip(pixels.values, pixels.sigmas):
+        if values is None:
+            column = ['-1  -1  '] * pixel_count
+        else:
+            column = ['%s  %s  ' % (value, sigma) if value > 0 else '-1  -1  ' for value, sigma in zip(values.tolist(), sigmas.tolist())]
+        rows = [row + cell for row, cell in zip(rows, column)]
+
+    return [row + '\n' for row in rows]
+
+
+class FanoutWriter:
+    """
+    Writes files into the fanout directories below the BOINC download directory
+    """
+    def __init__(self, download_dir, fanout, gzip_inputs=False):
+        """
+        Initialise the writer
+
+        :param download_dir: the BOINC download directory
+        :param fanout: the BOINC fanout
+        :param gzip_inputs: write a gzipped copy of each file as well
+        """
+        self._download_dir = download_dir
+        self._fanout = fanout
+        self._gzip_inputs = gzip_inputs
+        self._store_dir = os.path.join(download_dir, JOB_XML_STORE)
+        self._directories = set()
+        self._job_xml_stored = set()
+        self._can_link = True
+        self._lock = threading.Lock()
+
+    def path(self, file_name):
+        """
+        Calculate the fanout path and create the directory
+
+        :param file_name: the name of the file
+        :return: the full path of the file
+        """
+        s = hashlib.md5(file_name).hexdigest()[:8]
+        x = long(s, 16)
+
+        hash_dir_name = "%s/%x" % (self._download_dir, x % self._fanout)
+        if hash_dir_name not in self._directories:
+            self._make_directory(hash_dir_name)
+            self._directories.add(hash_dir_name)
+
+        return "%s/%x/%s" % (self._download_dir, x % self._fanout, file_name)
+
+    def write_job_xml(self, file_name, pixels_in_file):
+        """
+        Create the job.xml file as a hardlink to the copy for this number of pixels
+
+        :param file_name: the name of the file
+        :param pixels_in_file: the number of pixels
+        """
+        new_full_path = self.path(file_name)
+
+        if self._can_link:
+            stored_file = self._get_stored_job_xml(pixels_in_file)
+            try:
+                self._link(stored_file, new_full_path)
+                if self._gzip_inputs:
+                    self._link(stored_file + '.gz', new_full_path + '.gz')
+                return
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+                LOG.warning('Unable to hardlink the job.xml files, they will be written in full: {0}'.format(e))
+                self._can_link = False
+
+        self._write_file(new_full_path, build_job_xml(pixels_in_file))
+
+    def write_observation_file(self, file_name, data, pixels, redshift):
+        """
+        Create an observation file for the pixels
+
+        :param file_name: the name of the file
+        :param data: the details of the area for the header line
+        :param pixels: a PixelBlock or a list of Pixels
+        :param redshift: the redshift of the galaxy
+        """
+        self.write_observation_file_parts(file_name, data, [(pixels, redshift)])
+
+    def write_observation_file_parts(self, file_name, data, parts):
+        """
+        Create an observation file holding the pixels of one or more areas
+
+        :param file_name: the name of the file
+        :param data: the details of each area for the header line
+        :param parts: a list of (pixels, redshift) - one for each area
+        """
+        rows = ['#  {0}\n'.format(json.dumps(data))]
+        for pixels, redshift in parts:
+            rows.extend(format_observation_rows(pixels, redshift))
+        self._write_file(self.path(file_name), ''.join(rows))
+
+    def _write_file(self, new_full_path, contents):
+        """
+        Write the file and, if the inputs are gzipped, its .gz copy
+        """
+        outfile = open(new_full_path, 'wb')
+        outfile.write(contents)
+        outfile.close()
+
+        if self._gzip_inputs:
+            gzip_file = gzip.open(new_full_path + '.gz', 'wb', GZIP_LEVEL)
+            gzip_file.write(contents)
+            gzip_file.close()
+
+    def _get_stored_job_xml(self, pixels_in_file):
+        stored_file = os.path.join(self._store_dir, 'job_{0}.xml'.format(pixels_in_file))
+        if pixels_in_file in self._job_xml_stored:
+            return stored_file
+
+        with self._lock:
+            if pixels_in_file not in self._job_xml_stored:
+                if not os.path.isfile(stored_file):
+                    self._make_directory(self._store_dir)
+
+                    # Write it somewhere else first so another work generator never links to half a file
+                    handle, temp_file = tempfile.mkstemp(dir=self._store_dir)
+                    os.write(handle, build_job_xml(pixels_in_file))
+                    os.close(handle)
+                    os.chmod(temp_file, 0644)
+                    os.rename(temp_file, stored_file)
+
+                if self._gzip_inputs and not os.path.isfile(stored_file + '.gz'):
+                    handle, temp_file = tempfile.mkstemp(dir=self._store_dir)
+                    os.close(handle)
+                    gzip_file = gzip.open(temp_file, 'wb', GZIP_LEVEL)
+                    gzip_file.write(build_job_xml(pixels_in_file))
+                    gzip_file.close()
+                    os.chmod(temp_file, 0644)
+                    os.rename(temp_file, stored_file + '.gz')
+
+                self._job_xml_stored.add(pixels_in_file)
+
+        return stored_file
+
+    @staticmethod
+    def _link(source, target):
+        try:
+            os.link(source, target)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+            # Left by an earlier run that failed
+            os.remove(target)
+            os.link(source, target)
+
+    @staticmethod
+    def _make_directory(directory):
+        if os.path.exists(directory):
+            return
+        try:
+            os.mkdir(directory)
+        except OSError:
+            # Another writer may have just created it
+            if not os.path.isdir(directory):
+                raise
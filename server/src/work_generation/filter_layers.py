@@ -0,0 +1,208 @@
+#
+#    Copyright (c) UWA, The University of Western Australia
+#    M468/35 Stirling Hwy
+#    Perth WA 6009
+#    Australia
+#
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Match the layers of a FITS file to the filters used by a run
+"""
+from sqlalchemy.sql.expression import select
+from database.database_support_core import FILTER, RUN_FILTER
+from utils.logging_helper import config_logger
+
+LOG = config_logger(__name__)
+
+
+def get_run_filters(connection, run_id):
+    """
+    Get the filters used by the run in the order MAGPHYS expects them
+
+    :param connection: the database connection
+    :param run_id: the run
+    :return: a list of FILTER rows
+    """
+    list_filter_names = []
+    for filter_name in connection.execute(select([FILTER], distinct=True, from_obj=FILTER.join(RUN_FILTER)).where(RUN_FILTER.c.run_id == run_id).order_by(FILTER.c.eff_lambda)):
+        list_filter_names.append(filter_name)
+
+    return list_filter_names
+
+
+def get_layer_names(hdu_list, list_filter_names, description='fits file'):
+    """
+    Get the MAGPHYSN name of each layer, checking the run uses the filter
+
+    :param hdu_list: the FITS file
+    :param list_filter_names: the filters from get_run_filters
+    :param description: what the file is for the error messages
+    :return: a list of the names in the order of the layers in the file
+    """
+    names = []
+    for layer in range(len(hdu_list)):
+        hdu = hdu_list[layer]
+        filter_name_magphysn = hdu.header['MAGPHYSN']
+        if filter_name_magphysn is None:
+            raise LookupError('The layer {0} does not have MAGPHYSN in it'.format(layer))
+        names.append(filter_name_magphysn)
+
+        found_filter = False
+        for filter_name in list_filter_names:
+            if filter_name_magphysn == filter_name[FILTER.c.name]:
+                found_filter = True
+                break
+
+        if not found_filter:
+            raise LookupError('The filter {0} in the {1} is not expected'.format(filter_name_magphysn, description))
+
+    return names
+
+
+def sort_layers(list_filter_names, names, names_snr=None):
+    """
+    Work out which layer in the file holds each of the run's filters
+
+    :param list_filter_names: the filters from get_run_filters
+    :param names: the layer names of the FITS file
+    :param names_snr: the layer names of the S/N ratio file or None
+    :return: the layer order, the sigma layer order and the maps of the ultraviolet, optical and infrared
+        filter names to their position in the layer order. The layer order is -1 for a missing filter.
+    """
+    ultraviolet_bands = {}
+    optical_bands = {}
+    infrared_bands = {}
+    layers = []
+    sigma_layers = []
+    for j in range(len(list_filter_names)):
+        filter_name = list_filter_names[j]
+        found_it = False
+        for i in range(len(names)):
+            if names[i] == filter_name[FILTER.c.name]:
+                layers.append(i)
+                if filter_name[FILTER.c.infrared] == 1:
+                    infrared_bands[filter_name[FILTER.c.name]] = j
+
+                if filter_name[FILTER.c.optical] == 1:
+                    optical_bands[filter_name[FILTER.c.name]] = j
+
+                if filter_name[FILTER.c.ultraviolet] == 1:
+                    ultraviolet_bands[filter_name[FILTER.c.name]] = j
+                found_it = True
+                break
+
+        if not found_it:
+            layers.append(-1)
+
+        """
+        Search the sigma hdu for the current filter name.
+        If it does exist, then add add its id to the sigma_layer_order
+        If it does not exist, then add -1.
+        sigma_layer_order will be in the same order as layer_order, meaning if a value exists for layer_order, there will be one for sigma_layer_order
+        and both of these layers will be for the same filter. only if a sigma file exists.
+
+        """
+        if names_snr is not None:
+            found_it = False
+            for i in range(len(names_snr)):
+                if names_snr[i] == filter_name[FILTER.c.name]:
+                    sigma_layers.append(i)
+                    found_it = True
+                    break
+            if not found_it:
+                sigma_layers.append(-1)
+
+    return layers, sigma_layers, ultraviolet_bands, optical_bands, infrared_bands
+
+
+def get_band_scaling(list_filter_names, ultraviolet_bands, optical_bands, infrared_bands):
+    """
+    Work out how much the credit and fpops_est are scaled up by for the bands in the model and the file.
+    Originally 5 layers.
+
+    :param list_filter_names: the filters from get_run_filters
+    :param ultraviolet_bands: the ultraviolet bands found in the file by sort_layers
+    :param optical_bands: the optical bands found in the file by sort_layers
+    :param infrared_bands: the infrared bands found in the file by sort_layers
+    :return: the cobblestone scaling and the fpops_est scaling
+    """
+    # Count the number of filters of each type in the model
+    num_optical_bands_model = 0
+    num_infrared_bands_model = 0
+    num_ultraviolet_bands_model = 0
+    for filter_entry in list_filter_names:
+        if filter_entry[FILTER.c.optical] == 1:
+            num_optical_bands_model += 1
+
+        if filter_entry[FILTER.c.infrared] == 1:
+            num_infrared_bands_model += 1
+
+        if filter_entry[FILTER.c.ultraviolet] == 1:
+            num_ultraviolet_bands_model += 1
+
+    uv_model = 0
+    ir_model = 0
+    optic_model = 0
+
+    if num_ultraviolet_bands_model > 0:
+        uv_model = num_ultraviolet_bands_model * 0.01
+        LOG.info('+ {0} for {1} UV bands in model'.format(uv_model, num_ultraviolet_bands_model))
+    else:
+        LOG.info('No ultraviolet bands in model for credit scaling')
+
+    if num_infrared_bands_model > 0:
+        ir_model = num_infrared_bands_model * 0.012
+        LOG.info('+ {0} for {1} IR bands in model'.format(ir_model, num_infrared_bands_model))
+    else:
+        LOG.info('No infrared bands in model for credit scaling')
+
+    if num_optical_bands_model > 0:
+        optic_model = num_optical_bands_model * 0.01
+        LOG.info('+ {0} for {1} optical bands in model'.format(optic_model, num_optical_bands_model))
+    else:
+        LOG.info('No optical bands in model for credit scaling')
+
+    uv = 0
+    ir = 0
+    optic = 0
+
+    if len(ultraviolet_bands) > 0:
+        uv = len(ultraviolet_bands) * 0.015
+        LOG.info('+ {0} for {1} UV bands in file'.format(uv, len(ultraviolet_bands)))
+    else:
+        LOG.info('No ultraviolet bands in file for credit scaling')
+
+    if len(infrared_bands) > 0:
+        ir = len(infrared_bands) * 0.02
+        LOG.info('+ {0} for {1} IR bands in file'.format(ir, len(infrared_bands)))
+    else:
+        LOG.info('No infrared bands in file for credit scaling')
+
+    if len(optical_bands) > 0:
+        optic = len(optical_bands) * 0.015
+        LOG.info('+ {0} for {1} optical bands in file'.format(optic, len(optical_bands)))
+    else:
+        LOG.info('No optical bands in file for credit scaling')
+
+    sum_scales = uv + ir + optic + uv_model + ir_model + optic_model
+    total_scaling_cobblestone = 1.0 + sum_scales
+    total_scaling_fpops_est = 1.0 + (sum_scales * 0.3)
+
+    LOG.info('Total scaling cobblestone: {0} fpops_est: {1}'.format(total_scaling_cobblestone, total_scaling_fpops_est))
+    return total_scaling_cobblestone, total_scaling_fpops_est
@@ -0,0 +1,368 @@
+#
+#    Copyright (c) UWA, The University of Western Australia
+#    M468/35 Stirling Hwy
+#    Perth WA 6009
+#    Australia
+#
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Benchmark the work generator without MySQL or a BOINC project.
+
+A synthetic FITS cube is registered in a SQLite database built from create_database_sqlite.sql,
+py_boinc is replaced by a fake that records the work units created and the files are written to a
+temporary download directory. The work generation settings still come from pogs.settings.
+"""
+from __future__ import print_function
+import os
+import sys
+
+# Setup the Python Path as we may be running this via ssh
+base_path = os.path.dirname(__file__)
+sys.path.append(os.path.abspath(os.path.join(base_path, '..')))
+sys.path.append(os.path.abspath(os.path.join(base_path, '../../../../boinc/py')))
+
+import argparse
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import types
+import numpy
+import pyfits
+from datetime import datetime
+
+
+class FakeBoinc:
+    """
+    Stands in for py_boinc and records the work units that would have been created
+    """
+    def __init__(self):
+        self.work_units = []
+        self.input_files = []
+        self.transactions = 0
+
+    def boinc_db_open(self):
+        return 0
+
+    def boinc_db_close(self):
+        return 0
+
+    def boinc_db_transaction_start(self):
+        return 0
+
+    def boinc_db_transaction_commit(self):
+        self.transactions += 1
+        return 0
+
+    def boinc_db_transaction_rollback(self):
+        return 0
+
+    def boinc_create_work(self, **kwargs):
+        self.work_units.append(kwargs['wu_name'])
+        self.input_files.append(kwargs['list_input_files'])
+        return 0
+
+    def install(self):
+        """
+        Put the fake in place of py_boinc - this must be done before the work generator is imported
+        """
+        module = types.ModuleType('py_boinc')
+        for name in ['boinc_db_open', 'boinc_db_close', 'boinc_db_transaction_start', 'boinc_db_transaction_commit',
+                     'boinc_db_transaction_rollback', 'boinc_create_work']:
+            setattr(module, name, getattr(self, name))
+        sys.modules['py_boinc'] = module
+
+
+FAKE_BOINC = FakeBoinc()
+FAKE_BOINC.install()
+
+# The stop trigger is looked for in the BOINC project, so point it somewhere harmless if there isn't one
+try:
+    from Boinc import boinc_project_path
+except ImportError:
+    boinc_module = types.ModuleType('Boinc')
+    boinc_module.boinc_project_path = types.ModuleType('Boinc.boinc_project_path')
+    boinc_module.boinc_project_path.project_path = lambda name: os.path.join(tempfile.gettempdir(), 'fits2wu_benchmark_' + name)
+    sys.modules['Boinc'] = boinc_module
+    sys.modules['Boinc.boinc_project_path'] = boinc_module.boinc_project_path
+
+from sqlalchemy.engine import create_engine
+from utils.logging_helper import config_logger
+from database.database_support_core import REGISTER
+from work_generation.fanout_writer import get_fanout_writer
+from work_generation.fits2wu_mod_mkii import Fit2Wu, TARGET_NRESULTS
+from work_generation.model_index import ModelIndex
+
+LOG = config_logger(__name__)
+
+# The layers of the synthetic cube - the first four are optical so every band count has some valid pixels
+FILTER_NAMES = ['SDSSu', 'SDSSg', 'SDSSr', 'SDSSi', 'SDSSz', 'GALEXFUV', 'GALEXNUV', 'WISEW1', 'WISEW2', 'WISEW3', 'WISEW4']
+RUN_ID = 1
+REDSHIFT = 0.01
+
+
+class StageTimer:
+    """
+    The time spent in each stage - the stages may be run by several threads at once
+    """
+    def __init__(self):
+        self._times = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self._times[stage] = self._times.get(stage, 0.0) + seconds
+
+    def get(self, stage):
+        return self._times.get(stage, 0.0)
+
+    def time(self, stage, function, *args):
+        """
+        Call the function, adding the time taken to the stage
+
+        :param stage: the name of the stage
+        :param function: the function to call
+        :return: whatever the function returns
+        """
+        start = time.time()
+        try:
+            return function(*args)
+        finally:
+            self.add(stage, time.time() - start)
+
+
+class BenchmarkFit2Wu(Fit2Wu):
+    """
+    A Fit2Wu that times its stages and skips the parts that need the BOINC project or S3
+    """
+    def __init__(self, connection, download_dir, fanout, pipeline, gzip_inputs, timer, work_dir):
+        self._timer = timer
+        self._work_dir = work_dir
+        Fit2Wu.__init__(self, connection, download_dir, fanout, pipeline=pipeline, gzip_inputs=gzip_inputs)
+
+    def _break_up_galaxy(self, max_work_units=None):
+        cube_get_row_band = self._pixel_cube.get_row_band
+        self._pixel_cube.get_row_band = lambda pix_y, row_height: self._timer.time('read the cube', cube_get_row_band, pix_y, row_height)
+        self._timer.time('break up the galaxy', Fit2Wu._break_up_galaxy, self, max_work_units)
+
+    def _write_area_files(self, job):
+        self._timer.time('write the files', Fit2Wu._write_area_files, self, job)
+
+    def _run_pending_db_tasks(self):
+        self._timer.time('database', Fit2Wu._run_pending_db_tasks, self)
+
+    def _run_pending_boinc_db_tasks(self):
+        self._timer.time('BOINC database', Fit2Wu._run_pending_boinc_db_tasks, self)
+
+    def _get_rounded_redshift(self):
+        # There are no run directories, so use the models the runs usually have
+        return ModelIndex(['{0:.4f}'.format(i / 100.0) for i in range(13)]).lookup(self._redshift)
+
+    def _build_template_file(self, check_files=True):
+        self._template_file = os.path.join(self._work_dir, 'fitsed_wu_{0}.xml'.format(self._rounded_redshift))
+        open(self._template_file, 'w').close()
+
+    def _copy_important_files(self, check_files=True):
+        self._filter_file = '{0:=04d}_filters.dat'.format(self._run_id)
+        self._sfh_model_file = '{0:=04d}_starformhist_cb07_z{1}.lbr'.format(self._run_id, self._rounded_redshift)
+        self._ir_model_file = '{0:=04d}_infrared_dce08_z{1}.lbr'.format(self._run_id, self._rounded_redshift)
+        self._zlib_file = '{0:=04d}zlib_{1}.dat'.format(self._run_id, self._rounded_redshift)
+        for file_name in [self._filter_file, self._sfh_model_file, self._ir_model_file, self._zlib_file]:
+            open(self._writer.path(file_name), 'w').close()
+
+    def _build_images(self):
+        pass
+
+    def _add_files_to_bucket(self, registration):
+        pass
+
+
+def make_fits_cube(filename, width, height, filter_names, nan_fraction, signal_noise=False):
+    """
+    Write a FITS file with one layer per filter
+
+    :param filename: the file to write
+    :param width: the width of the image
+    :param height: the height of the image
+    :param filter_names: the MAGPHYSN of each layer
+    :param nan_fraction: the fraction of each layer set to NaN
+    :param signal_noise: write a S/N ratio file rather than the fluxes
+    """
+    hdu_list = pyfits.HDUList()
+    for filter_name in filter_names:
+        if signal_noise:
+            data = numpy.random.uniform(1.0, 50.0, (height, width)).astype(numpy.float32)
+        else:
+            data = numpy.random.lognormal(0.0, 1.0, (height, width)).astype(numpy.float32)
+            data[numpy.random.random_sample((height, width)) < nan_fraction] = numpy.nan
+
+        if len(hdu_list) == 0:
+            hdu = pyfits.PrimaryHDU(data)
+        else:
+            hdu = pyfits.ImageHDU(data)
+        hdu.header['MAGPHYSN'] = filter_name
+        hdu_list.append(hdu)
+
+    hdu_list.writeto(filename)
+
+
+def create_database(filename, filter_names):
+    """
+    Create the SQLite database with a run using the filters
+
+    :param filename: the database file
+    :param filter_names: the filters used by the run
+    """
+    schema = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'database', 'create_database_sqlite.sql')
+    connection = sqlite3.connect(filename)
+    connection.executescript(open(schema).read())
+    connection.execute("INSERT INTO run VALUES (?, 'Benchmark', 'Benchmark', 'benchmark', 6.0, 8.85)", (RUN_ID,))
+    for filter_name in filter_names:
+        connection.execute('INSERT INTO run_filter (run_id, filter_id) SELECT ?, filter_id FROM filter WHERE name = ?', (RUN_ID, filter_name))
+    connection.commit()
+    connection.close()
+
+
+def get_download_bytes(download_dir, fanout):
+    """
+    Add up the sizes of the files that are sent with every result - the model files are sticky so they are only sent once
+
+    :param download_dir: the download directory
+    :param fanout: the fanout of the download directory
+    :return: the bytes in the files and in their gzipped copies (0 if there are none)
+    """
+    writer = get_fanout_writer(download_dir, fanout)
+    plain_bytes = 0
+    gzip_bytes = 0
+    for input_files in FAKE_BOINC.input_files:
+        # The observation file and the job.xml file
+        for file_name in input_files[:2]:
+            path = writer.path(file_name)
+            plain_bytes += os.path.getsize(path)
+            if os.path.isfile(path + '.gz'):
+                gzip_bytes += os.path.getsize(path + '.gz')
+
+    return plain_bytes, gzip_bytes
+
+
+def run_benchmark(work_dir, width, height, bands, nan_fraction, snr, fanout, pipeline, gzip_inputs):
+    """
+    Generate the work units for a synthetic galaxy and report how long it took
+
+    :param work_dir: the directory to put everything in
+    :param width: the width of the image
+    :param height: the height of the image
+    :param bands: the number of layers
+    :param nan_fraction: the fraction of each layer set to NaN
+    :param snr: use a S/N ratio file rather than a sigma
+    :param fanout: the fanout of the download directory
+    :param pipeline: use the writer and committer threads
+    :param gzip_inputs: write the gzipped copies of the observation and job.xml files
+    :return: the StageTimer
+    """
+    filter_names = FILTER_NAMES[:bands]
+    download_dir = os.path.join(work_dir, 'download')
+    os.mkdir(download_dir)
+
+    LOG.info('Building a {0} x {1} x {2} cube'.format(width, height, bands))
+    filename = os.path.join(work_dir, 'benchmark.fits')
+    make_fits_cube(filename, width, height, filter_names, nan_fraction)
+    sigma_filename = None
+    if snr:
+        sigma_filename = os.path.join(work_dir, 'benchmark_snr.fits')
+        make_fits_cube(sigma_filename, width, height, filter_names, nan_fraction, signal_noise=True)
+
+    database = os.path.join(work_dir, 'pogs.db')
+    create_database(database, filter_names)
+
+    # The committer thread uses the connection when the pipeline is on
+    engine = create_engine('sqlite:///' + database, connect_args={'check_same_thread': False})
+    connection = engine.connect()
+    connection.execute(REGISTER.insert().values(galaxy_name='benchmark',
+                                                redshift=REDSHIFT,
+                                                galaxy_type='S',
+                                                sigma=0.1,
+                                                filename=filename,
+                                                sigma_filename=sigma_filename,
+                                                priority=0,
+                                                register_time=datetime.now(),
+                                                run_id=RUN_ID))
+    registration = connection.execute(REGISTER.select()).first()
+
+    timer = StageTimer()
+    fit2wu = BenchmarkFit2Wu(connection, download_dir, fanout, pipeline, gzip_inputs, timer, work_dir)
+    start = time.time()
+    result = fit2wu.process_file(registration)
+    elapsed = time.time() - start
+    connection.close()
+
+    (work_units_added, pixel_count, db_time, ave, boinc_db_time, bave, areas, pixels, complete) = result
+    break_up = timer.get('break up the galaxy')
+    print('Cube:                {0} x {1} x {2}, {3:.0%} NaN{4}'.format(width, height, bands, nan_fraction, ', S/N ratio file' if snr else ''))
+    print('Mode:                {0}'.format('pipeline' if pipeline else 'sequential'))
+    print('Areas:               {0} ({1} work units created)'.format(areas, len(FAKE_BOINC.work_units)))
+    print('Pixels:              {0}'.format(pixels))
+    print('Elapsed:             {0:.2f}s'.format(elapsed))
+    print('Pixels/sec:          {0:.0f}'.format(pixels / elapsed))
+    print('Areas/sec:           {0:.1f}'.format(areas / elapsed))
+    print('Stages:')
+    for stage in ['read the cube', 'write the files', 'database', 'BOINC database']:
+        print('  {0:<18} {1:8.2f}s {2:6.1%}'.format(stage, timer.get(stage), timer.get(stage) / elapsed))
+    if pipeline:
+        print('  The files and database stages run on the pipeline threads at the same time as the planning')
+    else:
+        planning = break_up - timer.get('read the cube') - timer.get('write the files') - timer.get('database') - timer.get('BOINC database')
+        print('  {0:<18} {1:8.2f}s {2:6.1%}'.format('planning the areas', planning, planning / elapsed))
+    print('  {0:<18} {1:8.2f}s {2:6.1%}'.format('setup and finish', elapsed - break_up, (elapsed - break_up) / elapsed))
+
+    plain_bytes, gzip_bytes = get_download_bytes(download_dir, fanout)
+    print('Bytes per pixel:     {0:.1f} (observation and job.xml files, {1:.1f} served for {2} results)'.format(plain_bytes / float(pixels),
+                                                                                                              plain_bytes * TARGET_NRESULTS / float(pixels),
+                                                                                                              TARGET_NRESULTS))
+    if gzip_bytes > 0:
+        print('Gzipped per pixel:   {0:.1f} ({1:.1f} served, {2:.1%} of the uncompressed size)'.format(gzip_bytes / float(pixels),
+                                                                                                    gzip_bytes * TARGET_NRESULTS / float(pixels),
+                                                                                                    gzip_bytes / float(plain_bytes)))
+    return timer
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-x', '--width', type=int, default=512, help='the width of the image')
+    parser.add_argument('-y', '--height', type=int, default=512, help='the height of the image')
+    parser.add_argument('-b', '--bands', type=int, default=9, choices=range(4, len(FILTER_NAMES) + 1), help='the number of layers')
+    parser.add_argument('-n', '--nan_fraction', type=float, default=0.2, help='the fraction of each layer that is NaN')
+    parser.add_argument('-s', '--snr', action='store_true', help='use a S/N ratio file')
+    parser.add_argument('-f', '--fanout', type=int, default=1024, help='the fanout of the download directory')
+    parser.add_argument('-p', '--pipeline', action='store_true', help='write the files and commit the areas on background threads')
+    parser.add_argument('-z', '--gzip', action='store_true', help='write gzipped copies of the observation and job.xml files')
+    parser.add_argument('-k', '--keep', action='store_true', help='keep the working directory')
+    parser.add_argument('--seed', type=int, default=1, help='the random seed for the cube')
+    args = vars(parser.parse_args())
+
+    numpy.random.seed(args['seed'])
+    directory = tempfile.mkdtemp(prefix='fits2wu_benchmark_')
+    try:
+        run_benchmark(directory, args['width'], args['height'], args['bands'], args['nan_fraction'], args['snr'], args['fanout'], args['pipeline'], args['gzip'])
+    finally:
+        if args['keep']:
+            LOG.info('The files are in {0}'.format(directory))
+        else:
+            shutil.rmtree(directory)
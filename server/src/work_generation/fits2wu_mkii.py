@@ -37,16 +37,20 @@ sys.path.append(os.path.abspath(os.path.join(base_path, '../../../../boinc/py'))
 import argparse
 import py_boinc
 import signal
+import time
 from Boinc import configxml
-from datetime import datetime
 from utils.logging_helper import config_logger
 from utils.shutdown_detection import signal_handler, check_stop_trigger
 from sqlalchemy.engine import create_engine
-from sqlalchemy.sql.expression import func, select, or_
-from config import BOINC_DB_LOGIN, WG_THRESHOLD, WG_HIGH_WATER_MARK, DB_LOGIN, POGS_BOINC_PROJECT_ROOT
-from database.boinc_database_support_core import RESULT
-from database.database_support_core import REGISTER, TAG_REGISTER
-from work_generation.fits2wu_mod_mkii import Fit2Wu, MIN_QUORUM
+from sqlalchemy.sql.expression import func, select
+from config import BOINC_DB_LOGIN, WG_THRESHOLD, WG_HIGH_WATER_MARK, DB_LOGIN, POGS_BOINC_PROJECT_ROOT, WG_POLL_SECONDS, WG_METADATA_CACHE_SECONDS, WG_PACK_GALAXIES, \
+    WG_UPLOAD_THREADS
+from database.database_support_core import REGISTER
+from work_generation.fits2wu_mod_mkii import BoincInsertError
+from work_generation.fits2wu_workers import WorkGenerationStats, WorkGenerationWorkers, get_next_registration, process_registration, get_max_work_units, get_pending_count, \
+    is_small_registration, get_small_registrations, process_packed_registrations
+from work_generation.run_cache import RunCache
+from work_generation.upload_queue import GalaxyUploader
 
 # install sigint handler for shutdowns
 signal.signal(signal.SIGINT, signal_handler)
@@ -54,18 +58,17 @@ signal.signal(signal.SIGINT, signal_handler)
 LOG = config_logger(__name__)
 LOG.info('PYTHONPATH = {0}'.format(sys.path))
 
+# Recycle the pooled connections before MySQL times them out
+POOL_RECYCLE_SECONDS = 3600
+
 parser = argparse.ArgumentParser()
 parser.add_argument('-l', '--limit', type=int, help='only generate N workunits from this galaxy (for testing)')
+parser.add_argument('-p', '--pipeline', action='store_true', help='write the files and commit the areas on background threads')
+parser.add_argument('-w', '--workers', type=int, default=1, help='process N registrations at the same time in separate processes')
+parser.add_argument('-d', '--daemon', action='store_true', help='keep running and generate work whenever the pending results drop below the threshold')
+parser.add_argument('--pack', action='store_true', help='pack the areas of small galaxies with the same models into shared work units (not used with --workers)')
 args = vars(parser.parse_args())
 
-# select count(*) from result where server_state = 2 or server_state = 1
-ENGINE = create_engine(BOINC_DB_LOGIN)
-connection = ENGINE.connect()
-count = connection.execute(select([func.count(RESULT.c.id)]).where(or_(RESULT.c.server_state == 2, RESULT.c.server_state == 1))).first()[0]
-connection.close()
-
-LOG.info('Checking pending = %d : threshold = %d', count, WG_THRESHOLD)
-
 LIMIT = None
 if args['limit'] is not None:
     LIMIT = args['limit']
@@ -73,129 +76,145 @@ if args['limit'] is not None:
 # The BOINC scripts/apps do not feel at home outside their directory
 os.chdir(POGS_BOINC_PROJECT_ROOT)
 
-# Connect to the database - the login string is set in the database package
-ENGINE = create_engine(DB_LOGIN)
-connection = ENGINE.connect()
-
-if count is not None and count >= WG_THRESHOLD:
-    LOG.info('Nothing to do')
-
-else:
-    # Get the BOINC downloads and fanout values
-    boinc_config = configxml.ConfigFile().read()
-    download_dir = boinc_config.config.download_dir
-    fanout = long(boinc_config.config.uldl_dir_fanout)
-    LOG.info("download_dir: %s, fanout: %d", download_dir, fanout)
-
-    # Database + program performance variables
-    total_db_time = 0
-    areaave = []
-    total_boinc_db_time = 0
-    areaave_boinc = []
-    total_areas = 0
-    total_pixels = 0
-
-    # Open the BOINC DB
-    LOG.info("Opening BOINC DB")
-    return_value = py_boinc.boinc_db_open()
-    if return_value != 0:
-        LOG.error('Could not open BOINC DB return code: %d', return_value)
+# Connect to the databases - the login strings are set in the config package.
+# A daemon takes its connections from the engines' pools on every pass.
+BOINC_ENGINE = create_engine(BOINC_DB_LOGIN, pool_recycle=POOL_RECYCLE_SECONDS)
+ENGINE = create_engine(DB_LOGIN, pool_recycle=POOL_RECYCLE_SECONDS)
+
+
+def generate_work(connection, boinc_connection, download_dir, fanout, run_cache, worker_pool, uploader):
+    """
+    Top the queue up to the high water mark if it has dropped below the threshold
+
+    :param connection: the database connection
+    :param boinc_connection: the BOINC database connection
+    :param download_dir: the BOINC download directory
+    :param fanout: the BOINC fanout
+    :param run_cache: the RunCache shared by the registrations
+    :param worker_pool: the WorkGenerationWorkers or None to process the registrations here
+    :param uploader: the GalaxyUploader to store the files in the background or None
+    :return: the number of results added
+    :raises BoincInsertError: if the work units could not be created - py_boinc's connection should be opened again
+    """
+    if uploader is not None:
+        # Pick up any uploads that were lost when a work generator stopped
+        uploader.recover(connection)
+
+    # select count(*) from result where server_state = 2 or server_state = 1 - we only need to count up to the threshold
+    count = get_pending_count(boinc_connection, WG_THRESHOLD)
+    LOG.info('Checking pending = %d : threshold = %d', count, WG_THRESHOLD)
+
+    if count >= WG_THRESHOLD:
+        LOG.info('Nothing to do')
+        return 0
+
+    stats = WorkGenerationStats()
+    work_units_to_be_added = WG_THRESHOLD - count + WG_HIGH_WATER_MARK
+
+    if worker_pool is not None:
+        if not worker_pool.generate(connection, work_units_to_be_added, stats):
+            # Start again with a full set of workers
+            worker_pool.stop()
+            worker_pool.start()
 
     else:
-        # Normal operation
-        total_work_units_added = 0
-        work_units_to_be_added = WG_THRESHOLD - count + WG_HIGH_WATER_MARK
-
         # Get registered FITS files and generate work units until we've refilled the queue to at least the high water mark
-        while total_work_units_added < work_units_to_be_added:
-            if check_stop_trigger():
-                LOG.info('Stop trigger identified')
-                break
-            LOG.info("Added %d of %d", total_work_units_added, work_units_to_be_added)
-            registration = connection.execute(select([REGISTER]).where(REGISTER.c.create_time == None).order_by(REGISTER.c.priority.desc(), REGISTER.c.register_time)).first()
-            if registration is None:
-                LOG.info('No registrations waiting')
-                break
-            else:
-                # As the load work unit component adds data to the data base we need autocommit on to ensure each pixel matches
-                if not os.path.isfile(registration[REGISTER.c.filename]):
-                    LOG.error('The file %s does not exist', registration[REGISTER.c.filename])
-                    connection.execute(REGISTER.update().where(REGISTER.c.register_id == registration[REGISTER.c.register_id]).values(create_time=datetime.now()))
-                elif registration[REGISTER.c.sigma_filename] is not None and not os.path.isfile(registration[REGISTER.c.sigma_filename]):
-                    LOG.error('The file %s does not exist', registration[REGISTER.c.sigma_filename])
-                    connection.execute(REGISTER.update().where(REGISTER.c.register_id == registration[REGISTER.c.register_id]).values(create_time=datetime.now()))
+        try:
+            while stats.total_work_units_added < work_units_to_be_added:
+                if check_stop_trigger():
+                    LOG.info('Stop trigger identified')
+                    break
+                LOG.info("Added %d of %d", stats.total_work_units_added, work_units_to_be_added)
+                registration = get_next_registration(connection)
+                if registration is None:
+                    LOG.info('No registrations waiting')
+                    break
+                elif args['pack'] and is_small_registration(connection, registration):
+                    # Small galaxies are done in batches so their areas can share work units
+                    registrations = get_small_registrations(connection, WG_PACK_GALAXIES)
+                    stats.add(process_packed_registrations(connection, registrations, download_dir, fanout, run_cache, uploader))
                 else:
-                    LOG.info('Processing {0} {1} {2}'.format(registration[REGISTER.c.galaxy_name], registration[REGISTER.c.priority], registration[REGISTER.c.register_id]))
-
-                    fit2wu = Fit2Wu(
-                        connection,
-                        download_dir,
-                        fanout)
-                    try:
-                        (work_units_added, pixel_count, sum, ave, bsum, bave, areas, pixels) = fit2wu.process_file(registration)
-
-                        # Calculate performance information
-                        total_db_time += sum
-                        total_boinc_db_time += bsum
-                        areaave.append(ave)
-                        areaave_boinc.append(bave)
-                        total_areas += areas
-                        total_pixels += pixels
-
-                        total_work_units_added += (work_units_added * MIN_QUORUM)
-                    except IOError:
-                        LOG.exception('An error occurred while trying to read from a fits file')
-
-                        connection.execute(REGISTER.update().where(REGISTER.c.register_id == registration[REGISTER.c.register_id]).values(create_time=datetime.now()))
-                        continue
-                    except Exception:
-                        LOG.exception('An error occurred while processing {0}'.format(registration[REGISTER.c.galaxy_name]))
-
-                        connection.execute(REGISTER.update().where(REGISTER.c.register_id == registration[REGISTER.c.register_id]).values(create_time=datetime.now()))
-                        continue
-                    # One WU = MIN_QUORUM Results
-
-                    # Delete the files once we are done
-                    if os.path.exists(registration[REGISTER.c.filename]):
-                        os.remove(registration[REGISTER.c.filename])
-                    if registration[REGISTER.c.sigma_filename] is not None and os.path.exists(registration[REGISTER.c.sigma_filename]):
-                        os.remove(registration[REGISTER.c.sigma_filename])
-                    if registration[REGISTER.c.rad_filename] is not None and os.path.exists(registration[REGISTER.c.rad_filename]):
-                        os.remove(registration[REGISTER.c.rad_filename])
-                    if registration[REGISTER.c.rad_sigma_filename] is not None and os.path.exists(registration[REGISTER.c.rad_sigma_filename]):
-                        os.remove(registration[REGISTER.c.rad_sigma_filename])
-                    if registration[REGISTER.c.int_filename] is not None and os.path.exists(registration[REGISTER.c.int_filename]):
-                        os.remove(registration[REGISTER.c.int_filename])
-                    if registration[REGISTER.c.int_sigma_filename] is not None and os.path.exists(registration[REGISTER.c.int_sigma_filename]):
-                        os.remove(registration[REGISTER.c.int_sigma_filename])
-
-                    connection.execute(REGISTER.update().where(REGISTER.c.register_id == registration[REGISTER.c.register_id]).values(create_time=datetime.now()))
-
-                connection.execute(TAG_REGISTER.delete().where(TAG_REGISTER.c.register_id == registration[REGISTER.c.register_id]))
-
-        LOG.info('Total areas added {0}, pixels added {1}'.format(total_areas, total_pixels))
-        if len(areaave) > 0:
-            LOG.info('Total db time: {0}'.format(total_db_time))
-            asum = 0
-            for rtime in areaave:
-                asum += rtime
-            LOG.info('Average time per transaction: {0}'.format(asum / len(areaave)))
-
-            LOG.info('Total BOINC db time: {0}'.format(total_boinc_db_time))
-            asum_boinc = 0
-            for rtime in areaave_boinc:
-                asum_boinc += rtime
-            LOG.info('Average BOINC db time per transaction: {0}'.format(asum_boinc / len(areaave_boinc)))
-
-        LOG.info('Done - added %d Results', total_work_units_added)
+                    # Only make as many work units as we need - a big galaxy will be finished off by the next runs
+                    max_work_units = get_max_work_units(work_units_to_be_added - stats.total_work_units_added)
+                    if LIMIT is not None:
+                        max_work_units = min(max_work_units, LIMIT)
+                    stats.add(process_registration(connection, registration, download_dir, fanout, args['pipeline'], max_work_units, run_cache, uploader))
+        except BoincInsertError:
+            # The registration is left for the next pass, once the BOINC database has been opened again
+            LOG.error('Stopping as the BOINC database is not taking work units')
+            stats.log()
+            raise
+
+    stats.log()
+
+    # Log how many are left in the queue
+    count = connection.execute(select([func.count(REGISTER.c.register_id)]).where(REGISTER.c.create_time == None)).first()[0]
+    LOG.info('Galaxies in queue = %d', count)
+
+    return stats.total_work_units_added
+
+
+# Get the BOINC downloads and fanout values
+boinc_config = configxml.ConfigFile().read()
+download_dir = boinc_config.config.download_dir
+fanout = long(boinc_config.config.uldl_dir_fanout)
+LOG.info("download_dir: %s, fanout: %d", download_dir, fanout)
+
+# Keep the run details between galaxies - they expire so a daemon sees any changes
+run_cache = RunCache(WG_METADATA_CACHE_SECONDS)
+
+return_value = -1
+worker_pool = None
+if args['workers'] > 1:
+    # Each worker process opens its own BOINC DB and runs its own uploader
+    worker_pool = WorkGenerationWorkers(args['workers'], download_dir, fanout, args['pipeline'])
+    worker_pool.start()
+
+# Build the images and store the files of the finished galaxies in the background
+uploader = None
+if worker_pool is None and WG_UPLOAD_THREADS > 0:
+    uploader = GalaxyUploader(WG_UPLOAD_THREADS)
+    uploader.start()
+
+try:
+    while True:
+        results_added = 0
+        if worker_pool is None and return_value != 0:
+            # Open the BOINC DB - a daemon tries again on each pass until it opens
+            LOG.info("Opening BOINC DB")
+            return_value = py_boinc.boinc_db_open()
+            if return_value != 0:
+                LOG.error('Could not open BOINC DB return code: %d', return_value)
+
+        if worker_pool is not None or return_value == 0:
+            connection = ENGINE.connect()
+            boinc_connection = BOINC_ENGINE.connect()
+            try:
+                results_added = generate_work(connection, boinc_connection, download_dir, fanout, run_cache, worker_pool, uploader)
+            except BoincInsertError:
+                # The connection may have gone, so close it and open it again on the next pass
+                LOG.info('Closing BOINC DB')
+                py_boinc.boinc_db_close()
+                return_value = -1
+            finally:
+                boinc_connection.close()
+                connection.close()
+
+        if not args['daemon'] or check_stop_trigger():
+            break
+
+        # Go straight round again if we are still filling the queue
+        if results_added == 0:
+            time.sleep(WG_POLL_SECONDS)
+finally:
+    if worker_pool is not None:
+        worker_pool.stop()
+
+    # Wait for the uploads to finish
+    if uploader is not None:
+        uploader.close()
 
     # Closing BOINC DB
     if return_value == 0:
         LOG.info('Closing BOINC DB')
         return_value = py_boinc.boinc_db_close()
-
-# Log how many are left in the queue
-count = connection.execute(select([func.count(REGISTER.c.register_id)]).where(REGISTER.c.create_time == None)).first()[0]
-LOG.info('Galaxies in queue = %d', count)
-
-connection.close()
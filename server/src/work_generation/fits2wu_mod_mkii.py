@@ -26,31 +26,43 @@
 Convert a FITS file ready to be converted into Work Units
 """
 from __future__ import print_function
-import hashlib
 from utils.logging_helper import config_logger
 import os
-import json
-import shutil
-import math
 import pyfits
 import py_boinc
 
 import time
 
 from datetime import datetime
+from sqlalchemy import create_engine
 from sqlalchemy.sql.expression import select, func
-from config import POGS_BOINC_PROJECT_ROOT, WG_REPORT_DEADLINE, WG_PIXEL_COMMIT_THRESHOLD, WG_SIZE_CLASS, WG_MIN_PIXELS_PER_FILE, WG_ROW_HEIGHT, RADIAL_AREA_SIZE
-from database.database_support_core import GALAXY, REGISTER, AREA, PIXEL_RESULT, FILTER, RUN_FILTER, FITS_HEADER, RUN, TAG_REGISTER, TAG_GALAXY
+from config import BOINC_DB_LOGIN, POGS_BOINC_PROJECT_ROOT, WG_REPORT_DEADLINE, WG_PIXEL_COMMIT_THRESHOLD, RADIAL_AREA_SIZE, \
+    WG_BULK_INSERT_SIZE, WG_BOINC_BATCH_SIZE, WG_BOINC_BATCH_RETRIES, WG_WRITER_THREADS, WG_PIPELINE_QUEUE_SIZE, \
+    WG_ID_BLOCK_SIZE, WG_GZIP_INPUTS
+from database.boinc_database_support_core import WORK_UNIT
+from database.database_support_core import GALAXY, REGISTER, REGISTER_CURSOR, AREA, AREA_PACK, PIXEL_RESULT, FILTER, FITS_HEADER, RUN, TAG_REGISTER, TAG_GALAXY
 from image.fitsimage import FitsImage
-from utils.name_builder import get_galaxy_image_bucket, get_galaxy_file_name, get_key_fits, get_key_sigma_fits, get_saved_files_bucket, get_key_special_fits
+from utils.shutdown_detection import check_stop_trigger
+from utils.name_builder import get_galaxy_image_bucket, get_galaxy_file_name, get_saved_files_bucket, \
+    get_work_unit_name, get_packed_work_unit_name
 from utils.s3_helper import S3Helper
+from work_generation.fanout_writer import get_fanout_writer
+from work_generation.filter_layers import get_band_scaling, get_layer_names, sort_layers
+from work_generation.id_allocator import IdAllocator, IdBlock
+from work_generation.model_index import TEMPLATES_PATH2
+from work_generation.model_store import get_model_file_store
+from work_generation.pipeline import WorkGenerationPipeline
+from work_generation.pixel_cube import PixelCube
+from work_generation.preflight import load_preflight
+from work_generation.run_cache import RunCache
+from work_generation.upload_queue import get_galaxy_files
+from work_generation.wu_sizing import WorkUnitSizer
 
 LOG = config_logger(__name__)
 
 APP_NAME = 'magphys_wrapper'
 BIN_PATH = POGS_BOINC_PROJECT_ROOT + '/bin'
 TEMPLATES_PATH1 = 'templates'                                          # In true BOINC style, this is magically relative to the project root
-TEMPLATES_PATH2 = '/home/ec2-user/boinc-magphys/server/runs'           # Where the Server file & model files are
 MIN_QUORUM = 2                                                         # Validator run when there are at least this many results for a work unit
 TARGET_NRESULTS = MIN_QUORUM                                           # Initially create this many instances of a work unit
 DELAY_BOUND = 86400 * WG_REPORT_DEADLINE                               # Clients must report results within WG_REPORT_DEADLINE days
@@ -59,6 +71,39 @@ FPOPS_EXP = "e12"
 MAX_SUCCESS_RESULTS = 4
 MAX_ERROR_RESULTS = 8
 
+# Only needed when a galaxy is carried on, so it is made the first time it is used
+BOINC_ENGINE = None
+
+
+def find_boinc_work_units(names):
+    """
+    Find which of the work units are in the BOINC database
+
+    :param names: the work unit names
+    :return: the set of names that were found
+    """
+    global BOINC_ENGINE
+    if BOINC_ENGINE is None:
+        BOINC_ENGINE = create_engine(BOINC_DB_LOGIN)
+
+    found = set()
+    connection = BOINC_ENGINE.connect()
+    try:
+        for index in range(0, len(names), WG_BULK_INSERT_SIZE):
+            for row in connection.execute(select([WORK_UNIT.c.name]).where(WORK_UNIT.c.name.in_(names[index:index + WG_BULK_INSERT_SIZE]))):
+                found.add(row[0])
+    finally:
+        connection.close()
+    return found
+
+
+class BoincInsertError(Exception):
+    """
+    The work units could not be created in the BOINC database. The areas may already be in the POGS
+    database, so the registration must be left for the next run to finish off.
+    """
+    pass
+
 
 class Area:
     """
@@ -71,29 +116,6 @@ class Area:
         self.bottom_y = bottom_y
 
 
-class PixelValue:
-    """
-    The pixel value
-    """
-    def __init__(self, value, sigma):
-        self.value = value
-        self.sigma = sigma
-
-    def __str__(self):
-        return 'Value: {0}, Sigma: {1}'.format(self.value, self.sigma)
-
-
-class Pixel:
-    """
-    A pixel
-    """
-    def __init__(self, x, y, pixels):
-        self.x = x
-        self.y = y
-        self.pixels = pixels
-        self.pixel_id = None
-
-
 class PyBoincWu:
     """
     Used to encapsulate a single insert into the Boinc database
@@ -122,24 +144,44 @@ class PyBoincWu:
         self.size_class = size_class
         self.list_input_files = list_input_files
 
+
+class AreaJob:
+    """
+    An area on its way through the pipeline - the rows for the POGS db and the work unit for the BOINC db
+    """
+    def __init__(self, area, pixels, area_row, pixel_result_rows):
+        self.area = area
+        self.pixels = pixels
+        self.area_row = area_row
+        self.pixel_result_rows = pixel_result_rows
+        self.entry = None
+
+
 class Fit2Wu:
     """
     Convert a fit file to a wu
     """
-    def __init__(self, connection, download_dir, fanout):
+    def __init__(self, connection, download_dir, fanout, pipeline=False, run_cache=None, packer=None, gzip_inputs=WG_GZIP_INPUTS, uploader=None):
         """
         Initialise the class
 
         :param connection: the database connection
         :param download_dir: where the files will be written
         :param fanout: the fanout
+        :param pipeline: write the files and commit the areas on background threads
+        :param run_cache: the RunCache shared by the galaxies processed by a long running work generator
+        :param packer: the GalaxyPacker that will put the areas into work units shared with other small galaxies
+        :param gzip_inputs: send the observation and job.xml files to the clients gzipped
+        :param uploader: the GalaxyUploader to build the images and store the files in the background, or None to do it here
         """
         self._pixel_count = 0
         self._work_units_added = 0
         self._signal_noise_hdu = None
         self._connection = connection
-        self._download_dir = download_dir
-        self._fanout = fanout
+        self._gzip_inputs = gzip_inputs
+        self._writer = get_fanout_writer(download_dir, fanout, gzip_inputs)
+        self._model_store = get_model_file_store(download_dir)
+        self._run_cache = run_cache if run_cache is not None else RunCache()
         self._min_pixels_per_file_itr = 0  # Added global min pixels per file, this is a list
 
         self._filter_file = None
@@ -163,8 +205,10 @@ class Fit2Wu:
         self._end_x = None
         self._fpops_est_per_pixel = None
         self._cobblestone_scaling_factor = None
+        self._sizer = None
         self._template_file = None
         self._layer_order = None
+        self._pixel_cube = None
 
         # Each layer here corresponds to the same filter as in layer order.
         # e.g. sigma_layer_order[1] = same filter as layer_order[1]
@@ -173,29 +217,68 @@ class Fit2Wu:
         self._optical_bands = {}
         self._infrared_bands = {}
 
-        self._num_optical_bands_model = 0       # Total number of filters of this each type in the model (filters.dat)
-        self._num_infrared_bands_model = 0
-        self._num_ultraviolet_bands_model = 0
+        self._list_filter_names = None  # The filters used by the run (filters.dat)
+
+        # The preflight index built when the galaxy was registered, if it matches the file
+        self._preflight = None
 
         # New variables for bulk database inserts
-        self._areaPK = None  # Primary Key to use when inserting area into db. Increment BEFORE use
-        self._pixelPK = None  # Primary Key to use when inserting pixel into db. Increment BEFORE use
+        # The primary keys come from blocks reserved in ID_BLOCK so other work generators can run at the same time
+        self._id_allocator = IdAllocator(connection.engine)
+        self._area_ids = IdBlock(self._id_allocator, AREA.c.area_id, WG_ID_BLOCK_SIZE)
+        self._pixel_ids = IdBlock(self._id_allocator, PIXEL_RESULT.c.pxresult_id, WG_ID_BLOCK_SIZE)
         self._database_insert_queue = []  # List of inserts for database, should be executable by sqlalchemy
+        self._area_insert_rows = []  # Parameters for the AREA inserts, executed with executemany
+        self._pixel_result_insert_rows = []  # Parameters for the PIXEL_RESULT inserts, executed with executemany
+        self._area_pack_insert_rows = []  # Parameters for the AREA_PACK inserts when the areas are packed
         self._boinc_insert_queue = []  # List of PyBoincWu objects, each representing one insert into the boinc db
         self._pixels_processed = 0  # Number of pixels processed since last database insert
 
         # Variables for calculating database average and total access time
         self._db_access_time = []  # List of each db access time. Can be totalled and averaged.
+        self._db_rows_inserted = []  # List of the number of rows written in each db access
         self._boinc_db_access_time = []  # List of each boinc db access time. Can be totalled and averaged
+        self._boinc_batch_time = []  # List of the time taken by each batch of work units sent to the boinc db
 
         self._total_pixels = 0
         self._total_areas = 0
 
-    def process_file(self, registration):
+        # Where the last run stopped if the galaxy is being done in more than one go
+        self._cursor = None
+        self._next_row = 0
+        self._previous_pixel_count = 0
+        self._existing_areas = set()
+        self._missing_work_units = []  # The (Area, packed) tuples committed by an earlier run without a work unit
+
+        # The packer writes the files and commits the areas of several galaxies in one go
+        self._packer = packer
+        self._packed_jobs = []
+
+        # The images and files can be left to the uploader threads
+        self._uploader = uploader
+
+        # Set if the stop trigger is found part way through the galaxy
+        self._stopped = False
+
+        # The writer threads write the files and the committer thread owns the database connections
+        self._pipeline = None
+        if pipeline and packer is None:
+            self._pipeline = WorkGenerationPipeline(self._write_area_files,
+                                                    self._commit_area,
+                                                    WG_WRITER_THREADS,
+                                                    WG_PIPELINE_QUEUE_SIZE)
+
+    def process_file(self, registration, max_work_units=None):
         """
         Process a registration.
 
+        The galaxy can be done over several runs. Once max_work_units have been added we stop at the end
+        of the row band and the next run carries on from the REGISTER_CURSOR.
+
         :param registration:
+        :param max_work_units: stop after this many work units or None to do the whole galaxy
+        :return: the work units added, pixels added, the database timings, the areas and pixels added and if the galaxy is complete.
+                 The galaxy is not complete if the stop trigger was found, so its files must be kept.
         """
         self._filename = registration[REGISTER.c.filename]
         self._galaxy_name = registration[REGISTER.c.galaxy_name]
@@ -209,8 +292,7 @@ class Fit2Wu:
         # Have we files that we can use for this?
         self._rounded_redshift = self._get_rounded_redshift()
         if self._rounded_redshift is None:
-            LOG.error('No models matching the redshift of %.4f', self._redshift)
-            return 0, 0
+            raise LookupError('No models matching the redshift of {0:.4f}'.format(self._redshift))
 
         self._hdu_list = pyfits.open(self._filename, memmap=True)
         self._layer_count = len(self._hdu_list)
@@ -235,80 +317,170 @@ class Fit2Wu:
         LOG.info("Image dimensions: %(x)d x %(y)d x %(z)d => %(pix).2f Mpixels" % {'x': self._end_x, 'y': self._end_y, 'z': self._layer_count, 'pix': self._end_x * self._end_y / 1000000.0})
 
         # Get the flops estimate amd cobblestone factor
-        run = self._connection.execute(select([RUN]).where(RUN.c.run_id == self._run_id)).first()
+        run = self._run_cache.get_run(self._connection, self._run_id)
         self._fpops_est_per_pixel = run[RUN.c.fpops_est]
         self._cobblestone_scaling_factor = run[RUN.c.cobblestone_factor]
 
-        # Create and save the object
-        datetime_now = datetime.now()
-        # Galaxy ID is only needed once
-        self._galaxy_id = self._connection.execute(select([func.max(GALAXY.c.galaxy_id)])).first()[0]
-
-        if self._galaxy_id is None:
-            self._galaxy_id = 0
-
-        self._galaxy_id += 1
-        self._database_insert_queue.append(
-            GALAXY.insert().values(name=self._galaxy_name,
-                                   dimension_x=self._end_x,
-                                   dimension_y=self._end_y,
-                                   dimension_z=self._layer_count,
-                                   redshift=self._redshift,
-                                   sigma=self._sigma,
-                                   create_time=datetime_now,
-                                   image_time=datetime_now,
-                                   galaxy_type=self._galaxy_type,
-                                   ra_cent=0,
-                                   dec_cent=0,
-                                   pixel_count=0,
-                                   pixels_processed=0,
-                                   run_id=self._run_id,
-                                   galaxy_id=self._galaxy_id))
-
-        # Area and Pixel PKs are needed multiple times.
-        self._areaPK = self._connection.execute(select([func.max(AREA.c.area_id)])).first()[0]
-
-        if self._areaPK is None:
-            self._areaPK = 0
-
-        self._pixelPK = self._connection.execute(select([func.max(PIXEL_RESULT.c.pxresult_id)])).first()[0]
-
-        if self._pixelPK is None:
-            self._pixelPK = 0
-
-        LOG.info("Writing %s to database", self._galaxy_name)
-
-        # Store the tags
-        self._store_tags(registration[REGISTER.c.register_id])
-
-        # Store the fits header
-        self._store_fits_header()
+        register_id = registration[REGISTER.c.register_id]
+        self._cursor = self._connection.execute(select([REGISTER_CURSOR]).where(REGISTER_CURSOR.c.register_id == register_id)).first()
+        if self._cursor is None:
+            # Create and save the object
+            datetime_now = datetime.now()
+            # Galaxy ID is only needed once
+            self._galaxy_id = self._id_allocator.reserve(GALAXY.c.galaxy_id, 1)
+            self._database_insert_queue.append(
+                GALAXY.insert().values(name=self._galaxy_name,
+                                       dimension_x=self._end_x,
+                                       dimension_y=self._end_y,
+                                       dimension_z=self._layer_count,
+                                       redshift=self._redshift,
+                                       sigma=self._sigma,
+                                       create_time=datetime_now,
+                                       image_time=datetime_now,
+                                       galaxy_type=self._galaxy_type,
+                                       ra_cent=0,
+                                       dec_cent=0,
+                                       pixel_count=0,
+                                       pixels_processed=0,
+                                       run_id=self._run_id,
+                                       galaxy_id=self._galaxy_id))
+
+            # The cursor goes in with the galaxy so a crash part way through can be picked up again
+            self._database_insert_queue.append(
+                REGISTER_CURSOR.insert().values(register_id=register_id,
+                                                galaxy_id=self._galaxy_id,
+                                                next_row=0,
+                                                min_pixels_per_file_itr=0,
+                                                next_area_id=0,
+                                                work_units_added=0,
+                                                pixel_count=0,
+                                                update_time=datetime_now))
+
+            LOG.info("Writing %s to database", self._galaxy_name)
+
+            # Store the tags
+            self._store_tags(register_id)
+
+            # Store the fits header
+            self._store_fits_header()
+        else:
+            self._galaxy_id = self._cursor[REGISTER_CURSOR.c.galaxy_id]
+            self._next_row = self._cursor[REGISTER_CURSOR.c.next_row]
+            self._min_pixels_per_file_itr = self._cursor[REGISTER_CURSOR.c.min_pixels_per_file_itr]
+            self._area_ids.resume_from(self._cursor[REGISTER_CURSOR.c.next_area_id])
+            LOG.info('Carrying on with %s (galaxy_id %d) from row %d', self._galaxy_name, self._galaxy_id, self._next_row)
+
+            # Areas committed after the cursor was last saved (if the last run crashed) must not be made again,
+            # and areas committed without their work unit (if it crashed between the two databases) need it made
+            self._find_existing_areas()
+
+        # Use the layer names and valid pixels found when the galaxy was registered, as long as they are for this file
+        self._preflight = load_preflight(self._connection, register_id)
+        if self._preflight is not None and (self._preflight.valid_mask.shape != (self._end_y, self._end_x) or len(self._preflight.layer_names) != self._layer_count):
+            LOG.warning('The preflight index for {0} does not match the fits file so it will not be used'.format(self._galaxy_name))
+            self._preflight = None
 
         # Get the filters we're using for this run and sort the layers
         self._get_filters_sort_layers()
 
+        # The layers are now in the right order so we can read the pixels
+        self._pixel_cube = PixelCube(self._hdu_list,
+                                     self._signal_noise_hdu,
+                                     self._layer_order,
+                                     self._sigma_layer_order,
+                                     self._sigma,
+                                     self._ultraviolet_bands,
+                                     self._optical_bands,
+                                     self._infrared_bands,
+                                     valid_mask=self._preflight.valid_mask if self._preflight is not None else None)
+
         # Scales the credit values depending on what's in the file
         self._calculate_credit()
 
-        # Build the template file we need if necessary
-        self._build_template_file()
+        # The areas are sized with the scaled fpops_est, as that is what the work units are given
+        self._sizer = WorkUnitSizer(self._fpops_est_per_pixel)
 
-        # Copy the filter and model files we need
-        self._copy_important_files()
+        # Build the template file we need if necessary and copy the filter and model files we need.
+        # There is no need to look for them again if an earlier galaxy has done it.
+        check_files = not self._run_cache.files_ready(self._run_id, self._rounded_redshift)
+        self._build_template_file(check_files)
+        self._copy_important_files(check_files)
+        self._run_cache.set_files_ready(self._run_id,
+                                        self._rounded_redshift,
+                                        [self._template_file] + [self._writer.path(file_name) for file_name in (self._filter_file, self._sfh_model_file, self._ir_model_file, self._zlib_file)])
 
-        if registration[REGISTER.c.int_filename] is not None:
-            self._build_integrated_flux_area(registration)
+        # Make the work units the last run committed the areas for but did not get into the BOINC database.
+        # This is done before the pipeline starts as it adds to the BOINC queue.
+        if len(self._missing_work_units) > 0:
+            self._recreate_work_units(registration)
 
-        if registration[REGISTER.c.rad_filename] is not None:
-            self._build_radial_areas(registration)
+        try:
+            if self._pipeline is not None:
+                self._pipeline.start()
 
-        # Now break up the galaxy into chunks
-        self._break_up_galaxy()
+            try:
+                # The integrated flux and radial areas are done by the first run
+                first_run = self._cursor is None or (self._cursor[REGISTER_CURSOR.c.next_row] == 0 and self._cursor[REGISTER_CURSOR.c.work_units_added] == 0)
+
+                if first_run and registration[REGISTER.c.int_filename] is not None:
+                    self._build_integrated_flux_area(registration)
+
+                if first_run and registration[REGISTER.c.rad_filename] is not None:
+                    self._build_radial_areas(registration)
+
+                # Now break up the galaxy into chunks
+                self._break_up_galaxy(max_work_units)
+            except Exception:
+                if self._pipeline is not None:
+                    # Stop the threads without letting one of their errors hide this one
+                    self._pipeline.abort()
+                    self._pipeline.join()
+                raise
+
+            # Wait for the queued areas to be written and committed
+            if self._pipeline is not None:
+                self._pipeline.close()
+
+            # Save where we got to in the same transaction as the last of the areas.
+            # A galaxy stopped by the stop trigger is never complete, even if it got to the last row.
+            complete = not self._stopped and self._next_row >= self._end_y
+            next_area_id = self._area_ids.next_unused_id()
+            previous_work_units = 0
+            if self._cursor is not None:
+                previous_work_units = self._cursor[REGISTER_CURSOR.c.work_units_added]
+                self._previous_pixel_count = self._cursor[REGISTER_CURSOR.c.pixel_count]
+                if next_area_id is None:
+                    next_area_id = self._cursor[REGISTER_CURSOR.c.next_area_id]
+            self._database_insert_queue.append(
+                REGISTER_CURSOR.update().where(REGISTER_CURSOR.c.register_id == register_id)
+                                        .values(next_row=self._next_row,
+                                                min_pixels_per_file_itr=self._min_pixels_per_file_itr,
+                                                next_area_id=next_area_id or 0,
+                                                work_units_added=previous_work_units + self._work_units_added,
+                                                pixel_count=self._previous_pixel_count + self._pixel_count,
+                                                update_time=datetime.now()))
+        finally:
+            # Hand back the ids we did not need, even if the galaxy failed part way through
+            self._area_ids.release()
+            self._pixel_ids.release()
+
+        if self._packer is not None:
+            if not complete:
+                # Nothing has been written, so the galaxy is simply done again by the next run
+                LOG.info('{0} was stopped before all of its areas were made, so it will not be packed'.format(self._galaxy_name))
+                return 0, 0, 0, 0, 0, 0, 0, 0, complete
+
+            # Nothing has been written yet - the packer does it along with the other small galaxies
+            LOG.info('Handing {0} areas ({1} pixels) of {2} to the packer'.format(len(self._packed_jobs), self._pixel_count, self._galaxy_name))
+            self._packer.add(self, registration)
+            return 0, self._pixel_count, 0, 0, 0, 0, self._total_areas, self._total_pixels, complete
 
         # Sometimes there will be some remaining inserts to perform, so perform them now
-        if len(self._database_insert_queue) > 0:
-            LOG.info('Processing {0} remaining database inserts'.format(len(self._database_insert_queue)))
+        if len(self._database_insert_queue) > 0 or len(self._area_insert_rows) > 0:
+            LOG.info('Processing {0} remaining database inserts'.format(len(self._database_insert_queue) + len(self._area_insert_rows) + len(self._pixel_result_insert_rows)))
             self._run_pending_db_tasks()
+
+        if len(self._boinc_insert_queue) > 0:
             self._run_pending_boinc_db_tasks()
 
         LOG.info('Total number of areas for this galaxy {0}'.format(self._total_areas))
@@ -323,27 +495,99 @@ class Fit2Wu:
         LOG.info('Total time in DB for this galaxy {0}'.format(pogs_sum))
         LOG.info('Average time in DB for each transaction {0}'.format(ave))
 
+        rows_inserted = sum(self._db_rows_inserted)
+        if pogs_sum > 0:
+            LOG.info('Total rows inserted into DB for this galaxy {0} ({1:.1f} rows/second)'.format(rows_inserted, rows_inserted / pogs_sum))
+
         # ... And the amount of time spent in the boinc db
         boinc_sum = 0
         for rtime in self._boinc_db_access_time:
             boinc_sum += rtime
 
-        bave = boinc_sum / len(self._boinc_db_access_time)
+        bave = 0
+        if len(self._boinc_db_access_time) > 0:
+            bave = boinc_sum / len(self._boinc_db_access_time)
         LOG.info('Total time in BOINC DB for this galaxy {0}'.format(boinc_sum))
         LOG.info('Average time in BOINC DB for each transaction {0}'.format(bave))
+        if len(self._boinc_batch_time) > 0:
+            LOG.info('Average time for each batch of {0} work units {1} (max {2})'.format(WG_BOINC_BATCH_SIZE,
+                                                                                      sum(self._boinc_batch_time) / len(self._boinc_batch_time),
+                                                                                      max(self._boinc_batch_time)))
 
-        LOG.info('Building the images')
+        if not complete:
+            LOG.info('{0} is not finished - the next run will carry on from row {1} of {2}'.format(self._galaxy_name, self._next_row, self._end_y))
+            return self._work_units_added, self._pixel_count, pogs_sum, ave, boinc_sum, bave, self._total_areas, self._total_pixels, complete
 
-        galaxy_file_name = get_galaxy_file_name(self._galaxy_name, self._run_id, self._galaxy_id)
-        image = FitsImage(self._connection)
-        image.build_image(self._filename, galaxy_file_name, self._galaxy_id, get_galaxy_image_bucket())
+        self.finish_galaxy(registration)
+        return self._work_units_added, self._pixel_count, pogs_sum, ave, boinc_sum, bave, self._total_areas, self._total_pixels, complete
 
+    def finish_galaxy(self, registration):
+        """
+        Build the images and store the files once all of the work units for the galaxy have been created
+
+        :param registration: the REGISTER row
+        """
+        if self._uploader is not None:
+            # The uploader sets the pixel count once it has finished
+            self._uploader.add(self._connection, self._galaxy_id, registration[REGISTER.c.register_id], self._previous_pixel_count + self._pixel_count)
+            return
+
+        self._build_images()
         self._add_files_to_bucket(registration)
 
         # Store the pixel count as the last thing to stop the original_image_checker going off
         # too soon for BIG galaxies
-        self._connection.execute(GALAXY.update().where(GALAXY.c.galaxy_id == self._galaxy_id).values(pixel_count=self._pixel_count))
-        return self._work_units_added, self._pixel_count, pogs_sum, ave, boinc_sum, bave, self._total_areas, self._total_pixels
+        self._connection.execute(GALAXY.update().where(GALAXY.c.galaxy_id == self._galaxy_id).values(pixel_count=self._previous_pixel_count + self._pixel_count))
+
+    def get_pack_key(self):
+        """
+        Galaxies can only share a work unit if they use the same model files and template
+
+        :return: the run id, rounded redshift and if the inputs are gzipped
+        """
+        return self._run_id, self._rounded_redshift, self._gzip_inputs
+
+    def get_packed_jobs(self):
+        """
+        :return: the AreaJobs held for the packer
+        """
+        return self._packed_jobs
+
+    def get_pack_size(self, itr):
+        """
+        :param itr: how many packed work units have been made so far
+        :return: the number of pixels to put in the next packed work unit
+        """
+        return self._sizer.get_min_pixels(itr)
+
+    def take_pending_work_units(self):
+        """
+        :return: the PyBoincWu entries waiting for the BOINC database - they are no longer held here
+        """
+        entries = self._boinc_insert_queue
+        self._boinc_insert_queue = []
+        return entries
+
+    def create_work_units(self, entries):
+        """
+        Create packed work units in the BOINC database
+
+        :param entries: a list of PyBoincWu from create_packed_work_unit
+        :return: the time spent in the BOINC database
+        """
+        self._boinc_insert_queue.extend(entries)
+        self._run_pending_boinc_db_tasks()
+        return self._boinc_db_access_time[-1]
+
+    def _build_images(self):
+        """
+        Build the images of the galaxy and put them in the image bucket
+        """
+        LOG.info('Building the images')
+
+        galaxy_file_name = get_galaxy_file_name(self._galaxy_name, self._run_id, self._galaxy_id)
+        image = FitsImage(self._connection)
+        image.build_image(self._filename, galaxy_file_name, self._galaxy_id, get_galaxy_image_bucket())
 
     def _add_files_to_bucket(self, registration):
         """
@@ -351,28 +595,12 @@ class Fit2Wu:
         :param registration:
         :return:
         """
-        int_flux = registration[REGISTER.c.int_filename]
-        int_flux_sigma = registration[REGISTER.c.int_sigma_filename]
-        rad = registration[REGISTER.c.rad_filename]
-        rad_sigma = registration[REGISTER.c.rad_sigma_filename]
-
         # Copy the fits files to S3
         s3helper = S3Helper()
         bucket_name = get_saved_files_bucket()
 
-        s3helper.add_file_to_bucket(bucket_name, get_key_fits(self._galaxy_name, self._run_id, self._galaxy_id), self._filename)
-        if self._sigma_filename is not None:
-            s3helper.add_file_to_bucket(bucket_name, get_key_sigma_fits(self._galaxy_name, self._run_id, self._galaxy_id), self._sigma_filename)
-
-        if int_flux is not None:
-            s3helper.add_file_to_bucket(bucket_name, get_key_special_fits(self._galaxy_name, self._run_id, self._galaxy_id, 'int', sigma=False), int_flux)
-            if int_flux_sigma is not None:
-                s3helper.add_file_to_bucket(bucket_name, get_key_special_fits(self._galaxy_name, self._run_id, self._galaxy_id, 'int', sigma=True), int_flux_sigma)
-
-        if rad is not None:
-            s3helper.add_file_to_bucket(bucket_name, get_key_special_fits(self._galaxy_name, self._run_id, self._galaxy_id, 'rad', sigma=False), rad)
-            if rad_sigma is not None:
-                s3helper.add_file_to_bucket(bucket_name, get_key_special_fits(self._galaxy_name, self._run_id, self._galaxy_id, 'rad', sigma=True), rad_sigma)
+        for key, file_name in get_galaxy_files(registration, self._galaxy_id):
+            s3helper.add_file_to_bucket(bucket_name, key, file_name)
 
     def _build_radial_areas(self, registration):
         """
@@ -391,26 +619,17 @@ class Fit2Wu:
         else:
             rad_snr_hdu = None
 
-        max_y = rad_hdu[0].data.shape[0]  # How many radial pixels are there?
-        LOG.info('{0} radial pixels.'.format(max_y))
         x = -2  # TODO put in config file that all pixels/areas at x = -2 are radial areas.
 
-        px_count = 0
-        px_list = []
-        for y in range(0, max_y):
-            pixel_data = self._custom_get_pixel(rad_hdu, rad_snr_hdu, y=y, force=True)
-
-            if len(pixel_data) > 0:
-                px_list.append(Pixel(x, y, pixel_data))
-                px_count += 1
-            else:
-                LOG.info('No radial pixels pixels at {0}'.format(y))
+        # Every radial pixel is read in one go, then split into areas
+        pixels = self._get_special_pixel_cube(rad_hdu, rad_snr_hdu).get_column(x)
+        max_y = len(pixels)  # How many radial pixels are there?
+        LOG.info('{0} radial pixels.'.format(max_y))
 
-            if px_count == RADIAL_AREA_SIZE or y == max_y - 1:
-                LOG.info('Creating a radial area of size {0}'.format(px_count))
-                self._custom_create_area(px_list, y - px_count + 1, y, x, x)
-                px_list = []
-                px_count = 0
+        for min_y in range(0, max_y, RADIAL_AREA_SIZE):
+            end_y = min(min_y + RADIAL_AREA_SIZE, max_y)
+            LOG.info('Creating a radial area of size {0}'.format(end_y - min_y))
+            self._custom_create_area(pixels.slice(min_y, end_y), min_y, end_y - 1, x, x)
 
         LOG.info('Radial areas built!')
 
@@ -434,127 +653,234 @@ class Fit2Wu:
 
         x = -1
 
-        px_list = []
-
-        pixel_data = self._custom_get_pixel(intf_hdu, intf_snr_hdu, y=0, force=True)
+        # Only the first value is used
+        pixels = self._get_special_pixel_cube(intf_hdu, intf_snr_hdu).get_column(x).slice(0, 1)
 
-        if len(pixel_data) > 0:
-            px_list.append(Pixel(-1, 0, pixel_data))
-
-            self._custom_create_area(px_list, 0, 0, x, x)
+        if len(pixels) > 0:
+            self._custom_create_area(pixels, 0, 0, x, x)
             LOG.info('Integrated flux area built!')
         else:
             LOG.info('No int flux pixels')
 
-    def _custom_get_pixel(self, input_file, input_sigma=None, x=None, y=None, force=False):
+    def _get_special_pixel_cube(self, input_file, input_sigma=None):
         """
-        Retrieves all the pixels in the specified files from the specified x,y coordinates
+        Get a PixelCube for the radial or integrated flux files. They use the same layer order as the main file.
         :param input_file: The fits file to get pixels from
         :param input_sigma: The fits file for SNR readings (or none)
-        :param x: x location to get pixels
-        :param y: y location to get pixels
-        :param force: force the program to return pixels even if _enough_layers returns false.
-        :return:
+        :return: the PixelCube
         """
-        pixels = []
-
-        for layer in self._layer_order:
-            if layer == -1:
-                # The layer is missing
-                pixels.append(PixelValue(0, 0))
-            else:
-                # A vagary of PyFits/NumPy is the order of the x & y indexes is reversed
-                # See page 13 of the PyFITS User Guide
-                pixel = input_file[layer].data[y]  # TODO only using y currently because there are never any x values here
-                if math.isnan(pixel) or pixel == 0.0:
-                    # A zero tells MAGPHYS - we have no value here
-                    pixels.append(PixelValue(0, 0))
-                else:
-                    if input_sigma is None:  # If there is no signal to noise file, use the sigma value.
-
-                        if self._sigma is not None:
-                            sigma = pixel * self._sigma
-                        else:  # If there is no sigma value, use 0.1
-                            sigma = pixel * 0.1
-
-                    else:  # if we do have a signal to noise file, use it
-
-                        if self._sigma_layer_order[layer] != -1:  # TODO Currently making assumption that layer order for the main file is globally correct!
-                            sigma = pixel / input_sigma[layer].data[y]
-                        else:  # If there is no value for the current layer, use 0.1
-                            sigma = pixel * 0.1
-
-                    pixels.append(PixelValue(pixel, sigma))
-
-        if force:
-            return pixels
-
-        if self._enough_layers(pixels):
-            return pixels
-        else:
-            return []
+        # TODO Currently making assumption that layer order for the main file is globally correct!
+        return PixelCube(input_file,
+                         input_sigma,
+                         self._layer_order,
+                         self._sigma_layer_order,
+                         self._sigma,
+                         self._ultraviolet_bands,
+                         self._optical_bands,
+                         self._infrared_bands)
 
     def _custom_create_area(self, pixels, min_y, max_y, min_x, max_x):
         """
         Creates a rectangular area from the given pixels.
         Can specify custom x, y bounds for this area. Be careful to not have two areas that overlap.
-        :param pixels:
+        :param pixels: the PixelBlock
         :return:
         """
 
-        area_insert = AREA.insert()
-        pixel_result_insert = PIXEL_RESULT.insert()
-
         if len(pixels) > 0:
             area = Area(max_x, max_y, min_x, min_y)
+            if self._area_exists(area, len(pixels)):
+                return
 
-            self._areaPK += 1
-            area.area_id = self._areaPK
+            area.area_id = self._area_ids.next_id()
 
             self._total_areas += 1
 
-            self._database_insert_queue.append(
-                area_insert.values(galaxy_id=self._galaxy_id,
-                                   top_x=area.top_x,
-                                   top_y=area.top_y,
-                                   bottom_x=area.bottom_x,
-                                   bottom_y=area.bottom_y,
-                                   area_id=self._areaPK))
-            for pixel in pixels:
-                # Needs to be incremented before use
-                self._pixelPK += 1
-                pixel.pixel_id = self._pixelPK
-
+            pixels.set_pixel_ids(self._pixel_ids.next_ids(len(pixels)))
+            pixel_result_rows = []
+            for pixel_id, (x, y) in zip(pixels.pixel_ids, pixels.coordinates()):
                 # Enqueue this insert
-                self._total_pixels += 1
-                self._database_insert_queue.append(
-                    pixel_result_insert.values(galaxy_id=self._galaxy_id,
-                                               area_id=area.area_id,
-                                               y=pixel.y,
-                                               x=pixel.x,
-                                               pxresult_id=self._pixelPK))
-                self._pixel_count += 1
-
-            # Write the pixels, at this point the area has been fully created
-            self._create_output_file(area, pixels)
-            self._work_units_added += 1
-            self._pixels_processed += len(pixels)
+                pixel_result_rows.append({'galaxy_id': self._galaxy_id,
+                                          'area_id': area.area_id,
+                                          'y': y,
+                                          'x': x,
+                                          'pxresult_id': pixel_id})
+
+            self._total_pixels += len(pixels)
+            self._pixel_count += len(pixels)
 
-            # Once we've processed more pixels then the commit threshold, we commit everything to both dbs
-            if self._pixels_processed > WG_PIXEL_COMMIT_THRESHOLD:
-                self._run_pending_db_tasks()
-                self._run_pending_boinc_db_tasks()
-                self._pixels_processed = 0  # reset for next areas
+            self._add_area(area, pixels, pixel_result_rows)
 
-    def _break_up_galaxy(self):
+    def _break_up_galaxy(self, max_work_units=None):
         """
-        Break up the galaxy into small pieces
+        Break up the galaxy into small pieces, starting from the cursor
+
+        :param max_work_units: stop at the end of the row band once this many work units have been added
         """
-        pix_y = 0
+        pix_y = self._next_row
 
         while pix_y < self._end_y:
-            self._create_areas(pix_y, WG_ROW_HEIGHT)  # Min pixels per file is handled internally
-            pix_y += WG_ROW_HEIGHT
+            if max_work_units is not None and self._work_units_added >= max_work_units:
+                LOG.info('{0} work units added - stopping {1} at row {2}'.format(self._work_units_added, self._galaxy_name, pix_y))
+                break
+            if check_stop_trigger():
+                LOG.info('Stop trigger identified - stopping {0} at row {1}'.format(self._galaxy_name, pix_y))
+                self._stopped = True
+                break
+            if self._pipeline is not None and self._pipeline.failed():
+                break
+
+            self._create_areas(pix_y, self._sizer.row_height)  # Min pixels per file is handled internally
+            pix_y += self._sizer.row_height
+            self._next_row = min(pix_y, self._end_y)
+
+    def _area_exists(self, area, pixels_in_area):
+        """
+        Was the area made by an earlier run that crashed before it could save the cursor?
+        If so the area is counted now, as the cursor doesn't include it.
+
+        :param area: the area
+        :param pixels_in_area: the number of pixels in the area
+        """
+        if (area.top_x, area.top_y, area.bottom_x, area.bottom_y) in self._existing_areas:
+            LOG.info('Area {0},{1} to {2},{3} already exists'.format(area.top_x, area.top_y, area.bottom_x, area.bottom_y))
+            self._work_units_added += 1
+            self._pixel_count += pixels_in_area
+            return True
+        return False
+
+    def _find_existing_areas(self):
+        """
+        Get the areas an earlier run committed and check their work units were created. An area the assimilator
+        has seen has a workunit_id, the others are looked for by name in the BOINC database - the packed name if
+        the area is in AREA_PACK.
+        """
+        names = {}
+        for area in self._connection.execute(select([AREA.c.area_id, AREA.c.top_x, AREA.c.top_y, AREA.c.bottom_x, AREA.c.bottom_y, AREA.c.workunit_id])
+                                             .where(AREA.c.galaxy_id == self._galaxy_id)):
+            self._existing_areas.add((area[AREA.c.top_x], area[AREA.c.top_y], area[AREA.c.bottom_x], area[AREA.c.bottom_y]))
+            if area[AREA.c.workunit_id] is None:
+                existing_area = Area(area[AREA.c.top_x], area[AREA.c.top_y], area[AREA.c.bottom_x], area[AREA.c.bottom_y])
+                existing_area.area_id = area[AREA.c.area_id]
+                names[existing_area.area_id] = (self._get_work_unit_name(existing_area), existing_area, False)
+
+        if len(names) == 0:
+            return
+
+        # A packed work unit is named after the galaxy of its first area
+        pack_area = AREA.alias('pack_area')
+        for row in self._connection.execute(select([AREA_PACK.c.area_id, AREA_PACK.c.pack_area_id, GALAXY.c.name],
+                                                   from_obj=AREA_PACK.join(pack_area, pack_area.c.area_id == AREA_PACK.c.pack_area_id)
+                                                                     .join(GALAXY, GALAXY.c.galaxy_id == pack_area.c.galaxy_id))
+                                            .where(AREA_PACK.c.area_id.in_(names.keys()))):
+            _, existing_area, _ = names[row[AREA_PACK.c.area_id]]
+            names[row[AREA_PACK.c.area_id]] = (get_packed_work_unit_name(row[GALAXY.c.name], row[AREA_PACK.c.pack_area_id]), existing_area, True)
+
+        found = find_boinc_work_units([name for name, _, _ in names.values()])
+        for area_id in sorted(names.keys()):
+            name, existing_area, packed = names[area_id]
+            if name not in found:
+                LOG.warning('Area {0} of {1} does not have the work unit {2}'.format(area_id, self._galaxy_name, name))
+                self._missing_work_units.append((existing_area, packed))
+
+    def _recreate_work_units(self, registration):
+        """
+        Write the files and queue the work units for the areas in _missing_work_units. The pixel ids are the ones
+        committed with the area. A packed area gets a work unit of its own, as the other areas in its pack may be done.
+
+        :param registration: the REGISTER row
+        """
+        column_pixels = {}
+        for area, packed in self._missing_work_units:
+            if area.top_x == -2:
+                # Radial areas are stored from the last pixel to the first
+                if -2 not in column_pixels:
+                    column_pixels[-2] = self._get_special_pixel_cube(pyfits.open(registration[REGISTER.c.rad_filename], memmap=True),
+                                                                     self._open_optional(registration[REGISTER.c.rad_sigma_filename])).get_column(-2)
+                pixels = column_pixels[-2].slice(area.bottom_y, area.top_y + 1)
+            elif area.top_x == -1:
+                pixels = self._get_special_pixel_cube(pyfits.open(registration[REGISTER.c.int_filename], memmap=True),
+                                                      self._open_optional(registration[REGISTER.c.int_sigma_filename])).get_column(-1).slice(0, 1)
+            else:
+                row_band = self._pixel_cube.get_row_band(area.top_y, area.bottom_y - area.top_y)
+                pixels = row_band.get_columns(area.top_x, area.bottom_x)
+
+            first_pixel_id, pixel_count = self._connection.execute(select([func.min(PIXEL_RESULT.c.pxresult_id), func.count(PIXEL_RESULT.c.pxresult_id)])
+                                                                   .where(PIXEL_RESULT.c.area_id == area.area_id)).first()
+            if pixel_count != len(pixels):
+                LOG.error('Area {0} of {1} has {2} pixels, but {3} were read from the file - its work unit cannot be made'.format(area.area_id, self._galaxy_name, pixel_count, len(pixels)))
+                continue
+
+            LOG.info('Making the missing work unit for area {0} of {1}'.format(area.area_id, self._galaxy_name))
+            pixels.set_pixel_ids(first_pixel_id)
+            if packed:
+                self._database_insert_queue.append(AREA_PACK.delete().where(AREA_PACK.c.area_id == area.area_id))
+            self._boinc_insert_queue.append(self._create_output_file(area, pixels))
+
+    @staticmethod
+    def _open_optional(filename):
+        if filename is None:
+            return None
+        return pyfits.open(filename, memmap=True)
+
+    def _add_area(self, area, pixels, pixel_result_rows):
+        """
+        Hand a fully created area on to be written and committed
+
+        :param area: the area
+        :param pixels: the pixels in the area with their pixel ids set
+        :param pixel_result_rows: the PIXEL_RESULT rows for the pixels
+        """
+        job = AreaJob(area,
+                      pixels,
+                      {'galaxy_id': self._galaxy_id,
+                       'top_x': area.top_x,
+                       'top_y': area.top_y,
+                       'bottom_x': area.bottom_x,
+                       'bottom_y': area.bottom_y,
+                       'area_id': area.area_id},
+                      pixel_result_rows)
+        if self._packer is not None:
+            # The packer decides which work unit the area goes in, the rows are committed when it is done
+            self._packed_jobs.append(job)
+            self._area_insert_rows.append(job.area_row)
+            self._pixel_result_insert_rows.extend(job.pixel_result_rows)
+            return
+
+        self._work_units_added += 1
+
+        if self._pipeline is None:
+            self._write_area_files(job)
+            self._commit_area(job)
+        else:
+            # If the pipeline has failed the job is dropped - the error is raised when the pipeline is closed
+            self._pipeline.put(job)
+
+    def _write_area_files(self, job):
+        """
+        Write the files for an area - called from the writer threads when the pipeline is used
+
+        :param job: the AreaJob
+        """
+        job.entry = self._create_output_file(job.area, job.pixels)
+
+    def _commit_area(self, job):
+        """
+        Queue the database rows for an area whose files have been written.
+        Called from the committer thread when the pipeline is used, so this is the only place the databases are written to.
+
+        :param job: the AreaJob
+        """
+        self._area_insert_rows.append(job.area_row)
+        self._pixel_result_insert_rows.extend(job.pixel_result_rows)
+        self._boinc_insert_queue.append(job.entry)
+        self._pixels_processed += len(job.pixels)
+
+        # Once we've processed more pixels then the commit threshold, we commit everything to both dbs
+        if self._pixels_processed > WG_PIXEL_COMMIT_THRESHOLD:
+            self._run_pending_db_tasks()
+            self._run_pending_boinc_db_tasks()
+            self._pixels_processed = 0  # reset for next areas
 
     def _run_pending_db_tasks(self):
         """
@@ -566,8 +892,7 @@ class Fit2Wu:
 
         transaction = self._connection.begin()
         try:
-            for query in self._database_insert_queue:
-                self._connection.execute(query)
+            rows = self.execute_pending_db_tasks()
             transaction.commit()
         except Exception:
             LOG.error('Error inserting into database')
@@ -575,19 +900,82 @@ class Fit2Wu:
             raise
         # Used to calculate the average time spend in the db
         self._db_access_time.append(time.time() - start)
+        self._db_rows_inserted.append(rows)
+
+    def execute_pending_db_tasks(self):
+        """
+        Run the queued database tasks inside the caller's transaction
+
+        :return: the number of rows written
+        """
+        rows = len(self._database_insert_queue) + len(self._area_insert_rows) + len(self._pixel_result_insert_rows) + len(self._area_pack_insert_rows)
+
+        # The galaxy is in this queue so it must go before the areas and pixels
+        for query in self._database_insert_queue:
+            self._connection.execute(query)
+        self._bulk_insert(AREA, self._area_insert_rows)
+        self._bulk_insert(PIXEL_RESULT, self._pixel_result_insert_rows)
+        self._bulk_insert(AREA_PACK, self._area_pack_insert_rows)
+
         # Reset queue to none
         self._database_insert_queue = []
+        self._area_insert_rows = []
+        self._pixel_result_insert_rows = []
+        self._area_pack_insert_rows = []
+        return rows
+
+    def _bulk_insert(self, table, rows):
+        """
+        Insert the rows using one prepared statement and executemany batches of WG_BULK_INSERT_SIZE rows
+        :param table: the table to insert into
+        :param rows: a list of dictionaries of the column values
+        :return:
+        """
+        insert = table.insert()
+        for index in range(0, len(rows), WG_BULK_INSERT_SIZE):
+            self._connection.execute(insert, rows[index:index + WG_BULK_INSERT_SIZE])
 
     def _run_pending_boinc_db_tasks(self):
         """
-        Runs all of the queued boinc db tasks as one transaction.
+        Runs all of the queued boinc db tasks in batches of WG_BOINC_BATCH_SIZE work units per transaction.
+        If a batch fails the work units already created are committed and only the tail is retried.
+        Raises BoincInsertError if the work units still can't be created after WG_BOINC_BATCH_RETRIES tries.
         :return:
         """
         LOG.info('Committing all pending data to BOINC database')
         start = time.time()
-        for query in self._boinc_insert_queue:
+        retries = 0
+        while len(self._boinc_insert_queue) > 0:
+            batch_start = time.time()
+            batch = self._boinc_insert_queue[:WG_BOINC_BATCH_SIZE]
+            committed = self._create_work_batch(batch)
+            self._boinc_batch_time.append(time.time() - batch_start)
+
+            # Anything committed must never be sent again
+            del self._boinc_insert_queue[:committed]
+
+            if committed == len(batch):
+                retries = 0
+            else:
+                if committed > 0:
+                    retries = 0
+                retries += 1
+                if retries > WG_BOINC_BATCH_RETRIES:
+                    self._boinc_db_access_time.append(time.time() - start)
+                    raise BoincInsertError('Giving up after {0} retries, {1} work units are still waiting for the BOINC database'.format(WG_BOINC_BATCH_RETRIES, len(self._boinc_insert_queue)))
+                LOG.info('Retrying from work unit {0}'.format(self._boinc_insert_queue[0].wu_name))
+
+        # Used to calculate the final average time spent in the boinc db
+        self._boinc_db_access_time.append(time.time() - start)
 
-            py_boinc.boinc_db_transaction_start()
+    def _create_work_batch(self, batch):
+        """
+        Create the work units in a single BOINC transaction.
+        :param batch: a list of PyBoincWu objects
+        :return: the number of work units committed - these are always the first ones in the batch
+        """
+        py_boinc.boinc_db_transaction_start()
+        for index, query in enumerate(batch):
             retval = py_boinc.boinc_create_work(
                 app_name=query.app_name,
                 min_quorom=query.min_quorom,
@@ -609,22 +997,31 @@ class Fit2Wu:
                 list_input_files=query.list_input_files)
             if retval != 0:
                 py_boinc.boinc_db_transaction_rollback()
-                LOG.error('Error writing to boinc database. boinc_create_work return value = {0}'.format(retval))
-                return
-            else:
-                py_boinc.boinc_db_transaction_commit()
+                LOG.error('Error writing {0} to boinc database. boinc_create_work return value = {1}'.format(query.wu_name, retval))
 
-        # Used to calculate the final average time spent in the boinc db
-        self._boinc_db_access_time.append(time.time() - start)
-        # Reset queue to none.
-        self._boinc_insert_queue = []
+                # The rollback lost the work units ahead of the failure, so create them again on their own
+                if index > 0:
+                    return self._create_work_batch(batch[:index])
+                return 0
+
+        py_boinc.boinc_db_transaction_commit()
+        return len(batch)
 
-    def _build_template_file(self):
+    def _build_template_file(self, check_files=True):
         """
         Build the template files we need if they don't exist
+
+        :param check_files: False if the file is known to exist
         """
-        self._template_file = '{0}/{1:=04d}/fitsed_wu_{2}.xml'.format(POGS_BOINC_PROJECT_ROOT, self._run_id, self._rounded_redshift)
-        if not os.path.isfile(self._template_file):
+        # The gzipped inputs need a template of their own, as the work units already made use the other one
+        gzip_element = ''
+        if self._gzip_inputs:
+            self._template_file = '{0}/{1:=04d}/fitsed_wu_gz_{2}.xml'.format(POGS_BOINC_PROJECT_ROOT, self._run_id, self._rounded_redshift)
+            gzip_element = '\n        <gzip/>'
+        else:
+            self._template_file = '{0}/{1:=04d}/fitsed_wu_{2}.xml'.format(POGS_BOINC_PROJECT_ROOT, self._run_id, self._rounded_redshift)
+
+        if check_files and not os.path.isfile(self._template_file):
             # Make the directory we need
             directory = '{0}/{1:=04d}'.format(POGS_BOINC_PROJECT_ROOT, self._run_id)
             if not os.path.isdir(directory):
@@ -632,10 +1029,10 @@ class Fit2Wu:
             template_file = open(self._template_file, 'wb')
             template_file.write('''<input_template>
     <file_info>
-        <number>0</number>
+        <number>0</number>{1}
     </file_info>
     <file_info>
-        <number>1</number>
+        <number>1</number>{1}
     </file_info>
     <file_info>
         <number>2</number>
@@ -691,38 +1088,38 @@ class Fit2Wu:
         </file_ref>
         <rsc_disk_bound>1000000000</rsc_disk_bound>
     </workunit>
-</input_template>'''.format(self._rounded_redshift))
+</input_template>'''.format(self._rounded_redshift, gzip_element))
             template_file.close()
 
-    def _copy_important_files(self):
+    def _copy_important_files(self, check_files=True):
         """
-        Copy the model, zlib and filter files to where we need them (if the don't exist). They are marked as no_delete so one should be all we need
+        Place the model, zlib and filter files where we need them (if the don't exist). They are marked as no_delete so one should be all we need.
+        The filter and model files are hardlinks to the copy in the model file store, as many runs share the same files.
+
+        :param check_files: False if the files are known to exist
         """
-        # Copy the filter file
+        # Place the filter file
         self._filter_file = '{0:=04d}_filters.dat'.format(self._run_id)
-        new_full_path = self._fanout_path(self._filter_file)
-        if not os.path.isfile(new_full_path):
+        if check_files:
             source = '{0}/{1:=04d}/filters.dat'.format(TEMPLATES_PATH2, self._run_id)
-            shutil.copy(source, new_full_path)
+            self._model_store.place(source, self._writer.path(self._filter_file))
 
-        # Copy the SFH model
+        # Place the SFH model
         self._sfh_model_file = '{0:=04d}_starformhist_cb07_z{1}.lbr'.format(self._run_id, self._rounded_redshift)
-        new_full_path = self._fanout_path(self._sfh_model_file)
-        if not os.path.isfile(new_full_path):
+        if check_files:
             source = '{0}/{1:=04d}/starformhist_cb07_z{2}.lbr'.format(TEMPLATES_PATH2, self._run_id, self._rounded_redshift)
-            shutil.copy(source, new_full_path)
+            self._model_store.place(source, self._writer.path(self._sfh_model_file))
 
-        # Copy the IR model
+        # Place the IR model
         self._ir_model_file = '{0:=04d}_infrared_dce08_z{1}.lbr'.format(self._run_id, self._rounded_redshift)
-        new_full_path = self._fanout_path(self._ir_model_file)
-        if not os.path.isfile(new_full_path):
+        if check_files:
             source = '{0}/{1:=04d}/infrared_dce08_z{2}.lbr'.format(TEMPLATES_PATH2, self._run_id, self._rounded_redshift)
-            shutil.copy(source, new_full_path)
+            self._model_store.place(source, self._writer.path(self._ir_model_file))
 
         # Create the zlib file
         self._zlib_file = '{0:=04d}zlib_{1}.dat'.format(self._run_id, self._rounded_redshift)
-        new_full_path = self._fanout_path(self._zlib_file)
-        if not os.path.isfile(new_full_path):
+        new_full_path = self._writer.path(self._zlib_file)
+        if check_files and not os.path.isfile(new_full_path):
             zlib_file = open(new_full_path, 'wb')
             zlib_file.write(' 1  {0}'.format(self._rounded_redshift))
             zlib_file.close()
@@ -731,148 +1128,154 @@ class Fit2Wu:
         """
         Create a area - we try to make them squares, but they aren't as the images have dead zones
         """
-        area_insert = AREA.insert()
-        pixel_result_insert = PIXEL_RESULT.insert()
+        row_band = self._pixel_cube.get_row_band(pix_y, row_height)
         pix_x = 0
         while pix_x < self._end_x:
-            max_x, pixels = self._get_pixels(pix_x, pix_y, row_height, WG_MIN_PIXELS_PER_FILE[self._min_pixels_per_file_itr])
+            max_x, pixels = row_band.get_pixels(pix_x, self._sizer.get_min_pixels(self._min_pixels_per_file_itr))
 
             if len(pixels) > 0:
                 area = Area(pix_x, pix_y, max_x, min(pix_y + row_height, self._end_y))
 
-                # Needs to be incremented before use
-                self._areaPK += 1
-                area.area_id = self._areaPK
+                if not self._area_exists(area, len(pixels)):
+                    area.area_id = self._area_ids.next_id()
 
-                # Enqueue this insert
-                self._total_areas += 1
-                self._database_insert_queue.append(
-                    area_insert.values(galaxy_id=self._galaxy_id,
-                                       top_x=area.top_x,
-                                       top_y=area.top_y,
-                                       bottom_x=area.bottom_x,
-                                       bottom_y=area.bottom_y,
-                                       area_id=self._areaPK))
-
-                for pixel in pixels:
-                    # Needs to be incremented before use
-                    self._pixelPK += 1
-                    pixel.pixel_id = self._pixelPK
-
-                    # Enqueue this insert
-                    self._total_pixels += 1
-                    self._database_insert_queue.append(
-                        pixel_result_insert.values(galaxy_id=self._galaxy_id,
-                                                   area_id=area.area_id,
-                                                   y=pixel.y,
-                                                   x=pixel.x,
-                                                   pxresult_id=self._pixelPK))
-                    self._pixel_count += 1
-
-                # Write the pixels, at this point the area has been fully created
-                self._create_output_file(area, pixels)
-                self._work_units_added += 1
-                self._pixels_processed += len(pixels)
+                    self._total_areas += 1
 
-                # We made an area, so now we increment the min_pixels_per_file value
-                # This makes it so the next area will be made to the correct size.
-                self._min_pixels_per_file_itr += 1
-                if self._min_pixels_per_file_itr >= len(WG_MIN_PIXELS_PER_FILE):
-                    self._min_pixels_per_file_itr = 0  # back to zero
+                    pixels.set_pixel_ids(self._pixel_ids.next_ids(len(pixels)))
+                    pixel_result_rows = []
+                    for pixel_id, (x, y) in zip(pixels.pixel_ids, pixels.coordinates()):
+                        pixel_result_rows.append({'galaxy_id': self._galaxy_id,
+                                                  'area_id': area.area_id,
+                                                  'y': y,
+                                                  'x': x,
+                                                  'pxresult_id': pixel_id})
 
-                # Once we've processed more pixels then the commit threshold, we commit everything to both dbs
-                if self._pixels_processed > WG_PIXEL_COMMIT_THRESHOLD:
-                    self._run_pending_db_tasks()
-                    self._run_pending_boinc_db_tasks()
-                    self._pixels_processed = 0  # reset for next areas
+                    self._total_pixels += len(pixels)
+                    self._pixel_count += len(pixels)
 
-            pix_x = max_x + 1
+                    # At this point the area has been fully created
+                    self._add_area(area, pixels, pixel_result_rows)
 
-    def _create_job_xml(self, file_name, pixels_in_file):
-        """
-        Create the job.xml file
-
-        :param file_name:
-        :param pixels_in_file:
-        """
-        new_full_path = self._fanout_path(file_name)
-        job_file = open(new_full_path, 'wb')
-        job_file.write('<job_desc>\n')
-        for i in range(1, pixels_in_file + 1):
-            job_file.write('''   <task>
-      <application>./fit_sed</application>
-      <command_line>{0} filters.dat observations.dat</command_line>
-      <stdout_filename>stdout_file</stdout_filename>
-      <stderr_filename>stderr_file</stderr_filename>
-   </task>
-'''.format(i))
-
-        job_file.write('''   <task>
-      <application>./concat</application>
-      <command_line>{0} output.fit</command_line>
-      <stdout_filename>stdout_file</stdout_filename>
-      <stderr_filename>stderr_file</stderr_filename>
-   </task>
-'''.format(pixels_in_file))
-
-        job_file.write('</job_desc>\n')
-        job_file.close()
-
-    def _create_observation_file(self, filename, data, pixels):
-        """
-        Create an observation file for the list of pixels
-        :param filename:
-        :param data:
-        :param pixels:
-        """
-        new_full_path = self._fanout_path(filename)
-        outfile = open(new_full_path, 'w')
-        outfile.write('#  {0}\n'.format(json.dumps(data)))
+                # We made an area, so now we increment the min_pixels_per_file value
+                # This makes it so the next area will be made to the correct size.
+                self._min_pixels_per_file_itr = self._sizer.next_itr(self._min_pixels_per_file_itr)
 
-        row_num = 0
-        for pixel in pixels:
-            outfile.write('pix%(id)s %(pixel_redshift)s ' % {'id': pixel.pixel_id, 'pixel_redshift': self._redshift})
-            for pixel_value in pixel.pixels:  # Should be placed here in same order as LayerOrder
-                if pixel_value.value is None or pixel_value.value <= 0:                         # added
-                    outfile.write("{0}  {1}  ".format(-1, -1))                                  # added
-                else:                                                                           # added
-                    outfile.write("{0}  {1}  ".format(pixel_value.value, pixel_value.sigma))
+            pix_x = max_x + 1
 
-            outfile.write('\n')
-            row_num += 1
-        outfile.close()
+    def _get_work_unit_name(self, area):
+        return get_work_unit_name(self._galaxy_name, area.area_id)
 
     def _create_output_file(self, area, pixels):
         """
         Write an output file for this area
         :param area:
         :param pixels:
+        :return: the PyBoincWu to create the work unit once the files are written
         """
         pixels_in_area = len(pixels)
-        work_unit_name = '%(galaxy)s_area%(area)s' % {'galaxy': self._galaxy_name, 'area': area.area_id}
+        work_unit_name = self._get_work_unit_name(area)
         LOG.info("Creating work unit %s : %d pixels", work_unit_name, pixels_in_area)
 
         file_name_job = work_unit_name + '.job.xml'
 
         # Copy files into BOINC's download hierarchy
-        data = [{'galaxy': self._galaxy_name,
-                 'run_id': self._run_id,
-                 'galaxy_id': self._galaxy_id,
-                 'area_id': area.area_id,
-                 'pixels': pixels_in_area,
-                 'top_x': area.top_x,
-                 'top_y': area.top_y,
-                 'bottom_x': area.bottom_x,
-                 'bottom_y': area.bottom_y, }]
-        self._create_observation_file(work_unit_name, data, pixels)
-        self._create_job_xml(file_name_job, pixels_in_area)
+        data = [self._get_area_details(area, pixels_in_area)]
+        self._writer.write_observation_file(work_unit_name, data, pixels, self._redshift)
+        self._writer.write_job_xml(file_name_job, pixels_in_area)
+
+        return self._get_work_unit_entry(work_unit_name,
+                                         file_name_job,
+                                         pixels_in_area,
+                                         pixels_in_area * self._cobblestone_scaling_factor,
+                                         area.area_id,
+                                         self._priority)
+
+    def create_packed_work_unit(self, parts):
+        """
+        Write one observation file holding the areas of several galaxies.
+        The galaxies must have the same pack key as this one, as the work unit uses this galaxy's model files.
 
+        :param parts: a list of (Fit2Wu, AreaJob)
+        :return: the PyBoincWu to create the work unit
+        """
+        first_area = parts[0][1].area
+        work_unit_name = get_packed_work_unit_name(parts[0][0]._galaxy_name, first_area.area_id)
+        file_name_job = work_unit_name + '.job.xml'
+
+        data = []
+        observations = []
+        pixels_in_file = 0
+        credit = 0
+        fpops_est = 0
+        galaxies = []
+        for fit2wu, job in parts:
+            pixels_in_area = len(job.pixels)
+            data.append(fit2wu._get_area_details(job.area, pixels_in_area))
+            observations.append((job.pixels, fit2wu._redshift))
+            pixels_in_file += pixels_in_area
+
+            # The credit and fpops_est of each galaxy are scaled for its own bands
+            credit += pixels_in_area * fit2wu._cobblestone_scaling_factor
+            fpops_est += pixels_in_area * fit2wu._fpops_est_per_pixel
+            if fit2wu not in galaxies:
+                galaxies.append(fit2wu)
+
+            # So the archiver knows which galaxies are waiting on this work unit
+            fit2wu._area_pack_insert_rows.append({'area_id': job.area.area_id, 'pack_area_id': first_area.area_id})
+
+        # Each galaxy in the work unit counts it once
+        for fit2wu in galaxies:
+            fit2wu._work_units_added += 1
+
+        LOG.info("Creating work unit %s : %d pixels from %d areas", work_unit_name, pixels_in_file, len(parts))
+        self._writer.write_observation_file_parts(work_unit_name, data, observations)
+        self._writer.write_job_xml(file_name_job, pixels_in_file)
+
+        # The assimilator uses the opaque value to find the first area - the rest are found from the pixels
+        return self._get_work_unit_entry(work_unit_name,
+                                         file_name_job,
+                                         pixels_in_file,
+                                         credit,
+                                         first_area.area_id,
+                                         max([fit2wu._priority for fit2wu, _ in parts]),
+                                         fpops_est)
+
+    def _get_area_details(self, area, pixels_in_area):
+        """
+        The details of an area for the header line of the observation file
+        """
+        return {'galaxy': self._galaxy_name,
+                'run_id': self._run_id,
+                'galaxy_id': self._galaxy_id,
+                'area_id': area.area_id,
+                'pixels': pixels_in_area,
+                'top_x': area.top_x,
+                'top_y': area.top_y,
+                'bottom_x': area.bottom_x,
+                'bottom_y': area.bottom_y, }
+
+    def _get_work_unit_entry(self, work_unit_name, file_name_job, pixels_in_file, credit, opaque, priority, fpops_est=None):
+        """
+        Build the PyBoincWu for a work unit whose files have been written
+
+        :param work_unit_name: the name of the work unit and its observation file
+        :param file_name_job: the name of the job.xml file
+        :param pixels_in_file: the number of pixels
+        :param credit: the credit for the work unit
+        :param opaque: the area id
+        :param priority: the priority
+        :param fpops_est: the sum of fpops_est for the pixels if they come from several galaxies, or None if they are all from this one
+        :return: the PyBoincWu
+        """
         # Work out the size class
-        size_class = len(WG_SIZE_CLASS)
-        for i in range(0, size_class):
-            if pixels_in_area <= WG_SIZE_CLASS[i]:
-                size_class = i
-                break
+        size_class = self._sizer.get_size_class(pixels_in_file, fpops_est)
+
+        if fpops_est is None:
+            rsc_fpops_est = self._fpops_est_per_pixel * pixels_in_file * 1e12
+            rsc_fpops_bound = self._fpops_est_per_pixel * FPOPS_BOUND_PER_PIXEL * pixels_in_file * 1e12
+        else:
+            rsc_fpops_est = fpops_est * 1e12
+            rsc_fpops_bound = fpops_est * FPOPS_BOUND_PER_PIXEL * 1e12
 
         # And "create work" = create the work unit
         args_files = [work_unit_name, file_name_job, self._filter_file, self._zlib_file, self._sfh_model_file, self._ir_model_file]
@@ -885,128 +1288,36 @@ class Fit2Wu:
                           wu_name=work_unit_name,
                           wu_template=self._template_file,
                           result_template=TEMPLATES_PATH1 + "/fitsed_result.xml",
-                          rsc_fpops_est=self._fpops_est_per_pixel * pixels_in_area * 1e12,
-                          rsc_fpops_bound=self._fpops_est_per_pixel * FPOPS_BOUND_PER_PIXEL * pixels_in_area * 1e12,
+                          rsc_fpops_est=rsc_fpops_est,
+                          rsc_fpops_bound=rsc_fpops_bound,
                           rsc_memory_bound=2e8,
                           rsc_disk_bound=1e9,
-                          additional_xml="<credit>%(credit).03f</credit>" % {'credit': pixels_in_area * self._cobblestone_scaling_factor},
-                          opaque=area.area_id,
-                          priority=self._priority,
+                          additional_xml="<credit>%(credit).03f</credit>" % {'credit': credit},
+                          opaque=opaque,
+                          priority=priority,
                           size_class=size_class,
                           list_input_files=args_files)
-        self._boinc_insert_queue.append(entry)
-
-    def _enough_layers(self, pixels):
-        """
-        Are there enough layers with data in them to warrant counting this pixel?
-        :param pixels:
-        """
-        uv_layers = 0
-        for layer_id in self._ultraviolet_bands.values():
-            if pixels[layer_id].value > 0:
-                uv_layers += 1
-
-        optical_layers = 0
-        for layer_id in self._optical_bands.values():
-            if pixels[layer_id].value > 0:
-                optical_layers += 1
-
-        ir_layers = 0
-        for layer_id in self._infrared_bands.values():
-            if pixels[layer_id].value > 0:
-                ir_layers += 1
-
-        if optical_layers >= 4:
-            return True
-
-        if optical_layers == 3 and (uv_layers >= 1 or ir_layers >= 1):
-            return True
-
-        # Not enough layers
-        return False
-
-    def _fanout_path(self, file_name):
-        """
-        Calculate the fanout path and create the directory
-
-        :param file_name:
-        :rtype : the string of the download directory
-        """
-        s = hashlib.md5(file_name).hexdigest()[:8]
-        x = long(s, 16)
-
-        # Create the directory if needed
-        hash_dir_name = "%s/%x" % (self._download_dir, x % self._fanout)
-        if os.path.isfile(hash_dir_name):
-            pass
-        elif os.path.isdir(hash_dir_name):
-            pass
-        else:
-            os.mkdir(hash_dir_name)
-
-        return "%s/%x/%s" % (self._download_dir, x % self._fanout, file_name)
+        return entry
 
     def _get_filters_sort_layers(self):
         """
         Get the filters we'll be using for this run
         """
-        # Build the filter tables I need
-        self._ultraviolet_bands = {}
-        self._optical_bands = {}
-        self._infrared_bands = {}
-
         # Get the filters associated with this run
-        list_filter_names = []
-        for filter_name in self._connection.execute(select([FILTER], distinct=True, from_obj=FILTER.join(RUN_FILTER)).where(RUN_FILTER.c.run_id == self._run_id).order_by(FILTER.c.eff_lambda)):
-            list_filter_names.append(filter_name)
-
-        # Count the number of filters of each type in the model
-        for filter_entry in list_filter_names:
-            if filter_entry[FILTER.c.optical] == 1:
-                self._num_optical_bands_model += 1
-
-            if filter_entry[FILTER.c.infrared] == 1:
-                self._num_infrared_bands_model += 1
-
-            if filter_entry[FILTER.c.ultraviolet] == 1:
-                self._num_ultraviolet_bands_model += 1
-
-        # The order of the filters will be there order in the fits file so record the name and its position
-        names = []
-        for layer in range(self._layer_count):
-            hdu = self._hdu_list[layer]
-            filter_name_magphysn = hdu.header['MAGPHYSN']
-            if filter_name_magphysn is None:
-                raise LookupError('The layer {0} does not have MAGPHYSN in it'.format(layer))
-            names.append(filter_name_magphysn)
-
-            found_filter = False
-            for filter_name in list_filter_names:
-                if filter_name_magphysn == filter_name[FILTER.c.name]:
-                    found_filter = True
-                    break
-
-            if not found_filter:
-                raise LookupError('The filter {0} in the fits file is not expected'.format(filter_name_magphysn))
+        list_filter_names = self._run_cache.get_run_filters(self._connection, self._run_id)
+        self._list_filter_names = list_filter_names
+
+        # The order of the filters will be there order in the fits file so record the name and its position.
+        # The preflight index has already read them from the headers.
+        if self._preflight is not None:
+            names = self._preflight.layer_names
+        else:
+            names = get_layer_names(self._hdu_list, list_filter_names)
 
         # If the fit is using a S/N ratio file check the order is correct
+        names_snr = None
         if self._signal_noise_hdu is not None:
-            names_snr = []
-            for layer in range(self._sigma_layer_count):
-                hdu = self._signal_noise_hdu[layer]
-                filter_name_magphysn = hdu.header['MAGPHYSN']
-                if filter_name_magphysn is None:
-                    raise LookupError('The layer {0} does not have MAGPHYSN in it'.format(layer))
-                names_snr.append(filter_name_magphysn)  # list of all filters that appear in the sigma file
-
-                found_filter = False
-                for filter_name in list_filter_names:
-                    if filter_name_magphysn == filter_name[FILTER.c.name]:
-                        found_filter = True
-                        break
-
-                if not found_filter:
-                    raise LookupError('The filter {0} in the fits sigma file is not expected'.format(filter_name_magphysn))
+            names_snr = get_layer_names(self._signal_noise_hdu, list_filter_names, 'fits sigma file')
 
             # No longer matters if main file and sigma have matching layers/bands.
             if len(names) == len(names_snr):
@@ -1016,45 +1327,11 @@ class Fit2Wu:
             else:
                 LOG.info('The list of bands are not the same size {0} vs {1}'.format(names, names_snr))
 
-        layers = []
-        sigma_layers = []
-        for j in range(len(list_filter_names)):
-            filter_name = list_filter_names[j]
-            found_it = False
-            for i in range(len(names)):
-                if names[i] == filter_name[FILTER.c.name]:
-                    layers.append(i)
-                    if filter_name[FILTER.c.infrared] == 1:
-                        self._infrared_bands[filter_name[FILTER.c.name]] = j
-
-                    if filter_name[FILTER.c.optical] == 1:
-                        self._optical_bands[filter_name[FILTER.c.name]] = j
-
-                    if filter_name[FILTER.c.ultraviolet] == 1:
-                        self._ultraviolet_bands[filter_name[FILTER.c.name]] = j
-                    found_it = True
-                    break
-
-            if not found_it:
-                layers.append(-1)
-
-            """
-            Search the sigma hdu for the current filter name.
-            If it does exist, then add add its id to the sigma_layer_order
-            If it does not exist, then add -1.
-            sigma_layer_order will be in the same order as layer_order, meaning if a value exists for layer_order, there will be one for sigma_layer_order
-            and both of these layers will be for the same filter. only if a sigma file exists.
-
-            """
-            if self._signal_noise_hdu is not None:
-                found_it = False
-                for i in range(len(names_snr)):
-                    if names_snr[i] == filter_name[FILTER.c.name]:
-                        sigma_layers.append(i)
-                        found_it = True
-                        break
-                if not found_it:
-                    sigma_layers.append(-1)
+        (layers,
+         sigma_layers,
+         self._ultraviolet_bands,
+         self._optical_bands,
+         self._infrared_bands) = sort_layers(list_filter_names, names, names_snr)
 
         LOG.info('Optical bands found: {0}'.format(len(self._optical_bands)))
         LOG.info('Infrared bands found: {0}'.format(len(self._infrared_bands)))
@@ -1082,100 +1359,12 @@ class Fit2Wu:
         self._layer_order = layers
         self._sigma_layer_order = sigma_layers
 
-    def _get_pixels(self, pix_x, pix_y, row_height, min_pixels_per_file):
-        """
-        Retrieves pixels from each pair of (x, y) coordinates specified in pix_x and pix_y.
-        Returns pixels only from those coordinates where there is data in more than
-        given by the enough_layers function. Pixels are retrieved in the order specified in
-        the global LAYER_ORDER list.
-        """
-        result = []
-        max_x = pix_x
-        x = pix_x
-        while x < self._end_x:
-            for y in range(pix_y, pix_y + row_height):
-                # Have we moved off the edge
-                if y >= self._end_y:
-                    continue
-
-                pixels = []
-                for layer in self._layer_order:
-                    if layer == -1:
-                        # The layer is missing
-                        pixels.append(PixelValue(0, 0))
-                    else:
-                        # A vagary of PyFits/NumPy is the order of the x & y indexes is reversed
-                        # See page 13 of the PyFITS User Guide
-                        pixel = self._hdu_list[layer].data[y, x]
-                        if math.isnan(pixel) or pixel == 0.0:
-                            # A zero tells MAGPHYS - we have no value here
-                            pixels.append(PixelValue(0, 0))
-                        else:
-                            """
-                            If there is no sigma file at all, use self._sigma.
-                            If there is a sigma file,
-                            check whether the sigma_layer_order contains the layer in the sigma that corresponds to the current layer.
-                            if there is no layer in the sigma (-1), use 10% or whatever is defined as self._sigma.
-                            """
-                            if self._signal_noise_hdu is None:  # If there is no signal to noise file, use the sigma value.
-
-                                if self._sigma is not None:
-                                    sigma = pixel * self._sigma
-                                else:  # If there is no sigma value, use 0.1
-                                    sigma = pixel * 0.1
-
-                            else:  # if we do have a signal to noise file, use it
-
-                                if self._sigma_layer_order[layer] != -1:
-                                    sigma = pixel / self._signal_noise_hdu[layer].data[y, x]
-                                else:  # If there is no value for the current layer, use 0.1
-                                    sigma = pixel * 0.1
-
-                            pixels.append(PixelValue(pixel, sigma))
-
-                if self._enough_layers(pixels):
-                    result.append(Pixel(x, y, pixels))
-
-            max_x = x
-            if len(result) >= min_pixels_per_file:
-                break
-
-            x += 1
-
-        return max_x, result
-
     def _get_rounded_redshift(self):
         """
-        Select the template for the red shift
-        """
-        if self._redshift < 0.005:
-            return '0.0000'
-        elif self._redshift < 0.015:
-            return '0.0100'
-        elif self._redshift < 0.025:
-            return '0.0200'
-        elif self._redshift < 0.035:
-            return '0.0300'
-        elif self._redshift < 0.045:
-            return '0.0400'
-        elif self._redshift < 0.055:
-            return '0.0500'
-        elif self._redshift < 0.065:
-            return '0.0600'
-        elif self._redshift < 0.075:
-            return '0.0700'
-        elif self._redshift < 0.085:
-            return '0.0800'
-        elif self._redshift < 0.095:
-            return '0.0900'
-        elif self._redshift < 0.105:
-            return '0.1000'
-        elif self._redshift < 0.115:
-            return '0.1100'
-        elif self._redshift < 0.125:
-            return '0.1200'
-        else:
-            return None
+        Select the template for the red shift from the models available to the run
+        """
+        model_index = self._run_cache.get_model_index(TEMPLATES_PATH2, self._run_id)
+        return model_index.lookup(self._redshift)
 
     def _store_fits_header(self):
         """
@@ -1230,59 +1419,13 @@ class Fit2Wu:
     def _calculate_credit(self):
         """
         Determined additional credit that a user should get depending on the
-        number of layers in the fits file
-        Originally 5 layers
+        number of layers in the fits file - see get_band_scaling
         :return:
         """
-        uv_model = 0
-        ir_model = 0
-        optic_model = 0
-
-        if self._num_ultraviolet_bands_model > 0:
-            uv_model = self._num_ultraviolet_bands_model * 0.01
-            LOG.info('+ {0} for {1} UV bands in model'.format(uv_model, self._num_ultraviolet_bands_model))
-        else:
-            LOG.info('No ultraviolet bands in model for credit scaling')
-
-        if self._num_infrared_bands_model > 0:
-            ir_model = self._num_infrared_bands_model * 0.012
-            LOG.info('+ {0} for {1} IR bands in model'.format(ir_model, self._num_infrared_bands_model))
-        else:
-            LOG.info('No infrared bands in model for credit scaling')
-
-        if self._num_optical_bands_model > 0:
-            optic_model = self._num_optical_bands_model * 0.01
-            LOG.info('+ {0} for {1} optical bands in model'.format(optic_model, self._num_optical_bands_model))
-        else:
-            LOG.info('No optical bands in model for credit scaling')
-
-        uv = 0
-        ir = 0
-        optic = 0
-
-        if len(self._ultraviolet_bands) > 0:
-            uv = len(self._ultraviolet_bands) * 0.015
-            LOG.info('+ {0} for {1} UV bands in file'.format(uv, len(self._ultraviolet_bands)))
-        else:
-            LOG.info('No ultraviolet bands in file for credit scaling')
-
-        if len(self._infrared_bands) > 0:
-            ir = len(self._infrared_bands) * 0.02
-            LOG.info('+ {0} for {1} IR bands in file'.format(ir, len(self._infrared_bands)))
-        else:
-            LOG.info('No infrared bands in file for credit scaling')
-
-        if len(self._optical_bands) > 0:
-            optic = len(self._optical_bands) * 0.015
-            LOG.info('+ {0} for {1} optical bands in file'.format(optic, len(self._optical_bands)))
-        else:
-            LOG.info('No optical bands in file for credit scaling')
-
-        sum_scales = uv + ir + optic + uv_model + ir_model + optic_model
-        total_scaling_cobblestone = 1.0 + sum_scales
-        total_scaling_fpops_est = 1.0 + (sum_scales * 0.3)
-
-        LOG.info('Total scaling cobblestone: {0} fpops_est: {1}'.format(total_scaling_cobblestone, total_scaling_fpops_est))
+        total_scaling_cobblestone, total_scaling_fpops_est = get_band_scaling(self._list_filter_names,
+                                                                              self._ultraviolet_bands,
+                                                                              self._optical_bands,
+                                                                              self._infrared_bands)
         modified_cobblestone = self._cobblestone_scaling_factor * total_scaling_cobblestone
         modified_fpops = self._fpops_est_per_pixel * total_scaling_fpops_est
 
@@ -0,0 +1,493 @@
+#
+#    Copyright (c) UWA, The University of Western Australia
+#    M468/35 Stirling Hwy
+#    Perth WA 6009
+#    Australia
+#
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Process the registrations, either one at a time or several at once in worker processes.
+
+Each worker has its own database connections. The primary keys come from ID_BLOCK so the workers
+never pick the same ids. The workers can be kept running between passes by a long running work generator.
+"""
+import math
+import multiprocessing
+import os
+import Queue
+import py_boinc
+from datetime import datetime
+from sqlalchemy.engine import create_engine
+from sqlalchemy.sql.expression import select, func
+from config import DB_LOGIN, WG_METADATA_CACHE_SECONDS, WG_PACK_MAX_PIXELS, WG_UPLOAD_THREADS
+from database.boinc_database_support_core import RESULT
+from database.database_support_core import REGISTER, REGISTER_CURSOR, REGISTER_PREFLIGHT, TAG_REGISTER
+from utils.logging_helper import config_logger
+from utils.shutdown_detection import check_stop_trigger
+from work_generation.fits2wu_mod_mkii import BoincInsertError, Fit2Wu, MIN_QUORUM
+from work_generation.packing import GalaxyPacker
+from work_generation.preflight import get_estimated_work_units
+from work_generation.run_cache import RunCache
+from work_generation.upload_queue import GalaxyUploader, delete_registration_files
+
+LOG = config_logger(__name__)
+
+# How often the parent checks the workers are still alive
+WORKER_POLL_SECONDS = 10
+
+
+class WorkGenerationStats:
+    """
+    The totals over all of the registrations processed
+    """
+    def __init__(self):
+        self.total_work_units_added = 0
+        self.total_db_time = 0
+        self.total_boinc_db_time = 0
+        self.areaave = []
+        self.areaave_boinc = []
+        self.total_areas = 0
+        self.total_pixels = 0
+
+    def add(self, result):
+        """
+        Add the result from Fit2Wu.process_file
+
+        :param result: the tuple returned by process_file or None if the registration failed
+        """
+        if result is None:
+            return
+
+        (work_units_added, pixel_count, db_time, ave, boinc_db_time, bave, areas, pixels, complete) = result
+        self.total_db_time += db_time
+        self.total_boinc_db_time += boinc_db_time
+        self.areaave.append(ave)
+        self.areaave_boinc.append(bave)
+        self.total_areas += areas
+        self.total_pixels += pixels
+
+        # One WU = MIN_QUORUM Results
+        self.total_work_units_added += (work_units_added * MIN_QUORUM)
+
+    def log(self):
+        """
+        Log the totals
+        """
+        LOG.info('Total areas added {0}, pixels added {1}'.format(self.total_areas, self.total_pixels))
+        if len(self.areaave) > 0:
+            LOG.info('Total db time: {0}'.format(self.total_db_time))
+            LOG.info('Average time per transaction: {0}'.format(sum(self.areaave) / len(self.areaave)))
+
+            LOG.info('Total BOINC db time: {0}'.format(self.total_boinc_db_time))
+            LOG.info('Average BOINC db time per transaction: {0}'.format(sum(self.areaave_boinc) / len(self.areaave_boinc)))
+
+        LOG.info('Done - added %d Results', self.total_work_units_added)
+
+
+def get_pending_count(boinc_connection, limit=None):
+    """
+    Count the results that are waiting to be sent.
+
+    The count stops at limit, so the query only reads that many entries of the server_state index
+    however long the queue is.
+
+    :param boinc_connection: the BOINC database connection
+    :param limit: stop counting at this number or None for the full count
+    :return: the number of results
+    """
+    query = select([RESULT.c.id]).where(RESULT.c.server_state.in_([1, 2]))
+    if limit is not None:
+        query = query.limit(limit)
+
+    return boinc_connection.execute(select([func.count()]).select_from(query.alias('pending'))).first()[0]
+
+
+def get_next_registration(connection, exclude_register_ids=None):
+    """
+    Get the registration to process next
+
+    :param connection: the database connection
+    :param exclude_register_ids: registrations that are being processed already
+    :return: the registration or None
+    """
+    query = select([REGISTER]).where(REGISTER.c.create_time == None)
+    if exclude_register_ids:
+        query = query.where(~REGISTER.c.register_id.in_(list(exclude_register_ids)))
+
+    return connection.execute(query.order_by(REGISTER.c.priority.desc(), REGISTER.c.register_time)).first()
+
+
+def get_small_registrations(connection, limit, exclude_register_ids=None):
+    """
+    Get the next registrations whose preflight index shows they are small enough to be packed
+
+    :param connection: the database connection
+    :param limit: the most registrations to return
+    :param exclude_register_ids: registrations that are being processed already
+    :return: a list of REGISTER rows
+    """
+    query = select([REGISTER], from_obj=REGISTER.join(REGISTER_PREFLIGHT)) \
+        .where(REGISTER.c.create_time == None) \
+        .where(REGISTER_PREFLIGHT.c.valid_pixels <= WG_PACK_MAX_PIXELS)
+    if exclude_register_ids:
+        query = query.where(~REGISTER.c.register_id.in_(list(exclude_register_ids)))
+
+    return connection.execute(query.order_by(REGISTER.c.priority.desc(), REGISTER.c.register_time).limit(limit)).fetchall()
+
+
+def is_small_registration(connection, registration):
+    """
+    Is the registration small enough to be packed with others?
+
+    :param connection: the database connection
+    :param registration: the REGISTER row
+    :return: True if the preflight index shows it has at most WG_PACK_MAX_PIXELS pixels
+    """
+    row = connection.execute(select([REGISTER_PREFLIGHT.c.valid_pixels]).where(REGISTER_PREFLIGHT.c.register_id == registration[REGISTER.c.register_id])).first()
+    return row is not None and row[0] <= WG_PACK_MAX_PIXELS
+
+
+def process_registration(connection, registration, download_dir, fanout, pipeline=False, max_work_units=None, run_cache=None, uploader=None):
+    """
+    Build the work units for a registration and mark it as done once the whole galaxy has been done
+
+    :param connection: the database connection
+    :param registration: the REGISTER row
+    :param download_dir: the BOINC download directory
+    :param fanout: the BOINC fanout
+    :param pipeline: use the writer and committer threads
+    :param max_work_units: stop after this many work units - the next run carries on from there
+    :param run_cache: the RunCache to share between registrations
+    :param uploader: the GalaxyUploader to store the files in the background or None
+    :return: the tuple from Fit2Wu.process_file or None if nothing was added
+    :raises BoincInsertError: if the work units could not be created - the registration is left for the next run
+    """
+    result = None
+
+    # As the load work unit component adds data to the data base we need autocommit on to ensure each pixel matches
+    if not _files_exist(registration):
+        _mark_registration_done(connection, registration)
+    else:
+        LOG.info('Processing {0} {1} {2}'.format(registration[REGISTER.c.galaxy_name], registration[REGISTER.c.priority], registration[REGISTER.c.register_id]))
+
+        fit2wu = Fit2Wu(
+            connection,
+            download_dir,
+            fanout,
+            pipeline=pipeline,
+            run_cache=run_cache,
+            uploader=uploader)
+        try:
+            result = fit2wu.process_file(registration, max_work_units)
+        except BoincInsertError:
+            # The areas committed so far are picked up again by the next run, so the registration is left waiting
+            LOG.exception('The work units for {0} could not be created'.format(registration[REGISTER.c.galaxy_name]))
+            raise
+        except IOError:
+            LOG.exception('An error occurred while trying to read from a fits file')
+
+            _mark_registration_done(connection, registration)
+            return None
+        except Exception:
+            LOG.exception('An error occurred while processing {0}'.format(registration[REGISTER.c.galaxy_name]))
+
+            _mark_registration_done(connection, registration)
+            return None
+
+        if not result[-1]:
+            # Either the work unit limit or the stop trigger was hit - keep the files and the tags for the next run
+            return result
+
+        # Delete the files once we are done - the uploader deletes them once they have been stored
+        if uploader is None:
+            delete_registration_files(registration)
+        _mark_registration_done(connection, registration)
+
+    connection.execute(TAG_REGISTER.delete().where(TAG_REGISTER.c.register_id == registration[REGISTER.c.register_id]))
+    return result
+
+
+def process_packed_registrations(connection, registrations, download_dir, fanout, run_cache=None, uploader=None):
+    """
+    Build the work units for several small registrations, packing their areas into shared work units
+
+    :param connection: the database connection
+    :param registrations: the REGISTER rows
+    :param download_dir: the BOINC download directory
+    :param fanout: the BOINC fanout
+    :param run_cache: the RunCache to share between registrations
+    :param uploader: the GalaxyUploader to store the files in the background or None
+    :return: a tuple like the one from Fit2Wu.process_file covering all of the registrations or None if nothing was added
+    :raises BoincInsertError: if the packed galaxies were committed but their work units could not be created -
+        the registrations are left for the next run to finish off
+    """
+    packer = GalaxyPacker(connection)
+    pixel_count = 0
+    areas = 0
+    pixels = 0
+    for registration in registrations:
+        if not _files_exist(registration):
+            _mark_registration_done(connection, registration)
+            connection.execute(TAG_REGISTER.delete().where(TAG_REGISTER.c.register_id == registration[REGISTER.c.register_id]))
+            continue
+
+        LOG.info('Packing {0} {1} {2}'.format(registration[REGISTER.c.galaxy_name], registration[REGISTER.c.priority], registration[REGISTER.c.register_id]))
+        fit2wu = Fit2Wu(connection, download_dir, fanout, run_cache=run_cache, packer=packer, uploader=uploader)
+        try:
+            (_, galaxy_pixel_count, _, _, _, _, galaxy_areas, galaxy_pixels, complete) = fit2wu.process_file(registration)
+        except Exception:
+            LOG.exception('An error occurred while processing {0}'.format(registration[REGISTER.c.galaxy_name]))
+
+            _mark_registration_done(connection, registration)
+            continue
+
+        if not complete:
+            # The stop trigger was found - the galaxy was not handed to the packer, so leave it and the rest for the next run
+            break
+
+        pixel_count += galaxy_pixel_count
+        areas += galaxy_areas
+        pixels += galaxy_pixels
+
+    packed_registrations = packer.get_registrations()
+    if len(packed_registrations) == 0:
+        return None
+
+    try:
+        work_units_added, db_time, boinc_db_time = packer.flush()
+    except BoincInsertError:
+        # The areas are committed, so the next run makes the missing work units when it carries on with the galaxies
+        LOG.exception('The work units for {0} packed galaxies could not be created'.format(len(packed_registrations)))
+        raise
+    except Exception:
+        # Nothing was committed, so the galaxies are still waiting. Do them one at a time so a bad one can't hold up the rest.
+        LOG.exception('An error occurred while packing {0} galaxies'.format(len(packed_registrations)))
+        work_units_added = 0
+        pixel_count = 0
+        db_time = 0
+        boinc_db_time = 0
+        areas = 0
+        pixels = 0
+        for registration in packed_registrations:
+            result = process_registration(connection, registration, download_dir, fanout, run_cache=run_cache, uploader=uploader)
+            if result is not None:
+                work_units_added += result[0]
+                pixel_count += result[1]
+                db_time += result[2]
+                boinc_db_time += result[4]
+                areas += result[6]
+                pixels += result[7]
+        return work_units_added, pixel_count, db_time, db_time, boinc_db_time, boinc_db_time, areas, pixels, True
+
+    for registration in packed_registrations:
+        if uploader is None:
+            delete_registration_files(registration)
+        _mark_registration_done(connection, registration)
+        connection.execute(TAG_REGISTER.delete().where(TAG_REGISTER.c.register_id == registration[REGISTER.c.register_id]))
+
+    return work_units_added, pixel_count, db_time, db_time, boinc_db_time, boinc_db_time, areas, pixels, True
+
+
+def _files_exist(registration):
+    """
+    Check the FITS files of the registration are still there
+    """
+    if not os.path.isfile(registration[REGISTER.c.filename]):
+        LOG.error('The file %s does not exist', registration[REGISTER.c.filename])
+        return False
+    if registration[REGISTER.c.sigma_filename] is not None and not os.path.isfile(registration[REGISTER.c.sigma_filename]):
+        LOG.error('The file %s does not exist', registration[REGISTER.c.sigma_filename])
+        return False
+    return True
+
+
+def _mark_registration_done(connection, registration):
+    connection.execute(REGISTER.update().where(REGISTER.c.register_id == registration[REGISTER.c.register_id]).values(create_time=datetime.now()))
+
+    # The galaxy won't be carried on again, so the cursor isn't needed
+    connection.execute(REGISTER_CURSOR.delete().where(REGISTER_CURSOR.c.register_id == registration[REGISTER.c.register_id]))
+
+
+class WorkGenerationWorkers:
+    """
+    Worker processes that are each sent one registration at a time
+    """
+    def __init__(self, workers, download_dir, fanout, pipeline):
+        """
+        Initialise the workers
+
+        :param workers: the number of worker processes
+        :param download_dir: the BOINC download directory
+        :param fanout: the BOINC fanout
+        :param pipeline: use the writer and committer threads in each worker
+        """
+        self._workers = workers
+        self._download_dir = download_dir
+        self._fanout = fanout
+        self._pipeline = pipeline
+        self._task_queue = None
+        self._result_queue = None
+        self._processes = []
+
+    def start(self):
+        """
+        Start the worker processes
+        """
+        self._task_queue = multiprocessing.Queue()
+        self._result_queue = multiprocessing.Queue()
+        self._processes = []
+        for i in range(self._workers):
+            process = multiprocessing.Process(target=_worker_loop,
+                                              name='fits2wu-worker-{0}'.format(i),
+                                              args=(self._task_queue, self._result_queue, self._download_dir, self._fanout, self._pipeline))
+            process.start()
+            self._processes.append(process)
+        LOG.info('Started {0} worker processes'.format(self._workers))
+
+    def stop(self):
+        """
+        Stop the worker processes once they have finished what they are doing
+        """
+        for _ in self._processes:
+            self._task_queue.put(None)
+        for process in self._processes:
+            process.join()
+        self._processes = []
+
+    def generate(self, connection, work_units_to_be_added, stats):
+        """
+        Process the registrations until we've added enough work units
+
+        :param connection: the database connection - only used to pick the registrations
+        :param work_units_to_be_added: stop once this many results have been added
+        :param stats: the WorkGenerationStats to add the results to
+        :return: False if a worker process died - the workers must be restarted
+        """
+        # The results we expect from the registrations being processed, taken from the preflight index
+        in_progress = {}
+        failed = set()
+        stopping = False
+        while True:
+            # Keep every worker busy, but don't start more galaxies than we need to fill the queue
+            while not stopping and len(in_progress) < self._workers and stats.total_work_units_added + sum(in_progress.values()) < work_units_to_be_added:
+                if check_stop_trigger():
+                    LOG.info('Stop trigger identified')
+                    stopping = True
+                    break
+
+                registration = get_next_registration(connection, failed.union(in_progress))
+                if registration is None:
+                    LOG.info('No registrations waiting')
+                    stopping = True
+                    break
+
+                register_id = registration[REGISTER.c.register_id]
+                estimated_work_units = get_estimated_work_units(connection, register_id)
+                LOG.info("Added %d of %d, sending %s (%s work units) to a worker",
+                         stats.total_work_units_added,
+                         work_units_to_be_added,
+                         registration[REGISTER.c.galaxy_name],
+                         'unknown' if estimated_work_units is None else estimated_work_units)
+                max_work_units = get_max_work_units(work_units_to_be_added - stats.total_work_units_added - sum(in_progress.values()))
+                in_progress[register_id] = 0 if estimated_work_units is None else min(estimated_work_units, max_work_units) * MIN_QUORUM
+                self._task_queue.put((register_id, max_work_units))
+
+            if len(in_progress) == 0:
+                return True
+
+            try:
+                register_id, result = self._result_queue.get(timeout=WORKER_POLL_SECONDS)
+            except Queue.Empty:
+                if not all([process.is_alive() for process in self._processes]):
+                    LOG.error('A worker process has died, {0} registrations may not have been finished'.format(len(in_progress)))
+                    return False
+                continue
+
+            del in_progress[register_id]
+            if result is None:
+                # A registration left waiting after an error is not tried again until the next pass
+                failed.add(register_id)
+            stats.add(result)
+
+
+def get_max_work_units(results_wanted):
+    """
+    How many work units make up the results wanted
+
+    :param results_wanted: the number of results
+    :return: the number of work units
+    """
+    return max(int(math.ceil(results_wanted / float(MIN_QUORUM))), 1)
+
+
+def _worker_loop(task_queue, result_queue, download_dir, fanout, pipeline):
+    """
+    Process the registrations sent by the parent until told to stop
+    """
+    engine = create_engine(DB_LOGIN)
+    connection = engine.connect()
+    run_cache = RunCache(WG_METADATA_CACHE_SECONDS)
+
+    # Each worker stores the files of its own galaxies
+    uploader = None
+    if WG_UPLOAD_THREADS > 0:
+        uploader = GalaxyUploader(WG_UPLOAD_THREADS)
+        uploader.start()
+
+    return_value = py_boinc.boinc_db_open()
+    if return_value != 0:
+        LOG.error('Could not open BOINC DB return code: %d', return_value)
+
+    try:
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+
+            register_id, max_work_units = task
+
+            if uploader is not None:
+                # Pick up any uploads that were lost when a work generator stopped
+                uploader.recover(connection)
+
+            if return_value != 0:
+                # Try again after an earlier failure
+                return_value = py_boinc.boinc_db_open()
+                if return_value != 0:
+                    LOG.error('Could not open BOINC DB return code: %d', return_value)
+
+            result = None
+            if return_value == 0:
+                registration = connection.execute(select([REGISTER]).where(REGISTER.c.register_id == register_id)).first()
+                try:
+                    result = process_registration(connection, registration, download_dir, fanout, pipeline, max_work_units, run_cache, uploader)
+                except BoincInsertError:
+                    # The connection may have gone, so close it and open it again for the next registration
+                    py_boinc.boinc_db_close()
+                    return_value = -1
+                except Exception:
+                    LOG.exception('An error occurred while processing registration {0}'.format(register_id))
+
+            result_queue.put((register_id, result))
+    finally:
+        if uploader is not None:
+            uploader.close()
+        if return_value == 0:
+            py_boinc.boinc_db_close()
+        connection.close()
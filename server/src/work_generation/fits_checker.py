@@ -0,0 +1,160 @@
+#
+#    Copyright (c) UWA, The University of Western Australia
+#    M468/35 Stirling Hwy
+#    Perth WA 6009
+#    Australia
+#
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Check FITS files by reading their headers - the pixel data is never read.
+
+Each file gets a summary dict that can be written out as JSON:
+  file_name - the file checked
+  layers - the number of layers (HDUs)
+  dimensions - [NAXIS1, NAXIS2, ...] of the first layer
+  filters, filter_numbers - the MAGPHYSN and MAGPHYSI of each layer, None if it is missing
+  missing_filters - the filters used by the run that are not in the file (only if the run's filters are given)
+  keywords - any other keywords asked for from the first layer
+  errors - what is wrong with the file, empty if it is fine
+"""
+import glob
+import multiprocessing
+import os
+import pyfits
+from utils.logging_helper import config_logger
+
+LOG = config_logger(__name__)
+
+
+def check_fits_file(file_name, filter_names=None, keywords=(), include_headers=False, require_filters=True):
+    """
+    Check a FITS file from its headers
+
+    :param file_name: the file
+    :param filter_names: the names of the filters used by the run, or None not to check the filters
+    :param keywords: the keywords to get from the first layer
+    :param include_headers: add every card of every layer to the summary as 'headers'
+    :param require_filters: is a layer without MAGPHYSN an error - the radial and integrated flux files use the image's filters
+    :return: the summary dict
+    """
+    summary = {'file_name': file_name,
+               'layers': 0,
+               'dimensions': [],
+               'filters': [],
+               'filter_numbers': [],
+               'missing_filters': [],
+               'keywords': {},
+               'errors': []}
+    errors = summary['errors']
+
+    try:
+        hdu_list = pyfits.open(file_name, memmap=True)
+    except Exception as e:
+        errors.append('Could not open the file: {0}'.format(e))
+        return summary
+
+    try:
+        for layer, hdu in enumerate(hdu_list):
+            # Only the header is touched, so pyfits never loads the data
+            header = hdu.header
+            dimensions = [header.get('NAXIS{0}'.format(axis)) for axis in range(1, header.get('NAXIS', 0) + 1)]
+            if layer == 0:
+                summary['dimensions'] = dimensions
+                for keyword in keywords:
+                    summary['keywords'][keyword] = header.get(keyword)
+
+            if len(dimensions) == 0:
+                errors.append('Layer {0} has no pixels'.format(layer))
+            elif dimensions != summary['dimensions']:
+                errors.append('Layer {0} is {1} not {2}'.format(layer, dimensions, summary['dimensions']))
+
+            filter_name = header.get('MAGPHYSN')
+            if filter_name is None:
+                if require_filters:
+                    errors.append('Layer {0} does not have MAGPHYSN in it'.format(layer))
+            elif filter_names is not None and filter_name not in filter_names:
+                errors.append('The filter {0} in layer {1} is not expected'.format(filter_name, layer))
+            summary['filters'].append(filter_name)
+            summary['filter_numbers'].append(header.get('MAGPHYSI'))
+
+            if include_headers:
+                summary.setdefault('headers', []).append([[keyword, str(header[keyword]), header.comments[keyword]] for keyword in header])
+
+            summary['layers'] += 1
+    except Exception as e:
+        errors.append('Could not read the headers: {0}'.format(e))
+    finally:
+        hdu_list.close()
+
+    if summary['layers'] == 0 and len(errors) == 0:
+        errors.append('The file has no layers')
+
+    if filter_names is not None:
+        summary['missing_filters'] = sorted(set(filter_names) - set(summary['filters']))
+
+    return summary
+
+
+def check_fits_files(file_names, workers=None, filter_names=None, keywords=(), include_headers=False):
+    """
+    Check several FITS files at the same time in a pool of processes
+
+    :param file_names: the files
+    :param workers: the number of processes, the number of CPUs if None
+    :param filter_names: see check_fits_file
+    :param keywords: see check_fits_file
+    :param include_headers: see check_fits_file
+    :return: a list of summary dicts in the same order as file_names
+    """
+    tasks = [(file_name, filter_names, keywords, include_headers) for file_name in file_names]
+    if workers == 1 or len(tasks) <= 1:
+        return [_check_task(task) for task in tasks]
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        return pool.map(_check_task, tasks, chunksize=max(len(tasks) // (4 * (workers or multiprocessing.cpu_count())), 1))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _check_task(task):
+    return check_fits_file(*task)
+
+
+def expand_file_names(file_name_stubs):
+    """
+    Expand the globs into a list of files
+
+    :param file_name_stubs: the file names or globs
+    :return: the files that exist and the stubs that did not match any
+    """
+    file_names = []
+    seen = set()
+    not_found = []
+    for file_name_stub in file_name_stubs:
+        matches = [file_name for file_name in sorted(glob.glob(file_name_stub)) if os.path.isfile(file_name)]
+        if len(matches) == 0:
+            not_found.append(file_name_stub)
+        for file_name in matches:
+            if file_name not in seen:
+                seen.add(file_name)
+                file_names.append(file_name)
+
+    return file_names, not_found
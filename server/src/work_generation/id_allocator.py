@@ -0,0 +1,186 @@
+#
+#    Copyright (c) UWA, The University of Western Australia
+#    M468/35 Stirling Hwy
+#    Perth WA 6009
+#    Australia
+#
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Hand out disjoint blocks of primary keys so several work generators can run at the same time.
+
+The next free id for each table is kept in ID_BLOCK. A block is reserved by moving next_id
+on in a short transaction of its own, so the ids can then be used without touching the database.
+"""
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql.expression import select, func
+from database.database_support_core import ID_BLOCK
+from utils.logging_helper import config_logger
+
+LOG = config_logger(__name__)
+
+
+class IdAllocator:
+    """
+    Reserves blocks of ids using the ID_BLOCK table
+    """
+    def __init__(self, engine):
+        """
+        Initialise the allocator
+
+        :param engine: the engine to get connections from - the reservations are committed on their own connection
+        """
+        self._engine = engine
+
+    def reserve(self, column, count):
+        """
+        Reserve count consecutive ids for the column
+
+        :param column: the primary key column, e.g. AREA.c.area_id
+        :param count: how many ids are needed
+        :return: the first id in the block
+        """
+        connection = self._engine.connect()
+        try:
+            while True:
+                transaction = connection.begin()
+                try:
+                    first_id = self._reserve(connection, column, count)
+                    transaction.commit()
+                    return first_id
+                except IntegrityError:
+                    # Another generator created the row for this table first - try again
+                    transaction.rollback()
+                except Exception:
+                    transaction.rollback()
+                    raise
+        finally:
+            connection.close()
+
+    def release(self, column, next_unused_id, end_id):
+        """
+        Give back the unused end of a block - this only works if no one has reserved a block after it
+
+        :param column: the primary key column
+        :param next_unused_id: the first id that was not used
+        :param end_id: the id after the end of the block
+        """
+        if next_unused_id < end_id:
+            connection = self._engine.connect()
+            try:
+                connection.execute(ID_BLOCK.update().where(ID_BLOCK.c.table_name == column.table.name)
+                                                    .where(ID_BLOCK.c.next_id == end_id)
+                                                    .values(next_id=next_unused_id))
+            finally:
+                connection.close()
+
+    @staticmethod
+    def _reserve(connection, column, count):
+        table_name = column.table.name
+
+        # Moving next_id on first locks the row, so no one else can read it until we commit
+        result = connection.execute(ID_BLOCK.update().where(ID_BLOCK.c.table_name == table_name).values(next_id=ID_BLOCK.c.next_id + count))
+
+        # Rows written without the allocator (or before it existed) must never be reused
+        max_id = connection.execute(select([func.max(column)])).first()[0]
+        first_id = (max_id or 0) + 1
+
+        if result.rowcount == 0:
+            LOG.info('Starting the id blocks for {0} at {1}'.format(table_name, first_id))
+            connection.execute(ID_BLOCK.insert().values(table_name=table_name, next_id=first_id + count))
+            return first_id
+
+        next_id = connection.execute(select([ID_BLOCK.c.next_id]).where(ID_BLOCK.c.table_name == table_name)).first()[0]
+        if next_id - count >= first_id:
+            return next_id - count
+
+        connection.execute(ID_BLOCK.update().where(ID_BLOCK.c.table_name == table_name).values(next_id=first_id + count))
+        return first_id
+
+
+class IdBlock:
+    """
+    Ids taken one or more at a time from blocks reserved by an IdAllocator
+    """
+    def __init__(self, allocator, column, block_size):
+        """
+        Initialise the block
+
+        :param allocator: the IdAllocator
+        :param column: the primary key column
+        :param block_size: how many ids to reserve at a time
+        """
+        self._allocator = allocator
+        self._column = column
+        self._block_size = block_size
+        self._next_id = 0
+        self._end_id = 0
+
+    def next_id(self):
+        """
+        Get the next id
+        """
+        return self.next_ids(1)
+
+    def next_ids(self, count):
+        """
+        Get count consecutive ids - a new block is reserved if there are not enough left in this one
+
+        :param count: how many ids are needed
+        :return: the first id
+        """
+        if self._next_id + count > self._end_id:
+            block_size = max(count, self._block_size)
+            first_id = self._allocator.reserve(self._column, block_size)
+
+            # If no one else has reserved a block since ours the new block carries on from it,
+            # otherwise the rest of the current block is skipped
+            if first_id != self._end_id:
+                self._next_id = first_id
+            self._end_id = first_id + block_size
+
+        first_id = self._next_id
+        self._next_id += count
+        return first_id
+
+    def resume_from(self, next_id):
+        """
+        Carry on from an earlier block - if no one else has reserved a block since it was released
+        the ids will follow on from next_id
+
+        :param next_id: the first unused id of the earlier block
+        """
+        self._next_id = next_id
+        self._end_id = next_id
+
+    def next_unused_id(self):
+        """
+        Get the id that would be handed out next
+
+        :return: the id or None if no block has been reserved
+        """
+        if self._end_id == 0:
+            return None
+        return self._next_id
+
+    def release(self):
+        """
+        Give back the unused ids at the end of the current block
+        """
+        self._allocator.release(self._column, self._next_id, self._end_id)
+        self._next_id = self._end_id
@@ -0,0 +1,121 @@
+#
+#    Copyright (c) UWA, The University of Western Australia
+#    M468/35 Stirling Hwy
+#    Perth WA 6009
+#    Australia
+#
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Find the models to use for a redshift.
+
+Each run directory holds the starformhist_cb07_z*.lbr and infrared_dce08_z*.lbr models for the
+redshifts it supports. A model covers the redshifts within MODEL_HALF_WIDTH of its own, so the index
+is the sorted list of those bins and a lookup is a bisect.
+"""
+import bisect
+import os
+import re
+import numpy
+
+TEMPLATES_PATH2 = '/home/ec2-user/boinc-magphys/server/runs'           # Where the Server file & model files are
+
+SFH_MODEL = re.compile(r'^starformhist_cb07_z(\d+\.\d+)\.lbr$')
+IR_MODEL = 'infrared_dce08_z{0}.lbr'
+
+# The models are 0.01 apart, so each one is used for the redshifts up to halfway to the next
+MODEL_HALF_WIDTH = 0.005
+
+
+def get_run_directory(templates_path, run_id):
+    """
+    Get the directory holding the files for a run
+
+    :param templates_path: where the run directories are
+    :param run_id: the run
+    :return: the directory
+    """
+    return '{0}/{1:=04d}'.format(templates_path, run_id)
+
+
+def build_model_index(run_directory):
+    """
+    Build the index from the model files in a run directory. A redshift is only listed if both of its models are there.
+
+    :param run_directory: the run directory
+    :return: the ModelIndex
+    """
+    rounded_redshifts = []
+    if os.path.isdir(run_directory):
+        file_names = set(os.listdir(run_directory))
+        for file_name in file_names:
+            match = SFH_MODEL.match(file_name)
+            if match is not None and IR_MODEL.format(match.group(1)) in file_names:
+                rounded_redshifts.append(match.group(1))
+
+    return ModelIndex(rounded_redshifts)
+
+
+class ModelIndex:
+    """
+    The redshifts of the models available to a run
+    """
+    def __init__(self, rounded_redshifts):
+        """
+        Initialise the index
+
+        :param rounded_redshifts: the redshifts as they appear in the model file names, e.g. '0.0200'
+        """
+        self._rounded_redshifts = sorted(rounded_redshifts, key=float)
+
+        # Rounded so the edges are the same floats as the literals, 0.015 rather than 0.01 + 0.005
+        self._lower = [round(float(rounded_redshift) - MODEL_HALF_WIDTH, 6) for rounded_redshift in self._rounded_redshifts]
+        self._upper = [round(float(rounded_redshift) + MODEL_HALF_WIDTH, 6) for rounded_redshift in self._rounded_redshifts]
+
+    def __len__(self):
+        return len(self._rounded_redshifts)
+
+    def lookup(self, redshift):
+        """
+        Select the models for the redshift. Blue shifted galaxies use the models for a redshift of zero.
+
+        :param redshift: the redshift of the galaxy
+        :return: the rounded redshift used in the model file names or None if there are no models for it
+        """
+        redshift = max(float(redshift), 0.0)
+        index = bisect.bisect_right(self._lower, redshift) - 1
+        if index < 0 or redshift >= self._upper[index]:
+            return None
+        return self._rounded_redshifts[index]
+
+    def lookup_many(self, redshifts):
+        """
+        Select the models for many redshifts at once - see lookup
+
+        :param redshifts: a sequence of redshifts
+        :return: a list of the rounded redshifts, with None where there are no models
+        """
+        if len(self._rounded_redshifts) == 0:
+            return [None] * len(redshifts)
+
+        redshifts = numpy.maximum(numpy.asarray(redshifts, dtype=float), 0.0)
+        indexes = numpy.searchsorted(self._lower, redshifts, side='right') - 1
+        clipped = numpy.clip(indexes, 0, len(self._upper) - 1)
+        found = (indexes >= 0) & (redshifts < numpy.asarray(self._upper)[clipped])
+
+        return [self._rounded_redshifts[index] if ok else None for index, ok in zip(clipped.tolist(), found.tolist())]
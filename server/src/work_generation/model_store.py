@@ -0,0 +1,202 @@
+#
+#    Copyright (c) UWA, The University of Western Australia
+#    M468/35 Stirling Hwy
+#    Perth WA 6009
+#    Australia
+#
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+A content addressed store for the filter and model files sent with the work units.
+
+Every run has its own copy of filters.dat and the .lbr model files, but most runs use the same
+models. The store below the download directory holds one copy of each file, named by its checksum,
+and the files in the fanout directories are hardlinks to it. What has been placed is remembered,
+so once a file is in place looking for it again only costs a stat. A file that has been deleted
+since, by the file_deleter or by hand, is placed again.
+"""
+import errno
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from utils.logging_helper import config_logger
+
+LOG = config_logger(__name__)
+
+# The model files are kept in here, below the download directory so they can be hardlinked
+MODEL_FILE_STORE = 'model_files'
+
+# How much of a file is read at a time when it is checksummed
+CHECKSUM_BLOCK_SIZE = 1024 * 1024
+
+_STORES = {}
+_STORES_LOCK = threading.Lock()
+
+
+def get_model_file_store(download_dir):
+    """
+    Get the store for the download directory - it is kept so the files placed for earlier galaxies are remembered
+
+    :param download_dir: the BOINC download directory
+    :return: the ModelFileStore
+    """
+    with _STORES_LOCK:
+        store = _STORES.get(download_dir)
+        if store is None:
+            store = ModelFileStore(download_dir)
+            _STORES[download_dir] = store
+        return store
+
+
+def checksum_file(file_name):
+    """
+    Work out the MD5 checksum of a file
+
+    :param file_name: the file
+    :return: the checksum as a hex string
+    """
+    md5 = hashlib.md5()
+    with open(file_name, 'rb') as source:
+        while True:
+            block = source.read(CHECKSUM_BLOCK_SIZE)
+            if not block:
+                break
+            md5.update(block)
+    return md5.hexdigest()
+
+
+class ModelFileStore:
+    """
+    Places the filter and model files into the download hierarchy as hardlinks to one copy of each
+    """
+    def __init__(self, download_dir):
+        """
+        Initialise the store
+
+        :param download_dir: the BOINC download directory
+        """
+        self._store_dir = os.path.join(download_dir, MODEL_FILE_STORE)
+        self._checksums = {}
+        self._stored = set()
+        self._placed = set()
+        self._can_link = True
+        self._bytes_saved = 0
+        self._lock = threading.Lock()
+
+    def place(self, source, destination):
+        """
+        Put the file into the download hierarchy, unless it is there already
+
+        :param source: the file in the templates directory
+        :param destination: the full path of the file in the download hierarchy
+        :return: True if the file had to be placed
+        """
+        if destination in self._placed and os.path.isfile(destination):
+            return False
+
+        with self._lock:
+            # The file may have been deleted since it was placed
+            self._placed.discard(destination)
+
+            # The file may have been placed by another work generator, or before the store was used
+            if os.path.isfile(destination):
+                self._placed.add(destination)
+                return False
+
+            stored_file, size = self._get_stored_file(source)
+            if self._can_link:
+                try:
+                    self._link(stored_file, destination)
+                except OSError as e:
+                    if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                        raise
+                    LOG.warning('Unable to hardlink the model files, they will be copied in full: {0}'.format(e))
+                    self._can_link = False
+
+            if self._can_link:
+                # The store holds one link, so any more than two means a copy has been saved
+                if os.stat(stored_file).st_nlink > 2:
+                    self._bytes_saved += size
+                    LOG.info('Linked {0} to the stored copy of {1}, {2} bytes saved so far'.format(destination, source, self._bytes_saved))
+            else:
+                shutil.copy(source, destination)
+
+            self._placed.add(destination)
+            return True
+
+    def bytes_saved(self):
+        """
+        How much disk space has been saved by linking rather than copying?
+
+        :return: the number of bytes
+        """
+        return self._bytes_saved
+
+    def _get_stored_file(self, source):
+        """
+        Get the file in the store with the same contents as the source, adding it if need be
+
+        :return: the stored file and its size
+        """
+        stat = os.stat(source)
+        key = (source, stat.st_size, stat.st_mtime)
+        checksum = self._checksums.get(key)
+        if checksum is None:
+            checksum = checksum_file(source)
+            self._checksums[key] = checksum
+
+        stored_file = os.path.join(self._store_dir, checksum + os.path.splitext(source)[1])
+        if stored_file not in self._stored or not os.path.isfile(stored_file):
+            if not os.path.isfile(stored_file):
+                self._make_directory(self._store_dir)
+
+                # Copy it somewhere else first so another work generator never links to half a file
+                handle, temp_file = tempfile.mkstemp(dir=self._store_dir)
+                os.close(handle)
+                shutil.copyfile(source, temp_file)
+                os.chmod(temp_file, 0644)
+                os.rename(temp_file, stored_file)
+
+            self._stored.add(stored_file)
+
+        return stored_file, stat.st_size
+
+    @staticmethod
+    def _link(source, target):
+        try:
+            os.link(source, target)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+            # Another work generator has just placed it
+            if not os.path.isfile(target):
+                raise
+
+    @staticmethod
+    def _make_directory(directory):
+        if os.path.exists(directory):
+            return
+        try:
+            os.mkdir(directory)
+        except OSError:
+            # Another work generator may have just created it
+            if not os.path.isdir(directory):
+                raise
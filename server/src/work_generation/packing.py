@@ -0,0 +1,141 @@
+#
+#    Copyright (c) UWA, The University of Western Australia
+#    M468/35 Stirling Hwy
+#    Perth WA 6009
+#    Australia
+#
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Pack the areas of small galaxies into shared work units.
+
+A galaxy with only a few pixels would otherwise make a handful of tiny work units. The galaxies using
+the same run and rounded redshift have the same model files, so their areas can go into one observation
+file. Every pixel row keeps its own pxresult_id, so the assimilator can still find the galaxy and area.
+"""
+import time
+from collections import OrderedDict
+from database.database_support_core import REGISTER
+from work_generation.fits2wu_mod_mkii import BoincInsertError
+from utils.logging_helper import config_logger
+
+LOG = config_logger(__name__)
+
+
+class GalaxyPacker:
+    """
+    Collects the areas of several galaxies and then writes, commits and creates the work units in one go
+    """
+    def __init__(self, connection):
+        """
+        Initialise the packer
+
+        :param connection: the database connection shared by the Fit2Wu objects
+        """
+        self._connection = connection
+        self._galaxies = []
+
+    def add(self, fit2wu, registration):
+        """
+        Called by Fit2Wu.process_file once it has built the areas of a galaxy
+
+        :param fit2wu: the Fit2Wu holding the areas
+        :param registration: the REGISTER row
+        """
+        self._galaxies.append((fit2wu, registration))
+
+    def get_registrations(self):
+        """
+        :return: the registrations that have been added
+        """
+        return [registration for _, registration in self._galaxies]
+
+    def flush(self):
+        """
+        Write the packed work units, commit the rows of every galaxy in one transaction,
+        create the work units and then finish off each galaxy
+
+        :return: the number of work units added, the time in the database and the time in the BOINC database
+        :raises BoincInsertError: if the rows were committed but the work units were not created.
+            Any other exception means nothing was committed.
+        """
+        if len(self._galaxies) == 0:
+            return 0, 0, 0
+
+        # Only galaxies with the same model files can share a work unit
+        groups = OrderedDict()
+        for fit2wu, _ in self._galaxies:
+            groups.setdefault(fit2wu.get_pack_key(), []).append(fit2wu)
+
+        entries = []
+        for (run_id, rounded_redshift, _), members in groups.items():
+            builder = members[0]
+            parts = []
+            pixels_in_pack = 0
+            for fit2wu in members:
+                for job in fit2wu.get_packed_jobs():
+                    # Areas are never split, so a pixel stays in the area it was given
+                    parts.append((fit2wu, job))
+                    pixels_in_pack += len(job.pixels)
+                    if pixels_in_pack >= builder.get_pack_size(len(entries)):
+                        entries.append(builder.create_packed_work_unit(parts))
+                        parts = []
+                        pixels_in_pack = 0
+
+            if len(parts) > 0:
+                entries.append(builder.create_packed_work_unit(parts))
+
+            LOG.info('Packed {0} galaxies for run {1} at redshift {2}'.format(len(members), run_id, rounded_redshift))
+
+        # The work units of areas an earlier run committed without getting them into the BOINC database
+        for fit2wu, _ in self._galaxies:
+            entries.extend(fit2wu.take_pending_work_units())
+
+        # Either every galaxy goes in or none of them do - the next pass will try them again
+        start = time.time()
+        transaction = self._connection.begin()
+        try:
+            for fit2wu, _ in self._galaxies:
+                fit2wu.execute_pending_db_tasks()
+            transaction.commit()
+        except Exception:
+            LOG.error('Error inserting the packed galaxies into the database')
+            transaction.rollback()
+            raise
+        db_time = time.time() - start
+
+        # From here on the areas are committed, so any failure must leave the galaxies for the next run to finish off
+        boinc_db_time = 0
+        if len(entries) > 0:
+            try:
+                boinc_db_time = self._galaxies[0][0].create_work_units(entries)
+            except BoincInsertError:
+                raise
+            except Exception:
+                LOG.exception('Error creating the packed work units')
+                raise BoincInsertError('The packed galaxies were committed, but their work units could not be created')
+
+        # The work units exist now, so a failure here must not stop the other galaxies being finished
+        for fit2wu, registration in self._galaxies:
+            try:
+                fit2wu.finish_galaxy(registration)
+            except Exception:
+                LOG.exception('An error occurred while finishing {0}'.format(registration[REGISTER.c.galaxy_name]))
+
+        LOG.info('Created {0} work units for {1} galaxies'.format(len(entries), len(self._galaxies)))
+        return len(entries), db_time, boinc_db_time
@@ -0,0 +1,169 @@
+#
+#    Copyright (c) UWA, The University of Western Australia
+#    M468/35 Stirling Hwy
+#    Perth WA 6009
+#    Australia
+#
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+A producer/consumer pipeline for the work generator.
+
+The planner (the calling thread) puts areas into a bounded queue, a pool of writer threads
+writes the files for each area and a single committer thread owns the database connections.
+"""
+import Queue
+import threading
+from utils.logging_helper import config_logger
+
+LOG = config_logger(__name__)
+
+# How often a blocked thread checks if the pipeline has failed
+QUEUE_POLL_SECONDS = 1.0
+
+# Put on the queues to tell the threads there is no more work
+_END = object()
+
+
+class WorkGenerationPipeline:
+    """
+    Planner -> writer threads -> committer thread, with bounded queues between them for backpressure
+    """
+    def __init__(self, write_function, commit_function, writer_threads, queue_size):
+        """
+        Initialise the pipeline
+
+        :param write_function: called by a writer thread with each job
+        :param commit_function: called by the committer thread with each job once it has been written
+        :param writer_threads: the number of writer threads
+        :param queue_size: the maximum number of jobs waiting between each stage
+        """
+        self._write_function = write_function
+        self._commit_function = commit_function
+        self._writer_threads = max(writer_threads, 1)
+        self._queue_size = queue_size
+        self._write_queue = None
+        self._commit_queue = None
+        self._failed = threading.Event()
+        self._errors = []
+        self._writers = []
+        self._committer = None
+
+    def start(self):
+        """
+        Start the writer and committer threads. The pipeline can be started again once it has been closed.
+        """
+        self._write_queue = Queue.Queue(self._queue_size)
+        self._commit_queue = Queue.Queue(self._queue_size)
+        self._failed.clear()
+        self._errors = []
+        self._writers = []
+        for i in range(self._writer_threads):
+            self._writers.append(threading.Thread(target=self._write_loop, name='wg-writer-{0}'.format(i)))
+        self._committer = threading.Thread(target=self._commit_loop, name='wg-committer')
+
+        LOG.info('Starting the pipeline with {0} writer threads'.format(len(self._writers)))
+        for writer in self._writers:
+            writer.start()
+        self._committer.start()
+
+    def put(self, job):
+        """
+        Queue a job for writing. Blocks while the writers are behind.
+
+        :param job: the job
+        :return: False if the pipeline has failed and the job was not queued
+        """
+        while not self._failed.is_set():
+            try:
+                self._write_queue.put(job, timeout=QUEUE_POLL_SECONDS)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def failed(self):
+        """
+        Has one of the threads failed?
+        """
+        return self._failed.is_set()
+
+    def abort(self):
+        """
+        Stop doing any more work - the queued jobs are thrown away
+        """
+        self._failed.set()
+
+    def close(self):
+        """
+        Wait for the queued jobs to be written and committed, then stop the threads.
+        Any exception raised by a writer or the committer is raised again here.
+        """
+        self.join()
+        if len(self._errors) > 0:
+            raise self._errors[0]
+
+    def join(self):
+        """
+        Wait for the threads to stop without raising their errors - used when the caller is already handling an exception
+        """
+        for _ in self._writers:
+            self._write_queue.put(_END)
+        for writer in self._writers:
+            writer.join()
+        if self._committer is not None:
+            self._committer.join()
+        self._writers = []
+        self._committer = None
+
+    def _fail(self, error):
+        LOG.exception('The work generation pipeline has failed')
+        self._errors.append(error)
+        self._failed.set()
+
+    def _write_loop(self):
+        while True:
+            job = self._write_queue.get()
+            if job is _END:
+                break
+
+            # Keep emptying the queue after a failure so nothing blocks
+            if self._failed.is_set():
+                continue
+
+            try:
+                self._write_function(job)
+            except Exception as e:
+                self._fail(e)
+                continue
+
+            self._commit_queue.put(job)
+
+        self._commit_queue.put(_END)
+
+    def _commit_loop(self):
+        writers_running = len(self._writers)
+        while writers_running > 0:
+            job = self._commit_queue.get()
+            if job is _END:
+                writers_running -= 1
+            elif not self._failed.is_set():
+                try:
+                    self._commit_function(job)
+                except Exception as e:
+                    self._fail(e)
@@ -0,0 +1,371 @@
+#
+#    Copyright (c) UWA, The University of Western Australia
+#    M468/35 Stirling Hwy
+#    Perth WA 6009
+#    Australia
+#
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Array based extraction of the pixels from a FITS cube.
+
+The layers are read a band of rows at a time and the values, sigmas and the
+"enough layers" test are worked out with NumPy rather than pixel by pixel.
+"""
+import numpy
+
+# The minimum number of bands with data for a pixel to be worth processing
+MIN_OPTICAL_BANDS = 4
+MIN_OPTICAL_BANDS_WITH_UV_OR_IR = 3
+
+
+class PixelValue:
+    """
+    The pixel value
+    """
+    def __init__(self, value, sigma):
+        self.value = value
+        self.sigma = sigma
+
+    def __str__(self):
+        return 'Value: {0}, Sigma: {1}'.format(self.value, self.sigma)
+
+
+class Pixel:
+    """
+    A pixel
+    """
+    def __init__(self, x, y, pixels):
+        self.x = x
+        self.y = y
+        self.pixels = pixels
+        self.pixel_id = None
+
+
+class PixelBlock:
+    """
+    The pixels in an area held as arrays rather than a list of Pixel objects.
+
+    values and sigmas have one entry per filter (in layer order). The entry is None if the
+    layer is missing from the FITS file.
+    """
+    def __init__(self, x, y, values, sigmas):
+        self.x = x
+        self.y = y
+        self.values = values
+        self.sigmas = sigmas
+        self.pixel_ids = None
+
+    def __len__(self):
+        return len(self.x)
+
+    def __iter__(self):
+        """
+        Iterate over the block one Pixel at a time - used when the observation file is written
+        """
+        for index in range(len(self.x)):
+            pixel_values = []
+            for values, sigmas in zip(self.values, self.sigmas):
+                if values is None:
+                    pixel_values.append(PixelValue(0, 0))
+                else:
+                    pixel_values.append(PixelValue(values[index], sigmas[index]))
+
+            pixel = Pixel(int(self.x[index]), int(self.y[index]), pixel_values)
+            if self.pixel_ids is not None:
+                pixel.pixel_id = self.pixel_ids[index]
+            yield pixel
+
+    def set_pixel_ids(self, first_pixel_id):
+        """
+        Number the pixels consecutively
+
+        :param first_pixel_id: the id of the first pixel
+        """
+        self.pixel_ids = range(first_pixel_id, first_pixel_id + len(self.x))
+
+    def slice(self, start, end):
+        """
+        Get some of the pixels as a block of their own - the arrays are views, not copies
+
+        :param start: the index of the first pixel
+        :param end: the index after the last pixel
+        :return: the PixelBlock
+        """
+        values = []
+        sigmas = []
+        for band_values, band_sigmas in zip(self.values, self.sigmas):
+            if band_values is None:
+                values.append(None)
+                sigmas.append(None)
+            else:
+                values.append(band_values[start:end])
+                sigmas.append(band_sigmas[start:end])
+
+        return PixelBlock(self.x[start:end], self.y[start:end], values, sigmas)
+
+    def coordinates(self):
+        """
+        Get the x and y values as python ints - the database drivers do not like numpy types
+
+        :return: a list of (x, y) tuples
+        """
+        return zip(self.x.tolist(), self.y.tolist())
+
+
+class RowBand:
+    """
+    A band of rows from the cube with the values, sigmas and valid mask worked out
+    """
+    def __init__(self, pix_y, values, sigmas, valid):
+        self.pix_y = pix_y
+        self.values = values
+        self.sigmas = sigmas
+        self.valid = valid
+        self.end_x = valid.shape[1]
+
+        # The running total of the valid pixels in each column lets us find the end of an area without a loop
+        self._cumulative = numpy.cumsum(valid.sum(axis=0))
+
+    def get_area_end(self, pix_x, min_pixels_per_file):
+        """
+        Find where an area starting at pix_x ends. Whole columns are taken until there are at least
+        min_pixels_per_file pixels or we run off the edge of the image.
+
+        :param pix_x: the first column
+        :param min_pixels_per_file: the number of pixels wanted
+        :return: the last column used and the number of pixels in the area
+        """
+        if pix_x > 0:
+            already_used = self._cumulative[pix_x - 1]
+        else:
+            already_used = 0
+
+        offset = numpy.searchsorted(self._cumulative[pix_x:], already_used + min_pixels_per_file)
+        max_x = min(pix_x + int(offset), self.end_x - 1)
+        return max_x, int(self._cumulative[max_x] - already_used)
+
+    def get_pixels(self, pix_x, min_pixels_per_file):
+        """
+        Get the pixels from pix_x onwards - see get_area_end
+
+        :param pix_x: the first column
+        :param min_pixels_per_file: the number of pixels wanted
+        :return: the last column used and a PixelBlock of the pixels in column order
+        """
+        max_x, _ = self.get_area_end(pix_x, min_pixels_per_file)
+        return max_x, self.get_columns(pix_x, max_x)
+
+    def get_columns(self, pix_x, max_x):
+        """
+        Get the valid pixels in the columns pix_x to max_x
+
+        :param pix_x: the first column
+        :param max_x: the last column
+        :return: a PixelBlock of the pixels in column order
+        """
+        # Transposing gives us the pixels column by column - the same order as the original scan
+        x_index, y_index = numpy.nonzero(self.valid[:, pix_x:max_x + 1].T)
+        x_index += pix_x
+
+        values = []
+        sigmas = []
+        for band_values, band_sigmas in zip(self.values, self.sigmas):
+            if band_values is None:
+                values.append(None)
+                sigmas.append(None)
+            else:
+                values.append(band_values[y_index, x_index])
+                sigmas.append(band_sigmas[y_index, x_index])
+
+        return PixelBlock(x_index, y_index + self.pix_y, values, sigmas)
+
+
+class PixelCube:
+    """
+    The layers of a FITS file (and its S/N ratio file) in the order the filters are used by MAGPHYS
+    """
+    def __init__(self, hdu_list, signal_noise_hdu, layer_order, sigma_layer_order, sigma, ultraviolet_bands, optical_bands, infrared_bands, valid_mask=None):
+        """
+        Initialise the cube
+
+        :param hdu_list: the FITS file
+        :param signal_noise_hdu: the S/N ratio FITS file or None
+        :param layer_order: the layer in the FITS file for each filter, -1 if it is missing
+        :param sigma_layer_order: the layer in the S/N ratio file for each filter, -1 if it is missing
+        :param sigma: the sigma to use if there is no S/N ratio file
+        :param ultraviolet_bands: map of filter name to the position in layer_order
+        :param optical_bands: map of filter name to the position in layer_order
+        :param infrared_bands: map of filter name to the position in layer_order
+        :param valid_mask: the pixels with enough layers from the preflight index or None to work them out
+        """
+        self._hdu_list = hdu_list
+        self._signal_noise_hdu = signal_noise_hdu
+        self._layer_order = layer_order
+        self._sigma_layer_order = sigma_layer_order
+        self._sigma = sigma
+        self._ultraviolet_bands = ultraviolet_bands.values()
+        self._optical_bands = optical_bands.values()
+        self._infrared_bands = infrared_bands.values()
+        self._valid_mask = valid_mask
+
+        # The radial and integrated flux files only have one column of pixels
+        shape = hdu_list[0].data.shape
+        self.end_y = shape[0]
+        self.end_x = shape[1] if len(shape) > 1 else 1
+
+    def get_row_band(self, pix_y, row_height):
+        """
+        Read the rows pix_y to pix_y + row_height from every layer
+
+        :param pix_y: the first row
+        :param row_height: the number of rows
+        :return: the RowBand
+        """
+        end_y = min(pix_y + row_height, self.end_y)
+        valid = None
+        if self._valid_mask is not None:
+            valid = self._valid_mask[pix_y:end_y]
+            if not valid.any():
+                # Nothing to read - there are no pixels in these rows
+                return RowBand(pix_y, [None] * len(self._layer_order), [None] * len(self._layer_order), valid)
+
+        values = []
+        sigmas = []
+        for layer in self._layer_order:
+            if layer == -1:
+                # The layer is missing
+                values.append(None)
+                sigmas.append(None)
+            else:
+                band_values, band_sigmas = self._get_values_and_sigmas(layer, pix_y, end_y)
+                values.append(band_values)
+                sigmas.append(band_sigmas)
+
+        if valid is None:
+            valid = self._enough_layers(values, end_y - pix_y)
+        return RowBand(pix_y, values, sigmas, valid)
+
+    def get_column(self, x):
+        """
+        Read every pixel from a file with a single column of pixels, such as the radial or
+        integrated flux files. All of the pixels are returned - there is no "enough layers" test.
+
+        :param x: the x value to give the pixels
+        :return: a PixelBlock of the pixels in row order
+        """
+        values = []
+        sigmas = []
+        for layer in self._layer_order:
+            if layer == -1:
+                # The layer is missing
+                values.append(None)
+                sigmas.append(None)
+            else:
+                band_values, band_sigmas = self._get_values_and_sigmas(layer, 0, self.end_y)
+                values.append(band_values)
+                sigmas.append(band_sigmas)
+
+        return PixelBlock(numpy.full(self.end_y, x, dtype=int), numpy.arange(self.end_y), values, sigmas)
+
+    def valid_mask(self, row_height=256):
+        """
+        Build the mask of the pixels with enough layers for the whole image
+
+        :param row_height: how many rows to read at a time
+        :return: a boolean array the same shape as the image
+        """
+        mask = numpy.zeros((self.end_y, self.end_x), dtype=bool)
+        for pix_y in range(0, self.end_y, row_height):
+            # The sigmas are not needed to work out which pixels are valid
+            end_y = min(pix_y + row_height, self.end_y)
+            values = []
+            for layer in self._layer_order:
+                if layer == -1:
+                    values.append(None)
+                else:
+                    values.append(self._get_values(layer, pix_y, end_y))
+
+            mask[pix_y:end_y] = self._enough_layers(values, end_y - pix_y)
+
+        return mask
+
+    def _get_values(self, layer, start_y, end_y):
+        """
+        Get the values for one layer with the missing values set to zero
+        """
+        data = self._hdu_list[layer].data[start_y:end_y]
+        with numpy.errstate(invalid='ignore'):
+            return numpy.where(numpy.isnan(data), 0, data)
+
+    def _get_values_and_sigmas(self, layer, start_y, end_y):
+        """
+        Get the values and sigmas for one layer.
+
+        The arithmetic is done in the type a single pixel would produce, so the values written
+        to the observation file are identical to those from the pixel by pixel code.
+        """
+        data = self._hdu_list[layer].data[start_y:end_y]
+
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            # A zero tells MAGPHYS - we have no value here
+            present = ~(numpy.isnan(data) | (data == 0.0))
+
+            if self._signal_noise_hdu is None:
+                # If there is no signal to noise file, use the sigma value or 0.1 if there is none
+                sigma_factor = self._sigma if self._sigma is not None else 0.1
+                sigma_type = type(data.dtype.type(1) * sigma_factor)
+                sigmas = data.astype(sigma_type) * sigma_factor
+
+            elif self._sigma_layer_order[layer] != -1:
+                signal_noise = self._signal_noise_hdu[layer].data[start_y:end_y]
+                sigma_type = type(data.dtype.type(1) / signal_noise.dtype.type(1))
+                sigmas = data.astype(sigma_type) / signal_noise.astype(sigma_type)
+
+            else:
+                # If there is no value for the current layer, use 0.1
+                sigma_type = type(data.dtype.type(1) * 0.1)
+                sigmas = data.astype(sigma_type) * 0.1
+
+        return numpy.where(present, data, 0), numpy.where(present, sigmas, 0)
+
+    def _enough_layers(self, values, height):
+        """
+        Are there enough layers with data in them to warrant counting each pixel?
+
+        :param values: the values for each filter
+        :param height: the number of rows
+        :return: a boolean array
+        """
+        uv_layers = self._count_layers(values, self._ultraviolet_bands, height)
+        optical_layers = self._count_layers(values, self._optical_bands, height)
+        ir_layers = self._count_layers(values, self._infrared_bands, height)
+
+        return (optical_layers >= MIN_OPTICAL_BANDS) | \
+               ((optical_layers == MIN_OPTICAL_BANDS_WITH_UV_OR_IR) & ((uv_layers >= 1) | (ir_layers >= 1)))
+
+    def _count_layers(self, values, band_indexes, height):
+        """
+        Count how many of the bands have a value greater than zero
+        """
+        count = numpy.zeros((height, self.end_x), dtype=numpy.int16)
+        with numpy.errstate(invalid='ignore'):
+            for index in band_indexes:
+                count += values[index] > 0
+
+        return count
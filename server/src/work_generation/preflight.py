@@ -0,0 +1,205 @@
+#
+#    Copyright (c) UWA, The University of Western Australia
+#    M468/35 Stirling Hwy
+#    Perth WA 6009
+#    Australia
+#
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+The preflight index built when a galaxy is registered.
+
+The FITS cube is read once at registration to work out the layer order, which pixels have
+enough layers to be processed and how many work units the galaxy will make. This is stored in
+REGISTER_PREFLIGHT so the work generator can plan without opening the (very large) FITS files.
+"""
+import json
+import math
+import zlib
+import numpy
+import pyfits
+from datetime import datetime
+from sqlalchemy.sql.expression import select
+from config import RADIAL_AREA_SIZE
+from database.database_support_core import RUN, REGISTER_PREFLIGHT
+from utils.logging_helper import config_logger
+from work_generation.filter_layers import get_band_scaling, get_run_filters, get_layer_names, sort_layers
+from work_generation.pixel_cube import PixelCube, RowBand
+from work_generation.wu_sizing import WorkUnitSizer
+
+LOG = config_logger(__name__)
+
+
+class Preflight:
+    """
+    The preflight index for a registration
+    """
+    def __init__(self, layer_names, layer_order, valid_mask, estimated_work_units, estimated_fpops):
+        """
+        Initialise the index
+
+        :param layer_names: the MAGPHYSN names of the layers in the FITS file
+        :param layer_order: the layer in the FITS file for each of the run's filters, -1 if it is missing
+        :param valid_mask: a boolean array the size of the image, True for the pixels that will be processed
+        :param estimated_work_units: how many work units the galaxy will make
+        :param estimated_fpops: the total rsc_fpops_est of the work units
+        """
+        self.layer_names = layer_names
+        self.layer_order = layer_order
+        self.valid_mask = valid_mask
+        self.row_counts = valid_mask.sum(axis=1)
+        self.valid_pixels = int(self.row_counts.sum())
+        self.estimated_work_units = estimated_work_units
+        self.estimated_fpops = estimated_fpops
+
+
+def build_preflight(connection, run_id, filename, rad_filename=None, int_filename=None):
+    """
+    Read the FITS file and build the preflight index
+
+    :param connection: the database connection
+    :param run_id: the run the galaxy is registered for
+    :param filename: the FITS file
+    :param rad_filename: the radial FITS file or None
+    :param int_filename: the integrated flux FITS file or None
+    :return: the Preflight
+    """
+    list_filter_names = get_run_filters(connection, run_id)
+    run = connection.execute(select([RUN]).where(RUN.c.run_id == run_id)).first()
+
+    hdu_list = pyfits.open(filename, memmap=True)
+    try:
+        layer_names = get_layer_names(hdu_list, list_filter_names)
+        layer_order, _, ultraviolet_bands, optical_bands, infrared_bands = sort_layers(list_filter_names, layer_names)
+
+        # The work units are sized and given fpops_est after it has been scaled for the bands, just like Fit2Wu does
+        _, fpops_scaling = get_band_scaling(list_filter_names, ultraviolet_bands, optical_bands, infrared_bands)
+        fpops_est_per_pixel = run[RUN.c.fpops_est] * fpops_scaling
+        sizer = WorkUnitSizer(fpops_est_per_pixel)
+
+        # The sigmas do not change which pixels are valid
+        pixel_cube = PixelCube(hdu_list, None, layer_order, None, 0.1, ultraviolet_bands, optical_bands, infrared_bands)
+        valid_mask = pixel_cube.valid_mask(sizer.row_height)
+    finally:
+        hdu_list.close()
+
+    work_units, pixels = estimate_work_units(valid_mask, sizer)
+
+    # One work unit for every RADIAL_AREA_SIZE radial pixels
+    if rad_filename is not None:
+        # Same as data.shape[0] - numpy reverses the order of the FITS axes
+        header = pyfits.getheader(rad_filename)
+        radial_pixels = header['NAXIS{0}'.format(header['NAXIS'])]
+        work_units += int(math.ceil(radial_pixels / float(RADIAL_AREA_SIZE)))
+        pixels += radial_pixels
+
+    # The integrated flux is one pixel in its own work unit
+    if int_filename is not None:
+        work_units += 1
+        pixels += 1
+
+    estimated_fpops = fpops_est_per_pixel * pixels * 1e12
+
+    return Preflight(layer_names, layer_order, valid_mask, work_units, estimated_fpops)
+
+
+def estimate_work_units(valid_mask, sizer):
+    """
+    Count the work units the same way Fit2Wu breaks up the galaxy
+
+    :param valid_mask: the valid pixel mask
+    :param sizer: the WorkUnitSizer for the run
+    :return: the number of work units and the number of pixels in them
+    """
+    work_units = 0
+    min_pixels_per_file_itr = 0
+    end_y, end_x = valid_mask.shape
+    for pix_y in range(0, end_y, sizer.row_height):
+        row_band = RowBand(pix_y, [], [], valid_mask[pix_y:pix_y + sizer.row_height])
+        pix_x = 0
+        while pix_x < end_x:
+            max_x, pixels = row_band.get_area_end(pix_x, sizer.get_min_pixels(min_pixels_per_file_itr))
+            if pixels > 0:
+                work_units += 1
+                min_pixels_per_file_itr = sizer.next_itr(min_pixels_per_file_itr)
+            pix_x = max_x + 1
+
+    return work_units, int(valid_mask.sum())
+
+
+def save_preflight(connection, register_id, preflight):
+    """
+    Store the preflight index
+
+    :param connection: the database connection
+    :param register_id: the registration
+    :param preflight: the Preflight
+    """
+    dimension_y, dimension_x = preflight.valid_mask.shape
+    connection.execute(REGISTER_PREFLIGHT.insert(),
+                       register_id=register_id,
+                       dimension_x=dimension_x,
+                       dimension_y=dimension_y,
+                       dimension_z=len(preflight.layer_names),
+                       layer_names=json.dumps(preflight.layer_names),
+                       layer_order=json.dumps(preflight.layer_order),
+                       valid_pixels=preflight.valid_pixels,
+                       row_counts=zlib.compress(preflight.row_counts.astype('<i4').tostring()),
+                       valid_mask=zlib.compress(numpy.packbits(preflight.valid_mask).tostring()),
+                       estimated_work_units=preflight.estimated_work_units,
+                       estimated_fpops=preflight.estimated_fpops,
+                       create_time=datetime.now())
+
+
+def load_preflight(connection, register_id):
+    """
+    Get the preflight index for a registration
+
+    :param connection: the database connection
+    :param register_id: the registration
+    :return: the Preflight or None if there isn't one
+    """
+    row = connection.execute(select([REGISTER_PREFLIGHT]).where(REGISTER_PREFLIGHT.c.register_id == register_id)).first()
+    if row is None:
+        return None
+
+    dimension_x = row[REGISTER_PREFLIGHT.c.dimension_x]
+    dimension_y = row[REGISTER_PREFLIGHT.c.dimension_y]
+    bits = numpy.unpackbits(numpy.fromstring(zlib.decompress(row[REGISTER_PREFLIGHT.c.valid_mask]), dtype=numpy.uint8))
+    valid_mask = bits[:dimension_x * dimension_y].reshape((dimension_y, dimension_x)).astype(bool)
+
+    return Preflight(json.loads(row[REGISTER_PREFLIGHT.c.layer_names]),
+                     json.loads(row[REGISTER_PREFLIGHT.c.layer_order]),
+                     valid_mask,
+                     row[REGISTER_PREFLIGHT.c.estimated_work_units],
+                     row[REGISTER_PREFLIGHT.c.estimated_fpops])
+
+
+def get_estimated_work_units(connection, register_id):
+    """
+    Get the estimated number of work units without reading the mask
+
+    :param connection: the database connection
+    :param register_id: the registration
+    :return: the number of work units or None if there is no preflight index
+    """
+    row = connection.execute(select([REGISTER_PREFLIGHT.c.estimated_work_units]).where(REGISTER_PREFLIGHT.c.register_id == register_id)).first()
+    if row is None:
+        return None
+
+    return row[0]
@@ -0,0 +1,59 @@
+#! /usr/bin/env python2.7
+#
+#    Copyright (c) UWA, The University of Western Australia
+#    M468/35 Stirling Hwy
+#    Perth WA 6009
+#    Australia
+#
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Raise the priority of the work units of the galaxies that are nearly finished
+"""
+import os
+import sys
+
+# Setup the Python Path as we may be running this via ssh
+base_path = os.path.dirname(__file__)
+sys.path.append(os.path.abspath(os.path.join(base_path, '..')))
+sys.path.append(os.path.abspath(os.path.join(base_path, '../../../../boinc/py')))
+
+import argparse
+from sqlalchemy.engine import create_engine
+from config import BOINC_DB_LOGIN, DB_LOGIN
+from utils.logging_helper import config_logger
+from work_generation.priority_scheduler_mod import schedule
+
+LOG = config_logger(__name__)
+LOG.info('PYTHONPATH = {0}'.format(sys.path))
+
+parser = argparse.ArgumentParser('Raise the priority of the work units of nearly finished galaxies')
+parser.add_argument('-r', '--reissue', action='store_true', help='give the straggling work units of those galaxies another result')
+args = vars(parser.parse_args())
+
+ENGINE = create_engine(DB_LOGIN)
+BOINC_ENGINE = create_engine(BOINC_DB_LOGIN)
+connection = ENGINE.connect()
+boinc_connection = BOINC_ENGINE.connect()
+try:
+    schedule(connection, boinc_connection, args['reissue'])
+finally:
+    boinc_connection.close()
+    connection.close()
+
+LOG.info('All done')
@@ -0,0 +1,244 @@
+#
+#    Copyright (c) UWA, The University of Western Australia
+#    M468/35 Stirling Hwy
+#    Perth WA 6009
+#    Australia
+#
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Raise the BOINC priority of the work units of nearly finished galaxies.
+
+Every work unit of a galaxy is created with the priority of its registration, so the last few areas of a
+galaxy wait behind all of the fresh work. The galaxy can't be archived until they come back. Here the
+outstanding areas (those not assimilated yet) of each galaxy are counted. Once a galaxy is far enough
+through, its remaining work units are moved to the front of the feeder's queue. Work units whose only
+results have been out with slow hosts for too long can be given another result.
+"""
+import time
+from sqlalchemy.sql.expression import select, func
+from config import COMPUTING, WG_SCHEDULER_COMPLETION, WG_SCHEDULER_PRIORITY, WG_STRAGGLER_HOURS, WG_STRAGGLER_MAX_REISSUE
+from database.boinc_database_support_core import RESULT, WORK_UNIT
+from database.database_support_core import AREA, AREA_PACK, GALAXY
+from utils.logging_helper import config_logger
+from utils.name_builder import get_work_unit_name, get_packed_work_unit_name
+
+LOG = config_logger(__name__)
+
+# The BOINC result server states we are interested in
+SERVER_STATE_UNSENT = 2
+SERVER_STATE_IN_PROGRESS = 4
+
+# How many ids or names go in each IN clause
+IN_CLAUSE_SIZE = 1000
+
+
+class GalaxyProgress:
+    """
+    How far through a galaxy is
+    """
+    def __init__(self, galaxy_id, galaxy_name, total_areas, outstanding_areas):
+        self.galaxy_id = galaxy_id
+        self.galaxy_name = galaxy_name
+        self.total_areas = total_areas
+        self.outstanding_areas = outstanding_areas
+
+    def completion(self):
+        """
+        :return: the fraction of the areas that have been assimilated
+        """
+        if self.total_areas == 0:
+            return 0.0
+        return float(self.total_areas - self.outstanding_areas) / self.total_areas
+
+    def __str__(self):
+        return '{0} ({1}): {2} of {3} areas outstanding'.format(self.galaxy_name, self.galaxy_id, self.outstanding_areas, self.total_areas)
+
+
+def get_galaxy_progress(connection):
+    """
+    Count the areas and outstanding areas of the galaxies being computed.
+    Galaxies still having work units made (the pixel count is stored last) are left out.
+
+    :param connection: the database connection
+    :return: a list of GalaxyProgress for the galaxies with areas outstanding
+    """
+    progress = []
+    query = select([GALAXY.c.galaxy_id, GALAXY.c.name, func.count(AREA.c.area_id), func.count(AREA.c.workunit_id)], from_obj=GALAXY.join(AREA)) \
+        .where(GALAXY.c.status_id == COMPUTING) \
+        .where(GALAXY.c.pixel_count > 0) \
+        .group_by(GALAXY.c.galaxy_id, GALAXY.c.name)
+    for galaxy_id, galaxy_name, total_areas, assimilated_areas in connection.execute(query):
+        if assimilated_areas < total_areas:
+            progress.append(GalaxyProgress(galaxy_id, galaxy_name, total_areas, total_areas - assimilated_areas))
+
+    return progress
+
+
+def get_priority(galaxy_progress):
+    """
+    The priority for the remaining work units - the closer a galaxy is to being finished the sooner its work units go out
+
+    :param galaxy_progress: the GalaxyProgress
+    :return: the priority or None if the galaxy isn't far enough through
+    """
+    completion = galaxy_progress.completion()
+    if completion < WG_SCHEDULER_COMPLETION:
+        return None
+    return WG_SCHEDULER_PRIORITY + int(completion * 100)
+
+
+def get_outstanding_work_unit_names(connection, galaxy_progress):
+    """
+    Get the names of the work units holding the outstanding areas of a galaxy
+
+    :param connection: the database connection
+    :param galaxy_progress: the GalaxyProgress
+    :return: a set of work unit names
+    """
+    names = set()
+    pack_area_ids = set()
+    for area_id, pack_area_id in connection.execute(select([AREA.c.area_id, AREA_PACK.c.pack_area_id], from_obj=AREA.outerjoin(AREA_PACK))
+                                                    .where(AREA.c.galaxy_id == galaxy_progress.galaxy_id)
+                                                    .where(AREA.c.workunit_id == None)):
+        if pack_area_id is None:
+            names.add(get_work_unit_name(galaxy_progress.galaxy_name, area_id))
+        else:
+            pack_area_ids.add(pack_area_id)
+
+    # A packed work unit is named after the galaxy of its first area
+    if len(pack_area_ids) > 0:
+        for galaxy_name, area_id in connection.execute(select([GALAXY.c.name, AREA.c.area_id], from_obj=AREA.join(GALAXY))
+                                                       .where(AREA.c.area_id.in_(list(pack_area_ids)))):
+            names.add(get_packed_work_unit_name(galaxy_name, area_id))
+
+    return names
+
+
+def raise_priority(boinc_connection, work_unit_names, priority):
+    """
+    Raise the priority of the work units and of their results that haven't been sent yet.
+    The priority is never lowered.
+
+    :param boinc_connection: the BOINC database connection
+    :param work_unit_names: the names of the work units
+    :param priority: the new priority
+    :return: the ids of the work units that are still waiting to be assimilated, the work units changed and the results changed
+    """
+    work_unit_ids = []
+    names = list(work_unit_names)
+    for index in range(0, len(names), IN_CLAUSE_SIZE):
+        for work_unit in boinc_connection.execute(select([WORK_UNIT.c.id])
+                                                  .where(WORK_UNIT.c.name.in_(names[index:index + IN_CLAUSE_SIZE]))
+                                                  .where(WORK_UNIT.c.assimilate_state == 0)):
+            work_unit_ids.append(work_unit[0])
+
+    work_units_changed = 0
+    results_changed = 0
+    for index in range(0, len(work_unit_ids), IN_CLAUSE_SIZE):
+        ids = work_unit_ids[index:index + IN_CLAUSE_SIZE]
+        work_units_changed += boinc_connection.execute(WORK_UNIT.update()
+                                                       .where(WORK_UNIT.c.id.in_(ids))
+                                                       .where(WORK_UNIT.c.priority < priority)
+                                                       .values(priority=priority)).rowcount
+
+        # The feeder orders the results it sends by their priority
+        results_changed += boinc_connection.execute(RESULT.update()
+                                                    .where(RESULT.c.workunitid.in_(ids))
+                                                    .where(RESULT.c.server_state == SERVER_STATE_UNSENT)
+                                                    .where(RESULT.c.priority < priority)
+                                                    .values(priority=priority)).rowcount
+
+    return work_unit_ids, work_units_changed, results_changed
+
+
+def reissue_stragglers(boinc_connection, work_unit_ids, now=None):
+    """
+    Ask the transitioner for another result for work units that are only waiting on results sent more than
+    WG_STRAGGLER_HOURS ago. Each work unit gets at most WG_STRAGGLER_MAX_REISSUE extra results.
+
+    :param boinc_connection: the BOINC database connection
+    :param work_unit_ids: the work units to check
+    :param now: the time to use (seconds since the epoch)
+    :return: the number of work units reissued
+    """
+    if now is None:
+        now = int(time.time())
+    sent_before = now - int(WG_STRAGGLER_HOURS * 3600)
+
+    reissued = 0
+    for index in range(0, len(work_unit_ids), IN_CLAUSE_SIZE):
+        ids = work_unit_ids[index:index + IN_CLAUSE_SIZE]
+        stragglers = set()
+        unsent = set()
+        for work_unit_id, server_state, sent_time in boinc_connection.execute(select([RESULT.c.workunitid, RESULT.c.server_state, RESULT.c.sent_time])
+                                                                              .where(RESULT.c.workunitid.in_(ids))
+                                                                              .where(RESULT.c.server_state.in_([SERVER_STATE_UNSENT, SERVER_STATE_IN_PROGRESS]))):
+            if server_state == SERVER_STATE_UNSENT:
+                unsent.add(work_unit_id)
+            elif sent_time < sent_before:
+                stragglers.add(work_unit_id)
+
+        # A result waiting to be sent will do the job already
+        stragglers -= unsent
+        if len(stragglers) == 0:
+            continue
+
+        # Setting the transition time makes the transitioner create the extra result
+        reissued += boinc_connection.execute(WORK_UNIT.update()
+                                             .where(WORK_UNIT.c.id.in_(list(stragglers)))
+                                             .where(WORK_UNIT.c.target_nresults < WORK_UNIT.c.min_quorum + WG_STRAGGLER_MAX_REISSUE)
+                                             .values(target_nresults=WORK_UNIT.c.target_nresults + 1, transition_time=now)).rowcount
+
+    return reissued
+
+
+def schedule(connection, boinc_connection, reissue=False):
+    """
+    Raise the priority of the remaining work units of the nearly finished galaxies
+
+    :param connection: the database connection
+    :param boinc_connection: the BOINC database connection
+    :param reissue: reissue the straggling work units as well
+    :return: the number of galaxies boosted, the work units changed, the results changed and the work units reissued
+    """
+    galaxies = 0
+    total_work_units = 0
+    total_results = 0
+    total_reissued = 0
+    for galaxy_progress in sorted(get_galaxy_progress(connection), key=lambda progress: progress.completion(), reverse=True):
+        priority = get_priority(galaxy_progress)
+        if priority is None:
+            # The rest are even further from being done
+            break
+
+        work_unit_names = get_outstanding_work_unit_names(connection, galaxy_progress)
+        work_unit_ids, work_units, results = raise_priority(boinc_connection, work_unit_names, priority)
+        reissued = 0
+        if reissue:
+            reissued = reissue_stragglers(boinc_connection, work_unit_ids)
+
+        LOG.info('{0} - {1:.1f}% complete, priority {2}: {3} work units and {4} results changed, {5} reissued'.format(
+            galaxy_progress, galaxy_progress.completion() * 100, priority, work_units, results, reissued))
+        galaxies += 1
+        total_work_units += work_units
+        total_results += results
+        total_reissued += reissued
+
+    LOG.info('{0} galaxies: {1} work units and {2} results changed, {3} work units reissued'.format(galaxies, total_work_units, total_results, total_reissued))
+    return galaxies, total_work_units, total_results, total_reissued
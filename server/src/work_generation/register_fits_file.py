@@ -45,6 +45,7 @@ from config import DB_LOGIN
 from work_generation.register_fits_file_mod import fix_redshift, \
     decompress_gz_files, extract_tar_file, find_files, add_to_database, \
     clean_unused_fits, move_fits_files
+from work_generation.model_index import TEMPLATES_PATH2, build_model_index, get_run_directory
 
 LOG = config_logger(__name__)
 LOG.info('PYTHONPATH = {0}'.format(sys.path))
@@ -97,8 +98,10 @@ def main():
     shutil.rmtree(tar_extract_location)
 
     all_galaxy_data = []
+    model_index = build_model_index(get_run_directory(TEMPLATES_PATH2, run_id))
 
     num_galaxies_without_file = 0
+    num_galaxies_without_models = 0
     num_galaxies_without_sigma = 0
 
     # Loop through each of the galaxies
@@ -160,6 +163,11 @@ def main():
 
         single_galaxy_data['sigma'] = sigma
         single_galaxy_data['redshift'] = float(fix_redshift(hdu.header['POGSZ']))
+        if model_index.lookup(single_galaxy_data['redshift']) is None:
+            LOG.error('Galaxy {0} has a redshift of {1:.4f} and run {2} has no models for it!'.format(single_galaxy_data['name'], single_galaxy_data['redshift'], run_id))
+            num_galaxies_without_models += 1
+            continue
+
         single_galaxy_data['input_file'] = single_galaxy_data['img']
         single_galaxy_data['type'] = gal_type
         single_galaxy_data['priority'] = priority
@@ -192,6 +200,7 @@ def main():
     LOG.info('Total fits files without an entry in text file: {0}'.format(num_unused_fits))
     LOG.info('Total galaxies in text document with no fits file: {0}'.format(num_galaxies_without_file))
     LOG.info('Total galaxies without a sigma file: {0}'.format(num_galaxies_without_sigma))
+    LOG.info('Total galaxies without models for their redshift: {0}'.format(num_galaxies_without_models))
     LOG.info('Total galaxies inserted into database: {0}'.format(num_galaxies_inserted))
 
 
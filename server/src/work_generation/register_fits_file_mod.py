@@ -33,6 +33,8 @@ from utils.logging_helper import config_logger
 from datetime import datetime
 from sqlalchemy import select
 from database.database_support_core import REGISTER, TAG_REGISTER, TAG
+from work_generation.id_allocator import IdAllocator
+from work_generation.preflight import build_preflight, save_preflight
 
 LOG = config_logger(__name__)
 FOUR_PLACES = Decimal('.0001')
@@ -316,6 +318,25 @@ def clean_unused_fits(location, galaxy_names):
     return len(files_to_delete)
 
 
+def split_sigma(sigma_in):
+    """
+    The sigma is either a value or the name of the S/N ratio file
+
+    >>> split_sigma('0.05')
+    (0.05, None)
+
+    >>> split_sigma('/home/ec2-user/galaxies/POGSSNR_IC0089.fits')
+    (0.0, '/home/ec2-user/galaxies/POGSSNR_IC0089.fits')
+
+    :param sigma_in: the sigma from the command line or manifest
+    :return: the sigma and the S/N ratio file name or None
+    """
+    try:
+        return float(sigma_in), None
+    except ValueError:
+        return 0.0, sigma_in
+
+
 def add_to_database(connection, galaxy):
     """
     Adds the specified galaxies to the database
@@ -336,17 +357,25 @@ def add_to_database(connection, galaxy):
     rad = galaxy['rad']
     rad_snr = galaxy['rad_snr']
 
+    # Read the cube now, so the work generator doesn't have to - the registration still works without it
+    preflight = None
+    # noinspection PyBroadException
+    try:
+        preflight = build_preflight(connection, run_id, input_file, rad, integrated)
+        LOG.info('Preflight {0}: {1} valid pixels, {2} work units'.format(galaxy_name, preflight.valid_pixels, preflight.estimated_work_units))
+    except Exception:
+        LOG.exception('Could not build the preflight index for {0}'.format(galaxy_name))
+
+    # The register ids come from the same blocks as register_manifest's, so the two can run at the same time
+    register_id = IdAllocator(connection.engine).reserve(REGISTER.c.register_id, 1)
+
     transaction = connection.begin()
     try:
-        try:
-            sigma = float(sigma_in)
-            sigma_filename = None
-        except ValueError:
-            sigma = 0.0
-            sigma_filename = sigma_in
-
-        result = connection.execute(
+        sigma, sigma_filename = split_sigma(sigma_in)
+
+        connection.execute(
             REGISTER.insert(),
+            register_id=register_id,
             galaxy_name=galaxy_name,
             redshift=redshift,
             galaxy_type=galaxy_type,
@@ -362,7 +391,8 @@ def add_to_database(connection, galaxy):
             rad_sigma_filename=rad_snr
         )
 
-        register_id = result.inserted_primary_key[0]
+        if preflight is not None:
+            save_preflight(connection, register_id, preflight)
 
         # Get the tag ids
         tag_ids = set()
@@ -0,0 +1,148 @@
+#! /usr/bin/env python2.7
+#
+#    Copyright (c) UWA, The University of Western Australia
+#    M468/35 Stirling Hwy
+#    Perth WA 6009
+#    Australia
+#
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Register the galaxies listed in a CSV or JSON manifest
+"""
+import os
+import sys
+
+base_path = os.path.dirname(__file__)
+sys.path.append(os.path.abspath(os.path.join(base_path, '..')))
+
+import argparse
+import multiprocessing
+import shutil
+from sqlalchemy.engine import create_engine
+from config import DB_LOGIN, WG_BULK_INSERT_SIZE
+from utils.logging_helper import config_logger
+from work_generation.model_index import TEMPLATES_PATH2
+from work_generation.register_manifest_mod import read_manifest, extract_tar, init_worker, prepare_galaxy, get_filter_names, get_tag_ids, \
+    add_galaxies_to_database, get_model_indexes, reject_unsupported_redshifts
+
+LOG = config_logger(__name__)
+LOG.info('PYTHONPATH = {0}'.format(sys.path))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('working_directory', nargs=1, help='galaxies directory')
+    parser.add_argument('manifest', nargs=1, help='a CSV or JSON file listing the galaxies')
+    parser.add_argument('-p', '--priority', type=int, default=0, help='the priority for the galaxies without one in the manifest')
+    parser.add_argument('-r', '--run_id', type=int, help='the run id for the galaxies without one in the manifest')
+    parser.add_argument('-t', '--tags', nargs='*', default=[], help='tags to be associated with every galaxy')
+    parser.add_argument('-w', '--workers', type=int, default=multiprocessing.cpu_count(), help='the number of processes extracting and checking the files')
+    parser.add_argument('--no_preflight', action='store_true', help="don't build the preflight indexes - the work generator will read the cubes itself")
+
+    args = vars(parser.parse_args())
+    working_directory = os.path.abspath(args['working_directory'][0])
+    manifest_file = args['manifest'][0]
+
+    if not os.path.isfile(manifest_file):
+        LOG.error('The file %s does not exist', manifest_file)
+        exit(1)
+
+    entries = read_manifest(manifest_file, args['priority'], args['run_id'], args['tags'])
+    if any([entry['run_id'] is None for entry in entries]):
+        LOG.error('Every galaxy needs a run id - use --run_id or add a run_id column')
+        exit(1)
+
+    # Don't extract the files of galaxies that could never be processed
+    num_entries = len(entries)
+    model_indexes = get_model_indexes(TEMPLATES_PATH2, set([entry['run_id'] for entry in entries]))
+    entries, unsupported = reject_unsupported_redshifts(entries, model_indexes)
+    for error in unsupported:
+        LOG.error(error)
+
+    engine = create_engine(DB_LOGIN)
+    connection = engine.connect()
+    filter_names = get_filter_names(connection, set([entry['run_id'] for entry in entries]))
+
+    pool = multiprocessing.Pool(max(args['workers'], 1), init_worker, (not args['no_preflight'],))
+    try:
+        # Each tar file is only extracted once, however many galaxies are in it
+        tar_locations = {}
+        for entry in entries:
+            if entry['tar'] is not None and entry['tar'] not in tar_locations:
+                (head, tail) = os.path.split(entry['tar'])
+                tar_locations[entry['tar']] = os.path.join(working_directory, os.path.splitext(tail)[0])
+
+        num_files_extracted = 0
+        for tar_file, location, extracted in pool.imap_unordered(extract_tar, tar_locations.items()):
+            if extracted is None:
+                del tar_locations[tar_file]
+            else:
+                num_files_extracted += extracted
+
+        tasks = []
+        num_galaxies_without_tar = 0
+        for entry in entries:
+            if entry['tar'] is not None:
+                if entry['tar'] not in tar_locations:
+                    num_galaxies_without_tar += 1
+                    continue
+                source_directory = tar_locations[entry['tar']]
+            else:
+                source_directory = entry['directory'] or working_directory
+            tasks.append((entry, source_directory, working_directory, filter_names[entry['run_id']]))
+
+        galaxies = []
+        errors = []
+        # imap keeps the galaxies in the order of the manifest
+        for galaxy, error in pool.imap(prepare_galaxy, tasks, chunksize=8):
+            if galaxy is not None:
+                galaxies.append(galaxy)
+            else:
+                LOG.error(error)
+                errors.append(error)
+    finally:
+        pool.close()
+        pool.join()
+
+    # The redshifts read from the FITS headers are only known now
+    galaxies, header_unsupported = reject_unsupported_redshifts(galaxies, model_indexes)
+    for error in header_unsupported:
+        LOG.error(error)
+    unsupported.extend(header_unsupported)
+
+    # Remove the files left in the extract locations
+    for location in tar_locations.values():
+        shutil.rmtree(location, ignore_errors=True)
+
+    tag_ids = get_tag_ids(connection, [tag_text for galaxy in galaxies for tag_text in galaxy['tags']])
+    num_galaxies_inserted = add_galaxies_to_database(connection, galaxies, tag_ids, WG_BULK_INSERT_SIZE)
+    connection.close()
+
+    LOG.info('Summary information: ')
+    LOG.info('Total galaxies in the manifest: {0}'.format(num_entries))
+    LOG.info('Total files extracted from tars: {0}'.format(num_files_extracted))
+    LOG.info('Total galaxies whose tar could not be extracted: {0}'.format(num_galaxies_without_tar))
+    LOG.info('Total galaxies that failed the checks: {0}'.format(len(errors)))
+    LOG.info('Total galaxies without models for their redshift: {0}'.format(len(unsupported)))
+    LOG.info('Total galaxies without a sigma file: {0}'.format(len([galaxy for galaxy in galaxies if galaxy['img_snr'] is None])))
+    LOG.info('Total galaxies inserted into database: {0}'.format(num_galaxies_inserted))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,389 @@
+#
+#    Copyright (c) UWA, The University of Western Australia
+#    M468/35 Stirling Hwy
+#    Perth WA 6009
+#    Australia
+#
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Register the galaxies listed in a manifest in bulk.
+
+The tar files are extracted and the galaxies' files decompressed and checked in a pool of processes.
+Only the FITS headers are read to check the files, and galaxies with a redshift the run has no
+models for are rejected. The registrations are then inserted in batches, with all of the tags
+resolved in one go.
+"""
+import csv
+import gzip
+import json
+import os
+import shutil
+from datetime import datetime
+from sqlalchemy.engine import create_engine
+from sqlalchemy.sql.expression import select
+from config import DB_LOGIN
+from database.database_support_core import FILTER, REGISTER, TAG, TAG_REGISTER
+from utils.logging_helper import config_logger
+from work_generation.filter_layers import get_run_filters
+from work_generation.fits_checker import check_fits_file
+from work_generation.id_allocator import IdAllocator
+from work_generation.model_index import build_model_index, get_run_directory
+from work_generation.preflight import build_preflight, save_preflight
+from work_generation.register_fits_file_mod import extract_tar_file, fix_redshift, split_sigma
+
+LOG = config_logger(__name__)
+
+# The files that make up a galaxy - the key used in the galaxy dict and the prefix of the file name
+GALAXY_FILES = [('img', 'POGS_'),
+                ('img_snr', 'POGSSNR_'),
+                ('int', 'POGSint_'),
+                ('int_snr', 'POGSintSNR_'),
+                ('rad', 'POGSrad_'),
+                ('rad_snr', 'POGSradSNR_')]
+
+# How much of a gz file to decompress at a time
+COPY_BUFFER_SIZE = 16 * 1024 * 1024
+
+# The connection used by each process in the pool to build the preflight indexes
+_WORKER_CONNECTION = None
+
+
+def read_manifest(manifest_file, priority, run_id, tags):
+    """
+    Read the galaxies from a CSV file with a header row or a JSON list of objects.
+
+    Each galaxy must have a name. The optional fields are:
+      tar - a tar file holding the galaxy's files
+      directory - where the galaxy's files are if there is no tar file (the working directory if not given)
+      priority, run_id - the values from the command line are used if they are not given
+      tags - separated by ';' in a CSV file or a list in a JSON file, added to the tags from the command line
+      redshift, type - the POGSZ and POGSOBJT values in the FITS header are used if they are not given
+
+    :param manifest_file: the manifest
+    :param priority: the default priority
+    :param run_id: the default run id
+    :param tags: the tags for every galaxy
+    :return: a list of dicts, one for each galaxy
+    """
+    if manifest_file.endswith('.json'):
+        with open(manifest_file, 'r') as manifest:
+            rows = json.load(manifest)
+    else:
+        with open(manifest_file, 'rb') as manifest:
+            rows = list(csv.DictReader(manifest))
+
+    entries = []
+    for row in rows:
+        # Left as None if there is no run id anywhere, so the caller can report it
+        galaxy_run_id = row.get('run_id') or run_id
+
+        galaxy_tags = row.get('tags') or []
+        if isinstance(galaxy_tags, basestring):
+            galaxy_tags = galaxy_tags.split(';')
+        galaxy_tags = [tag_text.strip() for tag_text in list(tags) + list(galaxy_tags)]
+
+        entries.append({'name': row['name'].strip(),
+                        'tar': row.get('tar') or None,
+                        'directory': row.get('directory') or None,
+                        'priority': int(row.get('priority') or priority),
+                        'run_id': int(galaxy_run_id) if galaxy_run_id is not None else None,
+                        'tags': [tag_text for tag_text in galaxy_tags if len(tag_text) > 0],
+                        'redshift': row.get('redshift') or None,
+                        'type': row.get('type') or None})
+
+    LOG.info('{0} galaxies in {1}'.format(len(entries), manifest_file))
+    return entries
+
+
+def extract_tar(task):
+    """
+    Extract a tar file in a pool process
+
+    :param task: the tar file and where to extract it
+    :return: the tar file, where it was extracted and the number of files extracted or None if it failed
+    """
+    tar_file, location = task
+    # noinspection PyBroadException
+    try:
+        num_files_extracted, _ = extract_tar_file(tar_file, location)
+        return tar_file, location, num_files_extracted
+    except Exception:
+        LOG.exception('Could not extract {0}'.format(tar_file))
+        return tar_file, location, None
+
+
+def init_worker(build_preflights):
+    """
+    Set up a pool process
+
+    :param build_preflights: open a database connection to build the preflight indexes
+    """
+    global _WORKER_CONNECTION
+    if build_preflights:
+        _WORKER_CONNECTION = create_engine(DB_LOGIN).connect()
+
+
+def prepare_galaxy(task):
+    """
+    Get a galaxy ready to register in a pool process. The files are decompressed and moved
+    into the working directory, then the FITS headers are checked.
+
+    :param task: the manifest entry, where to find the files, the working directory and the filter names used by the run
+    :return: the galaxy dict used by add_galaxies_to_database and None, or None and the error
+    """
+    entry, source_directory, working_directory, filter_names = task
+    name = entry['name']
+
+    # noinspection PyBroadException
+    try:
+        galaxy = dict(entry)
+        for key, prefix in GALAXY_FILES:
+            galaxy[key] = place_file(source_directory, working_directory, '{0}{1}.fits'.format(prefix, name))
+
+        if galaxy['img'] is None:
+            return None, 'No image file for {0}'.format(name)
+
+        redshift, galaxy_type = check_headers(galaxy, filter_names)
+        if galaxy['redshift'] is None:
+            if redshift is None:
+                return None, 'No redshift for {0}'.format(name)
+            galaxy['redshift'] = redshift
+        if galaxy['type'] is None:
+            galaxy['type'] = galaxy_type if galaxy_type else 'Unk'
+
+        galaxy['redshift'] = float(fix_redshift(galaxy['redshift']))
+        galaxy['input_file'] = galaxy['img']
+        galaxy['sigma'] = galaxy['img_snr'] if galaxy['img_snr'] is not None else 0.1
+    except ValueError as e:
+        return None, '{0} failed the checks: {1}'.format(name, e)
+    except Exception as e:
+        LOG.exception('Could not prepare {0}'.format(name))
+        return None, 'Could not prepare {0}: {1}'.format(name, e)
+
+    galaxy['preflight'] = None
+    if _WORKER_CONNECTION is not None:
+        # The registration still works without it
+        # noinspection PyBroadException
+        try:
+            galaxy['preflight'] = build_preflight(_WORKER_CONNECTION, galaxy['run_id'], galaxy['input_file'], galaxy['rad'], galaxy['int'])
+        except Exception:
+            LOG.exception('Could not build the preflight index for {0}'.format(name))
+
+    return galaxy, None
+
+
+def place_file(source_directory, working_directory, file_name):
+    """
+    Put a file in the working directory, decompressing it if it is a gz file
+
+    :param source_directory: where the file is
+    :param working_directory: where the file should be
+    :param file_name: the name of the FITS file
+    :return: the absolute path of the file in the working directory or None if there is no such file
+    """
+    target = os.path.join(working_directory, file_name)
+    source = os.path.join(source_directory, file_name)
+
+    if os.path.exists(source + '.gz'):
+        # Streamed so a big cube is never held in memory
+        compressed = gzip.open(source + '.gz', 'rb')
+        try:
+            with open(target, 'wb') as decompressed:
+                shutil.copyfileobj(compressed, decompressed, COPY_BUFFER_SIZE)
+        finally:
+            compressed.close()
+        os.remove(source + '.gz')
+    elif os.path.exists(source):
+        if os.path.abspath(source) != os.path.abspath(target):
+            shutil.move(source, target)
+    elif not os.path.exists(target):
+        return None
+
+    return os.path.abspath(target)
+
+
+def check_headers(galaxy, filter_names):
+    """
+    Check the FITS files of a galaxy look right. Only the headers are read, never the pixel data.
+
+    :param galaxy: the galaxy dict with the file names
+    :param filter_names: the names of the filters used by the run
+    :return: the POGSZ and POGSOBJT values from the image or None if they are not there
+    """
+    summary = _check_file(galaxy['img'], 'image', filter_names, ['POGSZ', 'POGSOBJT'])
+    if len(summary['dimensions']) != 2:
+        raise ValueError('The image is not a 2D image')
+
+    if galaxy['img_snr'] is not None:
+        if _check_file(galaxy['img_snr'], 'S/N ratio file', filter_names)['dimensions'] != summary['dimensions']:
+            raise ValueError('The S/N ratio file is not the same size as the image')
+
+    # The work generator uses the layer order of the image for these
+    for key in ['int', 'int_snr', 'rad', 'rad_snr']:
+        if galaxy[key] is not None:
+            _check_file(galaxy[key], key, None, require_filters=False)
+
+    galaxy_type = summary['keywords']['POGSOBJT']
+    return summary['keywords']['POGSZ'], galaxy_type.strip() if galaxy_type is not None else None
+
+
+def _check_file(file_name, description, filter_names, keywords=(), require_filters=True):
+    """
+    Raise a ValueError if the file has anything wrong with it
+    """
+    summary = check_fits_file(file_name, filter_names, keywords, require_filters=require_filters)
+    if len(summary['errors']) > 0:
+        raise ValueError('{0}: {1}'.format(description, '; '.join(summary['errors'])))
+    return summary
+
+
+def get_filter_names(connection, run_ids):
+    """
+    Get the names of the filters used by each run
+
+    :param connection: the database connection
+    :param run_ids: the runs
+    :return: a dict of run id to a set of filter names
+    """
+    filter_names = {}
+    for run_id in run_ids:
+        filter_names[run_id] = set([run_filter[FILTER.c.name] for run_filter in get_run_filters(connection, run_id)])
+    return filter_names
+
+
+def get_model_indexes(templates_path, run_ids):
+    """
+    Get the index of the models available to each run
+
+    :param templates_path: where the run directories are
+    :param run_ids: the runs
+    :return: a dict of run id to the ModelIndex
+    """
+    model_indexes = {}
+    for run_id in run_ids:
+        model_indexes[run_id] = build_model_index(get_run_directory(templates_path, run_id))
+    return model_indexes
+
+
+def reject_unsupported_redshifts(galaxies, model_indexes):
+    """
+    Reject the galaxies whose runs have no models for their redshift. The galaxies without a redshift yet are kept.
+
+    :param galaxies: the manifest entries or galaxy dicts
+    :param model_indexes: see get_model_indexes
+    :return: the galaxies kept and the errors for those rejected
+    """
+    galaxies_by_run = {}
+    for position, galaxy in enumerate(galaxies):
+        if galaxy['redshift'] is not None:
+            galaxies_by_run.setdefault(galaxy['run_id'], []).append(position)
+
+    rejected = {}
+    for run_id, positions in galaxies_by_run.items():
+        redshifts = [float(fix_redshift(galaxies[position]['redshift'])) for position in positions]
+        for position, redshift, rounded_redshift in zip(positions, redshifts, model_indexes[run_id].lookup_many(redshifts)):
+            if rounded_redshift is None:
+                rejected[position] = 'No models in run {0} for {1} at a redshift of {2:.4f}'.format(run_id, galaxies[position]['name'], redshift)
+
+    kept = [galaxy for position, galaxy in enumerate(galaxies) if position not in rejected]
+    return kept, [rejected[position] for position in sorted(rejected)]
+
+
+def get_tag_ids(connection, tags):
+    """
+    Look up all of the tags in one query, adding any that are new
+
+    :param connection: the database connection
+    :param tags: the tag texts
+    :return: a dict of tag text to tag id
+    """
+    tags = set([tag_text.strip() for tag_text in tags if len(tag_text.strip()) > 0])
+    if len(tags) == 0:
+        return {}
+
+    tag_ids = {}
+    for tag in connection.execute(select([TAG.c.tag_id, TAG.c.tag_text]).where(TAG.c.tag_text.in_(tags))):
+        tag_ids[tag[TAG.c.tag_text]] = tag[TAG.c.tag_id]
+
+    for tag_text in tags - set(tag_ids.keys()):
+        result = connection.execute(TAG.insert(), tag_text=tag_text)
+        tag_ids[tag_text] = result.inserted_primary_key[0]
+
+    return tag_ids
+
+
+def add_galaxies_to_database(connection, galaxies, tag_ids, batch_size):
+    """
+    Register the galaxies. Each batch is inserted in one transaction.
+
+    :param connection: the database connection
+    :param galaxies: the galaxy dicts from prepare_galaxy
+    :param tag_ids: the dict from get_tag_ids
+    :param batch_size: the number of galaxies in each batch
+    :return: the number of galaxies registered
+    """
+    # The register ids are needed for the tags and the preflight indexes before the rows are inserted.
+    # register_fits_file takes its ids from the same blocks.
+    allocator = IdAllocator(connection.engine)
+    num_galaxies_inserted = 0
+    for start in range(0, len(galaxies), batch_size):
+        batch = galaxies[start:start + batch_size]
+        first_id = allocator.reserve(REGISTER.c.register_id, len(batch))
+
+        register_rows = []
+        tag_register_rows = []
+        register_time = datetime.now()
+        for register_id, galaxy in enumerate(batch, first_id):
+            sigma, sigma_filename = split_sigma(galaxy['sigma'])
+            register_rows.append({'register_id': register_id,
+                                  'galaxy_name': galaxy['name'],
+                                  'redshift': galaxy['redshift'],
+                                  'galaxy_type': galaxy['type'],
+                                  'filename': galaxy['input_file'],
+                                  'priority': galaxy['priority'],
+                                  'register_time': register_time,
+                                  'run_id': galaxy['run_id'],
+                                  'sigma': sigma,
+                                  'sigma_filename': sigma_filename,
+                                  'int_filename': galaxy['int'],
+                                  'int_sigma_filename': galaxy['int_snr'],
+                                  'rad_filename': galaxy['rad'],
+                                  'rad_sigma_filename': galaxy['rad_snr']})
+
+            for tag_id in set([tag_ids[tag_text] for tag_text in galaxy['tags']]):
+                tag_register_rows.append({'tag_id': tag_id, 'register_id': register_id})
+
+        transaction = connection.begin()
+        try:
+            connection.execute(REGISTER.insert(), register_rows)
+            if len(tag_register_rows) > 0:
+                connection.execute(TAG_REGISTER.insert(), tag_register_rows)
+            for register_id, galaxy in enumerate(batch, first_id):
+                if galaxy['preflight'] is not None:
+                    save_preflight(connection, register_id, galaxy['preflight'])
+            transaction.commit()
+        except Exception:
+            transaction.rollback()
+            LOG.exception('An error occurred adding {0} to {1} to the database'.format(batch[0]['name'], batch[-1]['name']))
+            continue
+
+        num_galaxies_inserted += len(batch)
+        LOG.info('Registered {0} of {1} galaxies'.format(num_galaxies_inserted, len(galaxies)))
+
+    return num_galaxies_inserted
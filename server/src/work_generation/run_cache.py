@@ -0,0 +1,137 @@
+#
+#    Copyright (c) UWA, The University of Western Australia
+#    M468/35 Stirling Hwy
+#    Perth WA 6009
+#    Australia
+#
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Keep the run details between galaxies so a long running work generator does not keep asking for them.
+
+The entries expire so changes made by load_run_details are picked up without a restart.
+"""
+import os
+import time
+from sqlalchemy.sql.expression import select
+from database.database_support_core import RUN
+from work_generation.filter_layers import get_run_filters
+from work_generation.model_index import build_model_index, get_run_directory
+
+
+class RunCache:
+    """
+    The RUN rows, the run filters, the models available to each run and the model files already in the download area
+    """
+    def __init__(self, expiry_seconds=None):
+        """
+        Initialise the cache
+
+        :param expiry_seconds: how long to keep an entry, None keeps it for the life of the cache
+        """
+        self._expiry_seconds = expiry_seconds
+        self._runs = {}
+        self._run_filters = {}
+        self._model_indexes = {}
+        self._files_ready = {}
+
+    def get_run(self, connection, run_id):
+        """
+        Get the RUN row
+
+        :param connection: the database connection
+        :param run_id: the run
+        :return: the RUN row
+        """
+        run = self._get(self._runs, run_id)
+        if run is None:
+            run = connection.execute(select([RUN]).where(RUN.c.run_id == run_id)).first()
+            self._put(self._runs, run_id, run)
+        return run
+
+    def get_run_filters(self, connection, run_id):
+        """
+        Get the filters used by the run - see filter_layers.get_run_filters
+
+        :param connection: the database connection
+        :param run_id: the run
+        :return: a list of FILTER rows
+        """
+        run_filters = self._get(self._run_filters, run_id)
+        if run_filters is None:
+            run_filters = get_run_filters(connection, run_id)
+            self._put(self._run_filters, run_id, run_filters)
+        return run_filters
+
+    def get_model_index(self, templates_path, run_id):
+        """
+        Get the index of the models in the run directory - see model_index.build_model_index
+
+        :param templates_path: where the run directories are
+        :param run_id: the run
+        :return: the ModelIndex
+        """
+        model_index = self._get(self._model_indexes, run_id)
+        if model_index is None:
+            model_index = build_model_index(get_run_directory(templates_path, run_id))
+            self._put(self._model_indexes, run_id, model_index)
+        return model_index
+
+    def files_ready(self, run_id, rounded_redshift):
+        """
+        Have the template, filter and model files for the run and redshift been checked already?
+        The entry is stale if it has expired or one of the files has gone, so the files are checked again.
+
+        :param run_id: the run
+        :param rounded_redshift: the redshift of the models
+        :return: True if they are known to be in place
+        """
+        file_names = self._get(self._files_ready, (run_id, rounded_redshift))
+        if file_names is None:
+            return False
+
+        for file_name in file_names:
+            if not os.path.isfile(file_name):
+                del self._files_ready[(run_id, rounded_redshift)]
+                return False
+        return True
+
+    def set_files_ready(self, run_id, rounded_redshift, file_names):
+        """
+        Record that the template, filter and model files are in place
+
+        :param run_id: the run
+        :param rounded_redshift: the redshift of the models
+        :param file_names: the full paths of the files
+        """
+        self._put(self._files_ready, (run_id, rounded_redshift), list(file_names))
+
+    def _get(self, entries, key):
+        entry = entries.get(key)
+        if entry is None:
+            return None
+
+        value, expires = entry
+        if expires is not None and expires < time.time():
+            del entries[key]
+            return None
+        return value
+
+    def _put(self, entries, key, value):
+        expires = None if self._expiry_seconds is None else time.time() + self._expiry_seconds
+        entries[key] = (value, expires)
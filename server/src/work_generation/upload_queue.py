@@ -0,0 +1,324 @@
+#
+#    Copyright (c) UWA, The University of Western Australia
+#    M468/35 Stirling Hwy
+#    Perth WA 6009
+#    Australia
+#
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+Build the images and store the FITS files of a galaxy in the background.
+
+Once the work units of a galaxy have been made a row is put in GALAXY_UPLOAD and handed to a pool
+of uploader threads, so the work generator can go straight on to the next registration. The row is
+only removed once the images and files are in S3, so any upload lost when a work generator stops
+is claimed again by the next one. While a galaxy is uploaded its claim_time is kept up to date, and
+every change to the row checks the claim is still ours, so a row is never uploaded twice at once.
+The GALAXY pixel_count is still set last. A row that has used up its
+attempts is given a failed_time and left for an operator - clearing failed_time and attempts lets the
+next recover try it again.
+"""
+import os
+import Queue
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy.engine import create_engine
+from sqlalchemy.sql.expression import select, or_, func
+from config import DB_LOGIN, WG_UPLOAD_PART_MB, WG_UPLOAD_PART_THREADS, WG_UPLOAD_RETRY_MINUTES, WG_UPLOAD_MAX_ATTEMPTS
+from database.database_support_core import GALAXY, GALAXY_UPLOAD, REGISTER
+from image.fitsimage import FitsImage
+from utils.logging_helper import config_logger
+from utils.name_builder import get_galaxy_image_bucket, get_galaxy_file_name, get_key_fits, get_key_sigma_fits, get_saved_files_bucket, get_key_special_fits
+from utils.s3_helper import S3Helper
+
+LOG = config_logger(__name__)
+
+# Put on the queue to tell the threads there is no more work
+_END = object()
+
+
+class UploadClaimLostError(Exception):
+    """
+    Another work generator has claimed the upload
+    """
+    pass
+
+
+def _get_claim_time():
+    # TIMESTAMP columns only hold whole seconds, so the claim can be compared with what was stored
+    return datetime.now().replace(microsecond=0)
+
+
+class GalaxyUploader:
+    """
+    A pool of threads building the images and storing the files of the galaxies queued in GALAXY_UPLOAD
+    """
+    def __init__(self, threads):
+        """
+        Initialise the uploader
+
+        :param threads: the number of galaxies to upload at the same time
+        """
+        # Connections can't be shared between threads, but the engine can
+        self._engine = create_engine(DB_LOGIN)
+        self._queue = Queue.Queue()
+        self._lock = threading.Lock()
+        self._uploads = 0
+        self._upload_time = 0
+        self._threads = []
+        for i in range(max(threads, 1)):
+            self._threads.append(threading.Thread(target=self._upload_loop, name='wg-uploader-{0}'.format(i)))
+
+    def start(self):
+        """
+        Start the uploader threads
+        """
+        LOG.info('Starting {0} uploader threads'.format(len(self._threads)))
+        for thread in self._threads:
+            thread.start()
+
+    def add(self, connection, galaxy_id, register_id, pixel_count):
+        """
+        Queue the upload of a galaxy. The row is claimed by this uploader as it is inserted.
+
+        :param connection: the database connection
+        :param galaxy_id: the galaxy
+        :param register_id: the registration holding the file names
+        :param pixel_count: the pixel count to set once the files have been stored
+        """
+        now = _get_claim_time()
+        result = connection.execute(GALAXY_UPLOAD.insert().values(galaxy_id=galaxy_id,
+                                                                  register_id=register_id,
+                                                                  pixel_count=pixel_count,
+                                                                  attempts=0,
+                                                                  claim_time=now,
+                                                                  create_time=now))
+        LOG.info('Queued the upload of galaxy {0}'.format(galaxy_id))
+        self._queue.put((result.inserted_primary_key[0], now))
+
+    def recover(self, connection):
+        """
+        Claim the uploads left unfinished by a work generator that stopped or failed.
+        Unfinished uploads that have used up their attempts are marked as failed.
+
+        :param connection: the database connection
+        :return: the number of uploads claimed
+        """
+        stale_time = datetime.now() - timedelta(minutes=WG_UPLOAD_RETRY_MINUTES)
+        claimed = 0
+        for upload in connection.execute(select([GALAXY_UPLOAD.c.galaxy_upload_id, GALAXY_UPLOAD.c.claim_time, GALAXY_UPLOAD.c.attempts])
+                                         .where(or_(GALAXY_UPLOAD.c.claim_time == None, GALAXY_UPLOAD.c.claim_time < stale_time))
+                                         .where(GALAXY_UPLOAD.c.failed_time == None)).fetchall():
+            # Another work generator may get there first
+            query = GALAXY_UPLOAD.update().where(GALAXY_UPLOAD.c.galaxy_upload_id == upload[GALAXY_UPLOAD.c.galaxy_upload_id])
+            if upload[GALAXY_UPLOAD.c.claim_time] is None:
+                query = query.where(GALAXY_UPLOAD.c.claim_time == None)
+            else:
+                query = query.where(GALAXY_UPLOAD.c.claim_time == upload[GALAXY_UPLOAD.c.claim_time])
+
+            if upload[GALAXY_UPLOAD.c.attempts] >= WG_UPLOAD_MAX_ATTEMPTS:
+                # The last attempt was lost part way through
+                if connection.execute(query.values(claim_time=None, failed_time=datetime.now())).rowcount == 1:
+                    LOG.error('Marked upload {0} as failed after {1} attempts'.format(upload[GALAXY_UPLOAD.c.galaxy_upload_id], upload[GALAXY_UPLOAD.c.attempts]))
+
+            else:
+                claim_time = _get_claim_time()
+                if connection.execute(query.values(claim_time=claim_time)).rowcount == 1:
+                    self._queue.put((upload[GALAXY_UPLOAD.c.galaxy_upload_id], claim_time))
+                    claimed += 1
+
+        if claimed > 0:
+            LOG.info('Claimed {0} unfinished uploads'.format(claimed))
+
+        failed = connection.execute(select([func.count(GALAXY_UPLOAD.c.galaxy_upload_id)]).where(GALAXY_UPLOAD.c.failed_time != None)).first()[0]
+        if failed > 0:
+            LOG.warning('{0} uploads have failed and are waiting for an operator'.format(failed))
+        return claimed
+
+    def close(self):
+        """
+        Wait for the queued uploads to finish, then stop the threads
+        """
+        for _ in self._threads:
+            self._queue.put(_END)
+        for thread in self._threads:
+            thread.join()
+        self._engine.dispose()
+
+        if self._uploads > 0:
+            LOG.info('Uploaded {0} galaxies, average time {1:.1f} seconds'.format(self._uploads, self._upload_time / self._uploads))
+
+    def _upload_loop(self):
+        while True:
+            task = self._queue.get()
+            if task is _END:
+                break
+
+            galaxy_upload_id, claim_time = task
+
+            # The uploads can be hours apart in a daemon, so don't hold on to a connection
+            start = datetime.now()
+            connection = self._engine.connect()
+            try:
+                upload_galaxy(connection, galaxy_upload_id, claim_time)
+            except UploadClaimLostError:
+                LOG.warning('Upload {0} has been claimed by another work generator'.format(galaxy_upload_id))
+                continue
+            except Exception:
+                LOG.exception('An error occurred while uploading {0}'.format(galaxy_upload_id))
+                continue
+            finally:
+                connection.close()
+
+            with self._lock:
+                self._uploads += 1
+                self._upload_time += (datetime.now() - start).total_seconds()
+
+
+def upload_galaxy(connection, galaxy_upload_id, claim_time):
+    """
+    Build the images, store the FITS files in S3 and then set the pixel count of the galaxy
+
+    :param connection: the database connection
+    :param galaxy_upload_id: the GALAXY_UPLOAD row
+    :param claim_time: the claim_time set when the row was claimed
+    :raises UploadClaimLostError: if another work generator has claimed the row since
+    """
+    upload = connection.execute(select([GALAXY_UPLOAD]).where(GALAXY_UPLOAD.c.galaxy_upload_id == galaxy_upload_id)).first()
+    if upload is None:
+        LOG.info('Upload {0} has already been done'.format(galaxy_upload_id))
+        return
+
+    galaxy_id = upload[GALAXY_UPLOAD.c.galaxy_id]
+    registration = connection.execute(select([REGISTER]).where(REGISTER.c.register_id == upload[GALAXY_UPLOAD.c.register_id])).first()
+    galaxy_name = registration[REGISTER.c.galaxy_name]
+    run_id = registration[REGISTER.c.run_id]
+
+    # The row may have waited in the queue for a while, so start the claim again
+    attempts = upload[GALAXY_UPLOAD.c.attempts] + 1
+    claim_time = _renew_claim(connection, galaxy_upload_id, claim_time, attempts=attempts)
+
+    LOG.info('Uploading {0} (galaxy_id {1}), attempt {2}'.format(galaxy_name, galaxy_id, attempts))
+    try:
+        image = FitsImage(connection)
+        image.build_image(registration[REGISTER.c.filename], get_galaxy_file_name(galaxy_name, run_id, galaxy_id), galaxy_id, get_galaxy_image_bucket())
+        claim_time = _renew_claim(connection, galaxy_upload_id, claim_time)
+
+        s3helper = S3Helper()
+        bucket_name = get_saved_files_bucket()
+        for key, file_name in get_galaxy_files(registration, galaxy_id):
+            s3helper.add_file_to_bucket_multipart(bucket_name, key, file_name, WG_UPLOAD_PART_MB * 1024 * 1024, WG_UPLOAD_PART_THREADS)
+            claim_time = _renew_claim(connection, galaxy_upload_id, claim_time)
+    except UploadClaimLostError:
+        raise
+    except Exception:
+        query = GALAXY_UPLOAD.update().where(GALAXY_UPLOAD.c.galaxy_upload_id == galaxy_upload_id).where(GALAXY_UPLOAD.c.claim_time == claim_time)
+        if attempts >= WG_UPLOAD_MAX_ATTEMPTS:
+            # Leave the row for an operator - recover won't claim it again until failed_time is cleared
+            LOG.error('Giving up on uploading {0} after {1} attempts - the files have been kept'.format(galaxy_name, attempts))
+            connection.execute(query.values(claim_time=None, failed_time=datetime.now()))
+        else:
+            # Let the next recover try again
+            connection.execute(query.values(claim_time=None))
+        raise
+
+    # Store the pixel count as the last thing to stop the original_image_checker going off
+    # too soon for BIG galaxies
+    transaction = connection.begin()
+    try:
+        connection.execute(GALAXY.update().where(GALAXY.c.galaxy_id == galaxy_id).values(pixel_count=upload[GALAXY_UPLOAD.c.pixel_count]))
+        if connection.execute(GALAXY_UPLOAD.delete().where(GALAXY_UPLOAD.c.galaxy_upload_id == galaxy_upload_id)
+                                                    .where(GALAXY_UPLOAD.c.claim_time == claim_time)).rowcount != 1:
+            raise UploadClaimLostError()
+        transaction.commit()
+    except Exception:
+        transaction.rollback()
+        raise
+
+    delete_registration_files(registration)
+    LOG.info('Uploaded {0} (galaxy_id {1})'.format(galaxy_name, galaxy_id))
+
+
+def _renew_claim(connection, galaxy_upload_id, claim_time, **values):
+    """
+    Move the claim_time on so no one else claims the row while we are still working on it
+
+    :param connection: the database connection
+    :param galaxy_upload_id: the GALAXY_UPLOAD row
+    :param claim_time: the claim_time we set last
+    :param values: any other columns to set
+    :return: the new claim_time
+    :raises UploadClaimLostError: if the row has been claimed by someone else
+    """
+    new_claim_time = _get_claim_time()
+    if connection.execute(GALAXY_UPLOAD.update().where(GALAXY_UPLOAD.c.galaxy_upload_id == galaxy_upload_id)
+                                                .where(GALAXY_UPLOAD.c.claim_time == claim_time)
+                                                .values(claim_time=new_claim_time, **values)).rowcount != 1:
+        raise UploadClaimLostError()
+    return new_claim_time
+
+
+def get_galaxy_files(registration, galaxy_id):
+    """
+    Get the FITS files of a registration and the keys they are stored under
+
+    :param registration: the REGISTER row
+    :param galaxy_id: the galaxy
+    :return: a list of (key, file name) tuples
+    """
+    galaxy_name = registration[REGISTER.c.galaxy_name]
+    run_id = registration[REGISTER.c.run_id]
+    sigma_filename = registration[REGISTER.c.sigma_filename]
+    int_flux = registration[REGISTER.c.int_filename]
+    int_flux_sigma = registration[REGISTER.c.int_sigma_filename]
+    rad = registration[REGISTER.c.rad_filename]
+    rad_sigma = registration[REGISTER.c.rad_sigma_filename]
+
+    files = [(get_key_fits(galaxy_name, run_id, galaxy_id), registration[REGISTER.c.filename])]
+    if sigma_filename is not None:
+        files.append((get_key_sigma_fits(galaxy_name, run_id, galaxy_id), sigma_filename))
+
+    if int_flux is not None:
+        files.append((get_key_special_fits(galaxy_name, run_id, galaxy_id, 'int', sigma=False), int_flux))
+        if int_flux_sigma is not None:
+            files.append((get_key_special_fits(galaxy_name, run_id, galaxy_id, 'int', sigma=True), int_flux_sigma))
+
+    if rad is not None:
+        files.append((get_key_special_fits(galaxy_name, run_id, galaxy_id, 'rad', sigma=False), rad))
+        if rad_sigma is not None:
+            files.append((get_key_special_fits(galaxy_name, run_id, galaxy_id, 'rad', sigma=True), rad_sigma))
+
+    return files
+
+
+def delete_registration_files(registration):
+    """
+    Delete the FITS files of a registration once its work units have been made and the files stored
+    """
+    if os.path.exists(registration[REGISTER.c.filename]):
+        os.remove(registration[REGISTER.c.filename])
+    if registration[REGISTER.c.sigma_filename] is not None and os.path.exists(registration[REGISTER.c.sigma_filename]):
+        os.remove(registration[REGISTER.c.sigma_filename])
+    if registration[REGISTER.c.rad_filename] is not None and os.path.exists(registration[REGISTER.c.rad_filename]):
+        os.remove(registration[REGISTER.c.rad_filename])
+    if registration[REGISTER.c.rad_sigma_filename] is not None and os.path.exists(registration[REGISTER.c.rad_sigma_filename]):
+        os.remove(registration[REGISTER.c.rad_sigma_filename])
+    if registration[REGISTER.c.int_filename] is not None and os.path.exists(registration[REGISTER.c.int_filename]):
+        os.remove(registration[REGISTER.c.int_filename])
+    if registration[REGISTER.c.int_sigma_filename] is not None and os.path.exists(registration[REGISTER.c.int_sigma_filename]):
+        os.remove(registration[REGISTER.c.int_sigma_filename])
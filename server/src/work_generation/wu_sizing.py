@@ -0,0 +1,119 @@
+#
+#    Copyright (c) UWA, The University of Western Australia
+#    M468/35 Stirling Hwy
+#    Perth WA 6009
+#    Australia
+#
+#    All rights reserved
+#
+#    This library is free software; you can redistribute it and/or
+#    modify it under the terms of the GNU Lesser General Public
+#    License as published by the Free Software Foundation; either
+#    version 2.1 of the License, or (at your option) any later version.
+#
+#    This library is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    Lesser General Public License for more details.
+#
+#    You should have received a copy of the GNU Lesser General Public
+#    License along with this library; if not, write to the Free Software
+#    Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+#    MA 02111-1307  USA
+#
+"""
+How many pixels go into each work unit and which BOINC size class it is given.
+
+In the "fixed" mode the areas cycle through min_pixels_per_file and the size class comes from the
+size_classes pixel limits. In the "fpops" mode the areas cycle through target_runtimes instead: the
+pixels for each target are worked out from the run's fpops_est so the work unit takes that long on
+a host doing host_flops, and the size class is the target nearest the work unit's estimated runtime.
+The app's n_size_classes must match - len(size_classes) + 1 for "fixed" and len(target_runtimes) for "fpops".
+"""
+import math
+from config import WG_MIN_PIXELS_PER_FILE, WG_ROW_HEIGHT, WG_SIZE_CLASS, WG_SIZING, WG_TARGET_RUNTIMES, WG_HOST_FLOPS
+from utils.logging_helper import config_logger
+
+LOG = config_logger(__name__)
+
+SIZING_FIXED = 'fixed'
+SIZING_FPOPS = 'fpops'
+
+
+class WorkUnitSizer:
+    """
+    Picks the size of the areas and their size class
+    """
+    def __init__(self, fpops_est_per_pixel, sizing=WG_SIZING):
+        """
+        Initialise the sizer
+
+        :param fpops_est_per_pixel: the RUN fpops_est after the band scaling - the work units are given fpops_est * pixels * 1e12
+        :param sizing: "fixed" or "fpops"
+        """
+        self._fpops_per_pixel = fpops_est_per_pixel * 1e12
+        self._sizing = sizing
+        if self._sizing == SIZING_FPOPS and self._fpops_per_pixel <= 0:
+            LOG.warning('The run has no fpops_est, so the fixed sizes will be used')
+            self._sizing = SIZING_FIXED
+
+        if self._sizing == SIZING_FPOPS:
+            self.min_pixels_per_file = []
+            for target_runtime in WG_TARGET_RUNTIMES:
+                self.min_pixels_per_file.append(max(int(round(target_runtime * WG_HOST_FLOPS / self._fpops_per_pixel)), 1))
+
+            # Keep the smallest areas roughly square
+            self.row_height = max(WG_ROW_HEIGHT, int(math.sqrt(min(self.min_pixels_per_file))))
+            LOG.info('Pixels per work unit {0} for the target runtimes {1}, row height {2}'.format(self.min_pixels_per_file, WG_TARGET_RUNTIMES, self.row_height))
+        else:
+            self.min_pixels_per_file = WG_MIN_PIXELS_PER_FILE
+            self.row_height = WG_ROW_HEIGHT
+
+    def get_min_pixels(self, itr):
+        """
+        Get the minimum number of pixels for the next area
+
+        :param itr: where we are in the cycle of sizes
+        :return: the number of pixels
+        """
+        return self.min_pixels_per_file[itr % len(self.min_pixels_per_file)]
+
+    def next_itr(self, itr):
+        """
+        Move on to the next size in the cycle
+
+        :param itr: where we are in the cycle of sizes
+        :return: the next position
+        """
+        return (itr + 1) % len(self.min_pixels_per_file)
+
+    def estimate_runtime(self, pixels_in_area, fpops_est=None):
+        """
+        How long will the work unit take on the reference host?
+
+        :param pixels_in_area: the number of pixels
+        :param fpops_est: the sum of fpops_est for the pixels if they are not all from this galaxy
+        :return: the runtime in seconds
+        """
+        if fpops_est is not None:
+            return fpops_est * 1e12 / WG_HOST_FLOPS
+        return pixels_in_area * self._fpops_per_pixel / WG_HOST_FLOPS
+
+    def get_size_class(self, pixels_in_area, fpops_est=None):
+        """
+        Get the BOINC size class for a work unit
+
+        :param pixels_in_area: the number of pixels
+        :param fpops_est: the sum of fpops_est for the pixels if they are not all from this galaxy
+        :return: the size class
+        """
+        if self._sizing == SIZING_FPOPS:
+            runtime = self.estimate_runtime(pixels_in_area, fpops_est)
+            return min(range(len(WG_TARGET_RUNTIMES)), key=lambda i: abs(math.log(runtime / WG_TARGET_RUNTIMES[i])))
+
+        size_class = len(WG_SIZE_CLASS)
+        for i in range(0, size_class):
+            if pixels_in_area <= WG_SIZE_CLASS[i]:
+                size_class = i
+                break
+        return size_class